@@ -12,12 +12,25 @@ This program is free software under the GNU General Public License
 import os
 import sys
 import atexit
+import numpy as np
 import grass.script as gscript
 from grass.exceptions import CalledModuleError
 import matplotlib.pyplot as plt
-
-# set graphics driver
-driver = "cairo"
+import parallel
+import cache
+import series as series_module
+import priority_flood
+import nearest_flow
+import rasters
+import rendering
+import simwe
+import flow_preview
+import incremental
+import pyramid
+import contours
+import tracing
+import mapcalc
+import univar
 
 # temporary region
 gscript.use_temp_region()
@@ -31,8 +44,45 @@ render = os.path.join(grassdata, render_dir)
 series_dir = os.path.normpath("results/summary/")
 series = os.path.join(grassdata, series_dir)
 
+# set cache directory
+cache_dir = os.path.join(grassdata, os.path.normpath("cache/analysis/"))
+cache_size = 10*1024**3  # maximum size of the cache in bytes
+series_state = os.path.join(grassdata, os.path.normpath("cache/series/"))
+rasters.store_dir = os.path.join(grassdata, os.path.normpath("cache/arrays/"))  # share memory mapped arrays of rasters between stages and processes, disable with None
+contours.cache_dir = os.path.join(grassdata, os.path.normpath("cache/contours/"))  # reuse contour segments of unchanged DEMs, disable with None
+
+# set trace directory
+trace_dir = os.path.join(grassdata, os.path.normpath("results/trace/"))
+
 # set paramters
 overwrite = True
+mapset = "analysis"  # mapset of the scanned DEMs and the maps derived from them
+reference_mapset = "PERMANENT"  # mapset of the reference water depth and concentrated flow points
+nprocs = 1  # number of worker processes for analyzing scanned DEMs and rendering in parallel
+render_maps = True  # render images, disable with --no-render for analysis only runs
+use_cache = True  # reuse derived maps if the DEM and parameters are unchanged
+use_pyramid = False  # screen scans at a coarse resolution and compute depth and depressions at full resolution only where needed
+use_incremental = False  # recompute maps only where each scan changed from the previous scan, for successive scans of a live session
+trace = False  # record the time and resources of every module call, also set with --trace
+series_engine = "streaming"  # update series statistics with new scans with "streaming", compute them in one pass with "numpy", or per statistic with "r.series"
+
+# set water flow parameters
+rain_value = 300
+nwalkers = 5000
+niterations = 4
+contour_step = 5
+contour_method = "r.contour"  # compute contours with "r.contour" or in process with a vectorized "marching-squares"
+threshold = 0.05  # minimum mean depth of concentrated flow
+water_method = "r.sim.water"  # simulate water flow in one run with "r.sim.water", with batches of walkers until convergence with "ensemble", or approximate it from flow accumulation with "preview", also set with --preview
+
+# set depression parameters
+depression_method = "r.fill.dir"  # fill depressions with "r.fill.dir" or in process with "priority-flood", which only partly agrees with r.fill.dir
+epsilon = 0  # raise filled cells above their spill point so that they drain
+
+# set flow distance parameters
+distance_method = "v.distance"  # compute minimum distances with "v.distance", which stores them as integers, or exactly in process with "kd-tree"
+render_flow_distance = True  # write concentrated flow points and flow distance lines and render them
+write_statistics = True  # write tables of the univariate statistics of the maps of each participant
 
 # set variables
 experiments = 2
@@ -42,6 +92,9 @@ iterator = experiments+1
 depressions_colors = '0% aqua\n100% blue'
 depth_colors = '0 255:255:255\n0.001 255:255:0\n0.05 0:255:255\n0.1 0:127:255\n0.5 0:0:255\n100% 0:0:0'
 
+# temporary maps
+temporary_maps = []
+
 # set region
 region = "dem@PERMANENT"
 gscript.run_command('g.region', rast=region, res=3)
@@ -52,9 +105,17 @@ width = int(info.cols)+int(info.cols)/2
 height = int(info.rows)
 
 def main():
+    if trace:
+        tracing.enable(trace_dir)
     analyze_models()
     cells, distance = analyze_series()
+    if render_maps:
+        rendering.render_queue(nprocs)
+    else:
+        rendering.clear_queue()
     plot_series(cells, distance)
+    if trace:
+        tracing.report(trace_dir)
     atexit.register(cleanup)
     sys.exit(0)
 
@@ -62,7 +123,8 @@ def main():
 def cleanup():
     try:
         # remove temporary maps
-        gscript.run_command('g.remove', type='raster', name=['depressionless_dem', 'flow_dir', 'dx', 'dy'], flags='f')
+        if temporary_maps:
+            gscript.run_command('g.remove', type='raster', name=temporary_maps, flags='f')
 
     except CalledModuleError:
         pass
@@ -72,55 +134,322 @@ def analyze_models():
     """Compute the relief, contours, water flow, difference in water flow, depressions, and concentrated flow for each model in each experiment"""
 
     # list scanned DEMs
-    dems = gscript.list_grouped('rast', pattern='*dem*')['analysis']
+    dems = gscript.list_grouped('rast', pattern='*dem*')[mapset]
+
+    # analyze each DEM in its own temporary mapset and merge the results
+    if nprocs > 1:
+        results = parallel.run_in_pool(analyze_model_in_mapset, dems, nprocs)
+        for dem, model_mapset in zip(dems, results):
+            rasters, vectors = model_maps(dem)
+            parallel.merge_mapset(model_mapset, rasters=rasters, vectors=vectors)
+            render_model(dem)
+        return
 
     # iterate through scanned DEMs
+    previous = None
+    progress = tracing.Progress(len(dems), 'models') if trace else None
     for dem in dems:
+        if use_incremental and previous:
+            update_model(dem, previous)
+        else:
+            analyze_model(dem)
+        render_model(dem)
+        previous = dem
+        if progress:
+            progress.step(dem)
+
+
+def analyze_model_in_mapset(dem):
+    """analyze a scanned DEM in a temporary mapset and return the name of the mapset"""
+
+    model_mapset, result = parallel.run_in_mapset(analyze_model, dem, region, search_path=mapset, prefix='analysis')
+    return model_mapset
+
+
+def reference_map(name):
+    """Return the full name of a map in the reference mapset"""
+
+    return name+'@'+reference_mapset
+
+
+def model_outputs(dem):
+    """Return the names of the maps derived from a scanned DEM"""
+
+    return {'relief': dem.replace("dem", "relief"),
+            'contour': dem.replace("dem", "contour"),
+            'depth': dem.replace("dem", "depth"),
+            'difference': dem.replace("dem", "diff"),
+            'depressions': dem.replace("dem", "depressions"),
+            'stderr': dem.replace("dem", "depth_stderr")}
+
 
-        # variables
-        relief = dem.replace("dem", "relief")
-        contour = dem.replace("dem", "contour")
-        depth = dem.replace("dem", "depth")
-        before = "depth@PERMANENT"
-        after = depth
-        difference = dem.replace("dem", "diff")
-        depressions = dem.replace("dem", "depressions")
-
-        # compute relief
-        gscript.run_command('r.relief', input=dem, output=relief, altitude=90, azimuth=45, zscale=1, units="intl", overwrite=overwrite)
-
-        # compute contours
-        gscript.run_command('r.contour', input=dem, output=contour, step=5, overwrite=overwrite)
-
-        # simulate water flow
-        gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(render, depth+".png"), overwrite=overwrite)
-        gscript.run_command('r.slope.aspect', elevation=dem, dx='dx', dy='dy', overwrite=overwrite)
-        gscript.run_command('r.sim.water', elevation=dem, dx='dx', dy='dy', rain_value=300, depth=depth, nwalkers=5000, niterations=4, overwrite=overwrite)
-        gscript.run_command('g.remove', flags='f', type='raster', name=['dx', 'dy'])
-        gscript.run_command('d.shade', shade=relief, color=depth, brighten=75)
-        gscript.run_command('d.vect', map=contour, display='shape')
-        gscript.run_command('d.legend', raster=depth, fontsize=9, at=(10, 90, 1, 4))
-        gscript.run_command('d.mon', stop=driver)
-
-        # identify depressions
-        gscript.run_command('r.fill.dir', input=dem, output='depressionless_dem', direction='flow_dir',overwrite=overwrite)
-        gscript.run_command('r.mapcalc', expression='{depressions} = if({depressionless_dem} - {dem} > {depth}, {depressionless_dem} - {dem}, null())'.format(depressions=depressions, depressionless_dem='depressionless_dem', dem=dem, depth=0), overwrite=overwrite)
-        gscript.write_command('r.colors', map=depressions, rules='-', stdin=depressions_colors)
-        gscript.run_command('g.remove', flags='f', type='raster', name=['depressionless_dem','flow_dir'])
-        gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(render, depressions+".png"), overwrite=overwrite)
-        gscript.run_command('d.shade', shade=relief, color=depressions, brighten=75)
-        gscript.run_command('d.vect', map=contour, display='shape')
-        gscript.run_command('d.legend', raster=depressions, fontsize=9, at=(10, 90, 1, 4))
-        gscript.run_command('d.mon', stop=driver)
-
-        # compute the difference between the modeled and reference flow depth
-        gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(render, difference+".png"), overwrite=overwrite)
-        gscript.run_command('r.mapcalc', expression='{difference} = {before} - {after}'.format(before=before, after=after, difference=difference), overwrite=overwrite)
-        gscript.run_command('r.colors', map=difference, color='differences')
-        gscript.run_command('d.shade', shade=relief, color=difference, brighten=75)
-        gscript.run_command('d.vect', map=contour, display='shape')
-        gscript.run_command('d.legend', raster=difference, fontsize=9, at=(10, 90, 1, 4))
-        gscript.run_command('d.mon', stop=driver)
+def model_parameters():
+    """Return the module parameters that the maps derived from a scanned DEM depend on"""
+
+    parameters = {'relief': {'altitude': 90, 'azimuth': 45, 'zscale': 1, 'units': "intl"},
+                  'contour': {'step': contour_step, 'method': contour_method, 'vector': contour_vectors()},
+                  'water': water_parameters(),
+                  'depressions': {'depth': 0, 'method': depression_method, 'epsilon': epsilon},
+                  'colors': {'depressions': depressions_colors, 'difference': 'differences'}}
+    if use_pyramid:
+        parameters['pyramid'] = {'factor': pyramid.factor, 'halo': pyramid.halo, 'depth_threshold': pyramid.depth_threshold,
+                                 'difference_threshold': pyramid.difference_threshold}
+    return parameters
+
+
+def water_parameters():
+    """Return the parameters of the water flow simulation"""
+
+    if water_method == "preview":
+        return {'rain_value': rain_value, 'method': water_method, 'routing': flow_preview.method,
+                'mannings': flow_preview.mannings, 'min_slope': flow_preview.min_slope, 'scale': flow_preview.scale}
+    if water_method == "ensemble":
+        return {'rain_value': rain_value, 'niterations': niterations, 'method': water_method,
+                'batch_walkers': simwe.batch_walkers, 'min_batches': simwe.min_batches, 'max_batches': simwe.max_batches,
+                'tolerance': simwe.tolerance, 'min_depth': simwe.min_depth, 'coverage': simwe.coverage}
+    return {'rain_value': rain_value, 'nwalkers': nwalkers, 'niterations': niterations}
+
+
+def model_maps(dem):
+    """Return the rasters and vectors derived from a scanned DEM that are kept"""
+
+    outputs = model_outputs(dem)
+    rasters = [outputs['relief'], outputs['depth'], outputs['depressions'], outputs['difference']]
+    vectors = [outputs['contour']] if contour_vectors() else []
+    if water_method == "ensemble":
+        rasters.append(outputs['stderr'])
+    return rasters, vectors
+
+
+def contour_vectors():
+    """Return whether contours are written as vector maps, which marching squares contours only need for d.vect"""
+
+    return contour_method != "marching-squares" or (render_maps and rendering.renderer == "grass")
+
+
+def analyze_model(dem, env=None):
+    """Compute the relief, contours, water flow, difference in water flow, and depressions for a scanned DEM"""
+
+    rasters, vectors = model_maps(dem)
+    compute = compute_pyramid if use_pyramid else compute_model
+
+    # reuse cached maps if neither the DEM, the reference, nor the parameters changed
+    if use_cache:
+        key = cache.cache_key([dem, reference_map("depth")], model_parameters(), env=env)
+        if not cache.load(cache_dir, key, rasters, vectors, env=env):
+            compute(dem, env=env)
+            cache.store(cache_dir, key, rasters, vectors, max_size=cache_size, env=env)
+    else:
+        compute(dem, env=env)
+
+
+def compute_model(dem, env=None):
+    """Compute the maps derived from a scanned DEM"""
+
+    # variables
+    outputs = model_outputs(dem)
+    relief = outputs['relief']
+    contour = outputs['contour']
+    depth = outputs['depth']
+    before = reference_map("depth")
+    after = depth
+    difference = outputs['difference']
+    depressions = outputs['depressions']
+
+    # compute relief
+    gscript.run_command('r.relief', input=dem, output=relief, altitude=90, azimuth=45, zscale=1, units="intl", overwrite=overwrite, env=env)
+
+    # compute contours
+    compute_contours(dem, contour, env=env)
+
+    # simulate water flow
+    simulate_water(dem, depth, outputs['stderr'], env=env)
+
+    # identify depressions and compute the difference between the modeled and reference flow depth in one pass
+    batch = mapcalc.Batch(env=env)
+    identify_depressions(dem, depressions, env=env, batch=batch)
+    batch.add(difference, '{before} - {after}'.format(before=before, after=after), color='differences')
+    batch.run()
+
+
+def compute_contours(dem, contour, env=None):
+    """Compute the contours of a DEM with the contour method"""
+
+    if contour_method == "marching-squares":
+        lines, levels = contours.cached_contours(dem, contour_step, env=env)
+        if contour_vectors():
+            contours.write_vector(lines, levels, contour, env=env)
+        return
+    gscript.run_command('r.contour', input=dem, output=contour, step=contour_step, overwrite=overwrite, env=env)
+
+
+def simulate_water(dem, depth, stderr=None, env=None):
+    """Simulate the water flow depth over a DEM with the water flow method"""
+
+    dx = parallel.temporary_name('dx')
+    dy = parallel.temporary_name('dy')
+    temporary_maps.extend([dx, dy])
+    if water_method == "preview":
+        flow_preview.simulate(dem, depth, rain_value, colors=reference_map("depth"), env=env)
+    else:
+        gscript.run_command('r.slope.aspect', elevation=dem, dx=dx, dy=dy, overwrite=overwrite, env=env)
+        if water_method == "ensemble":
+            simwe.simulate(dem, dx, dy, depth, rain_value, niterations, stderr=stderr, env=env)
+            gscript.run_command('r.colors', map=depth, raster=reference_map("depth"), env=env)
+        else:
+            gscript.run_command('r.sim.water', elevation=dem, dx=dx, dy=dy, rain_value=rain_value, depth=depth, nwalkers=nwalkers, niterations=niterations, overwrite=overwrite, env=env)
+        gscript.run_command('g.remove', flags='f', type='raster', name=[dx, dy], env=env)
+
+
+def identify_depressions(dem, depressions, env=None, batch=None):
+    """Identify the depressions of a DEM with the depression method
+
+    With a batch of map algebra the depressions filled by r.fill.dir are
+    computed when the batch is run
+    """
+
+    depressionless_dem = parallel.temporary_name('depressionless_dem')
+    flow_dir = parallel.temporary_name('flow_dir')
+    temporary_maps.extend([depressionless_dem, flow_dir])
+    if depression_method == "priority-flood":
+        priority_flood.compute_depressions(dem, depressions, epsilon=epsilon, depth=0, env=env)
+        gscript.write_command('r.colors', map=depressions, rules='-', stdin=depressions_colors, env=env)
+        return
+    own_batch = batch is None
+    if own_batch:
+        batch = mapcalc.Batch(env=env)
+    gscript.run_command('r.fill.dir', input=dem, output=depressionless_dem, direction=flow_dir, overwrite=overwrite, env=env)
+    batch.add(depressions, 'if({depressionless_dem} - {dem} > {depth}, {depressionless_dem} - {dem}, null())'.format(depressionless_dem=depressionless_dem, dem=dem, depth=0), rules=depressions_colors)
+    batch.remove(depressionless_dem, flow_dir)
+    if own_batch:
+        batch.run()
+
+
+def compute_pyramid(dem, env=None):
+    """Compute the maps derived from a scanned DEM, refining depth and depressions only where a coarse screening needs it
+
+    Depth and depressions are computed at full resolution where the coarse
+    maps show concentrated flow, depressions, or differences from the
+    reference and are null elsewhere. Each refined area is simulated with
+    the catchment upstream of it so that its inflow is not lost.
+    """
+
+    # variables
+    outputs = model_outputs(dem)
+    keys = ['depth', 'depressions']
+    if water_method == "ensemble":
+        keys.append('stderr')
+    coarse = dict((key, parallel.temporary_name('coarse_'+key)) for key in keys)
+    fine = dict((key, parallel.temporary_name('fine_'+key)) for key in keys)
+    patched = dict((key, parallel.temporary_name(key)) for key in keys)
+    mask = parallel.temporary_name('refined')
+    catchment_mask = parallel.temporary_name('catchment')
+    temporary_maps.extend(list(coarse.values())+list(fine.values())+list(patched.values())+[mask, catchment_mask])
+
+    # compute relief and contours over the whole region
+    gscript.run_command('r.relief', input=dem, output=outputs['relief'], altitude=90, azimuth=45, zscale=1, units="intl", overwrite=overwrite, env=env)
+    compute_contours(dem, outputs['contour'], env=env)
+
+    # screen the DEM at coarse resolution
+    info = gscript.region(env=env)
+    coarse_env = pyramid.coarse_environment(info, env)
+    simulate_water(dem, coarse['depth'], coarse.get('stderr'), env=coarse_env)
+    identify_depressions(dem, coarse['depressions'], env=coarse_env)
+    refined = pyramid.refine_mask(rasters.read_array(coarse['depth'], env=coarse_env), rasters.read_array(coarse['depressions'], env=coarse_env),
+                                  rasters.read_array(reference_map("depth"), env=coarse_env))
+    rasters.write_array(np.where(refined, 1, np.nan), mask, env=coarse_env)
+
+    # include the catchments upstream of the refined areas so that their flow reaches them
+    coarse_info = gscript.region(env=coarse_env)
+    catchment = incremental.upstream(rasters.read_array(dem, env=coarse_env), refined, float(coarse_info['ewres']), float(coarse_info['nsres']))
+    rasters.write_array(np.where(catchment, 1, np.nan), catchment_mask, env=coarse_env)
+
+    # recompute at full resolution in the bounding boxes of the refined areas and their catchments
+    refined = ~np.isnan(rasters.read_array(mask, env=env))
+    recompute = ~np.isnan(rasters.read_array(catchment_mask, env=env))
+    batch = mapcalc.Batch(env=env)
+    for key in keys:
+        batch.add(patched[key], 'null()')
+    batch.run()
+    boxes = incremental.boxes(recompute)
+    for box in boxes:
+        box_env = incremental.box_environment(box, info, env)
+        simulate_water(dem, fine['depth'], fine.get('stderr'), env=box_env)
+        identify_depressions(dem, fine['depressions'], env=box_env)
+        incremental.patch_maps([(patched[key], fine[key]) for key in keys], mask, env=env)
+    for key in keys:
+        if boxes:
+            gscript.run_command('r.colors', map=patched[key], raster=fine[key], env=env)
+        gscript.run_command('g.rename', raster=[patched[key], outputs[key]], overwrite=overwrite, env=env)
+    gscript.run_command('g.remove', flags='f', type='raster', name=list(coarse.values())+list(fine.values())+[mask, catchment_mask], env=env)
+    print(dem + ': refined ' + str(len(boxes)) + ' regions with ' + str(round(refined.mean()*100, 1)) + ' percent of cells')
+
+    # compute the difference between the modeled and reference flow depth
+    gscript.run_command('r.mapcalc', expression='{difference} = {before} - {after}'.format(before=reference_map("depth"), after=outputs['depth'], difference=outputs['difference']), overwrite=overwrite, env=env)
+    gscript.run_command('r.colors', map=outputs['difference'], color='differences', env=env)
+
+
+def update_model(dem, previous, env=None):
+    """Update the maps derived from the previous scanned DEM where a scanned DEM changed"""
+
+    outputs = model_outputs(dem)
+    previous_outputs = model_outputs(previous)
+    keys = ['relief', 'depth', 'depressions']
+    if water_method == "ensemble":
+        keys.append('stderr')
+
+    # find the cells influenced by the changes
+    info = gscript.region(env=env)
+    changed, influenced, recompute = incremental.influence(rasters.load_array(previous, env=env), rasters.load_array(dem, env=env),
+                                                           float(info['ewres']), float(info['nsres']))
+    if recompute.mean() > incremental.max_fraction:
+        compute_model(dem, env=env)
+        return
+
+    # start from the maps of the previous scan
+    patched = dict((key, parallel.temporary_name(key)) for key in keys)
+    mask = parallel.temporary_name('influenced')
+    temporary_maps.extend(list(patched.values())+[mask])
+    for key in keys:
+        gscript.run_command('g.copy', raster=[previous_outputs[key], patched[key]], overwrite=overwrite, env=env)
+    rasters.write_array(np.where(influenced, 1, np.nan), mask, env=env)
+
+    # recompute the maps in the bounding boxes of the influenced cells and patch them
+    boxes = incremental.boxes(recompute)
+    for box in boxes:
+        compute_model(dem, env=incremental.box_environment(box, info, env))
+        incremental.patch_maps([(patched[key], outputs[key]) for key in keys], mask, env=env)
+    for key in keys:
+        gscript.run_command('g.rename', raster=[patched[key], outputs[key]], overwrite=overwrite, env=env)
+    gscript.run_command('g.remove', flags='f', type='raster', name=mask, env=env)
+    print(dem + ': recomputed ' + str(len(boxes)) + ' regions with ' + str(int(changed.sum())) + ' changed cells')
+
+    # contours and differences are fast to recompute over the whole region
+    compute_contours(dem, outputs['contour'], env=env)
+    gscript.run_command('r.mapcalc', expression='{difference} = {before} - {after}'.format(before=reference_map("depth"), after=outputs['depth'], difference=outputs['difference']), overwrite=overwrite, env=env)
+    gscript.run_command('r.colors', map=outputs['difference'], color='differences', env=env)
+
+
+def model_renders(dem):
+    """Return render specifications of the water flow, depressions, and difference in water flow for a scanned DEM"""
+
+    # variables
+    outputs = model_outputs(dem)
+    relief = outputs['relief']
+    overlay = {'map': outputs['contour'], 'display': 'shape'}
+    if contour_method == "marching-squares":
+        # the in-process renderer draws the cached contour segments
+        overlay['source'] = {'dem': dem, 'step': contour_step}
+
+    return [rendering.spec(os.path.join(render, raster+".png"), relief, raster, width, height, overlays=[overlay])
+            for raster in [outputs['depth'], outputs['depressions'], outputs['difference']]]
+
+
+def render_model(dem):
+    """Queue renders of the water flow, depressions, and difference in water flow for a scanned DEM"""
+
+    for specification in model_renders(dem):
+        rendering.enqueue(specification)
 
 
 def analyze_series():
@@ -130,144 +459,169 @@ def analyze_series():
     distance = []
 
     # compute percentage of cells with depressions in the reference
-    univar_ref_cells = gscript.parse_command('r.univar', map="depressions@PERMANENT", separator='newline', flags='g')
-    total_count = float(univar_ref_cells['cells'])
-    null_count = float(univar_ref_cells['null_cells'])
+    reference_statistics = univar.row(univar.collect(["depressions@PERMANENT"]), "depressions@PERMANENT")
+    total_count = float(reference_statistics['cells'])
+    null_count = float(reference_statistics['null_cells'])
     depression_count = total_count - null_count
     reference_percent = depression_count/total_count*100
     cells.append(reference_percent)
     print 'percentage cells with depressions in reference: ' + str(reference_percent)
 
-    for i in range(1, iterator):
-
-        # variables
-        diff_pattern = "*diff_"+str(i)
-        depth_pattern = "*depth_"+str(i)
-        depressions_pattern = "*depressions_"+str(i)
-        reference_contour = "contour@PERMANENT"
-        reference_relief = "relief@PERMANENT"
-        mean_diff = "mean_diff_"+str(i)
-        mean_depth = "mean_depth_"+str(i)
-        max_depth = "max_depth_"+str(i)
-        sum_depth = "sum_depth_"+str(i)
-        mean_depressions = "mean_depressions_"+str(i)
-        max_depressions = "max_depressions_"+str(i)
-        sum_depressions = "sum_depressions_"+str(i)
-        concentrated_flow = "concentrated_flow_"+str(i)
-        concentrated_points = "concentrated_points_"+str(i)
-        reference_points = "concentrated_points"
-        flow_distance = "flow_distance_"+str(i)
-        copied_points = 'copied_points_'+str(i)
-
-        # list depths
-        depth_list = gscript.list_grouped('rast', pattern=depth_pattern)['analysis']
-
-        # list of differences of depths
-        diff_list = gscript.list_grouped('rast', pattern=diff_pattern)['analysis']
-
-        # list depths
-        depressions_list = gscript.list_grouped('rast', pattern=depressions_pattern)['analysis']
-
-        # compute the mean of depths
-        gscript.run_command('r.series', input=depth_list, output=mean_depth, method="average", overwrite=overwrite)
-        gscript.write_command('r.colors', map=mean_depth, rules='-', stdin=depth_colors)
-        gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(series, mean_depth+".png"), overwrite=overwrite)
-        gscript.run_command('d.shade', shade=reference_relief, color=mean_depth, brighten=75)
-        gscript.run_command('d.vect', map=reference_contour, display='shape')
-        gscript.run_command('d.legend', raster=mean_depth, fontsize=9, at=(10, 90, 1, 4))
-        gscript.run_command('d.mon', stop=driver)
-
-        # compute mean of differences of depths
-        gscript.run_command('r.series', input=diff_list, output=mean_diff, method="average", overwrite=overwrite)
-        gscript.run_command('r.colors', map=mean_diff, color='differences')
-        gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(series, mean_diff+".png"), overwrite=overwrite)
-        gscript.run_command('d.shade', shade=reference_relief, color=mean_diff, brighten=75)
-        gscript.run_command('d.vect', map=reference_contour, display='shape')
-        gscript.run_command('d.legend', raster=mean_diff, fontsize=9, at=(10, 90 ,1 ,4))
-        gscript.run_command('d.mon', stop=driver)
-
-        # compute maximum flow depth
-        gscript.run_command('r.series', input=depth_list, output=max_depth, method="maximum", overwrite=overwrite)
-        gscript.write_command('r.colors', map=max_depth, rules='-', stdin=depth_colors)
-        gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(series, max_depth+".png"), overwrite=overwrite)
-        gscript.run_command('d.shade', shade=reference_relief, color=max_depth, brighten=75)
-        gscript.run_command('d.vect', map=reference_contour, display='shape')
-        gscript.run_command('d.legend', raster=max_depth, fontsize=9, at=(10, 90, 1, 4))
-        gscript.run_command('d.mon', stop=driver)
-
-        # compute sum of flow depth
-        gscript.run_command('r.series', input=depth_list, output=sum_depth, method="sum", overwrite=overwrite)
-        gscript.write_command('r.colors', map=sum_depth, rules='-', stdin=depth_colors)
-        gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(series, sum_depth+".png"), overwrite=overwrite)
-        gscript.run_command('d.shade', shade=reference_relief, color=sum_depth, brighten=75)
-        gscript.run_command('d.vect', map=reference_contour, display='shape')
-        gscript.run_command('d.legend', raster=sum_depth, fontsize=9, at=(10, 90, 1, 4))
-        gscript.run_command('d.mon', stop=driver)
-
-        # compute mean depressions
-        gscript.run_command('r.series', input=depressions_list, output=mean_depressions, method="average", overwrite=overwrite)
-        gscript.write_command('r.colors', map=mean_depressions, rules='-', stdin=depressions_colors)
-        gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(series, mean_depressions+".png"), overwrite=overwrite)
-        gscript.run_command('d.shade', shade=reference_relief, color=mean_depressions, brighten=75)
-        gscript.run_command('d.vect', map=reference_contour, display='shape')
-        gscript.run_command('d.legend', raster=mean_depressions, fontsize=9, at=(10, 90, 1, 4))
-        gscript.run_command('d.mon', stop=driver)
-
-        # compute maximum depressions
-        gscript.run_command('r.series', input=depressions_list, 
-                            output=max_depressions, method="maximum", overwrite=overwrite)
-        gscript.write_command('r.colors', map=max_depressions, rules='-', stdin=depressions_colors)
-        gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(series,max_depressions+".png"), overwrite=overwrite)
-        gscript.run_command('d.shade', shade=reference_relief, color=max_depressions, brighten=75)
-        gscript.run_command('d.vect', map=reference_contour, display='shape')
-        gscript.run_command('d.legend', raster=max_depressions, fontsize=9, at=(10, 90, 1, 4))
-        gscript.run_command('d.mon', stop=driver)
-
-        # compute sum of depressions
-        gscript.run_command('r.series', input=depressions_list, output=sum_depressions, method="sum", overwrite=overwrite)
-        gscript.write_command('r.colors', map=sum_depressions, rules='-', stdin=depressions_colors)
-        gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(series, sum_depressions+".png"), overwrite=overwrite)
-        gscript.run_command('d.shade', shade=reference_relief, color=sum_depressions, brighten=75)
-        gscript.run_command('d.vect', map=reference_contour, display='shape')
-        gscript.run_command('d.legend', raster=sum_depressions, fontsize=9, at=(10, 90, 1, 4))
-        gscript.run_command('d.mon', stop=driver)
-
-        # extract concentrated flow
-        gscript.run_command('r.mapcalc', expression='{concentrated_flow} = if({mean_depth}>=0.05,{mean_depth},null())'.format(mean_depth=mean_depth, concentrated_flow=concentrated_flow), overwrite=overwrite)
-        gscript.write_command('r.colors', map=concentrated_flow, rules='-', stdin=depth_colors)
-        gscript.run_command('r.random', input=concentrated_flow, npoints='100%', vector=concentrated_points, overwrite=overwrite)
-
-        # compute distance from reference
-        gscript.run_command('g.copy', vector=[reference_points+'@PERMANENT', copied_points], overwrite=overwrite)
-        gscript.run_command('v.db.addcolumn', map=copied_points, columns='distance INTEGER', overwrite=overwrite)
-        gscript.run_command('v.distance', from_=copied_points, to=concentrated_points, upload='dist', column='distance', output=flow_distance, separator='newline', overwrite=overwrite)
-        univar_distance = gscript.parse_command('v.db.univar', map=copied_points, column='distance', flags='g', overwrite=overwrite)
-        dist = float(univar_distance['sum'])
+    # read the reference concentrated flow points
+    reference_xy = None
+    if distance_method == "kd-tree":
+        reference_xy = nearest_flow.read_points(reference_map("concentrated_points"))
+
+    # analyze each experiment in its own temporary mapset and merge the results in order
+    experiments = [(i, reference_xy) for i in range(1, iterator)]
+    if nprocs > 1:
+        results = []
+        for experiment_mapset, result in parallel.run_in_pool(analyze_experiment_in_mapset, experiments, nprocs):
+            parallel.merge_mapset(experiment_mapset, rasters=result['rasters'], vectors=result['vectors'])
+            results.append(result)
+    else:
+        results = [analyze_experiment(experiment) for experiment in experiments]
+
+    for result in sorted(results, key=lambda result: result['experiment']):
+        i = result['experiment']
+        distance_statistics = result['distance_statistics']
+        dist = float(distance_statistics['sum'])
         distance.append(dist)
         print 'sum of min distance in experiment '+str(i)+': ' + str(dist)
-        mean_dist = float(univar_distance['mean'])
+        mean_dist = float(distance_statistics['mean'])
         print 'mean of min distance in experiment '+str(i)+': ' + str(mean_dist)
+        for p in nearest_flow.percentiles:
+            if 'percentile_'+str(p) in distance_statistics:
+                print str(p)+'th percentile of min distance in experiment '+str(i)+': ' + str(distance_statistics['percentile_'+str(p)])
 
-        # render
-        gscript.run_command('d.mon', start=driver, width=width*2, height=height*2, output=os.path.join(series,concentrated_flow+".png"), overwrite=overwrite)
-        gscript.run_command('d.shade', shade=reference_relief, color=mean_diff, brighten=75)
-        gscript.run_command('d.vect', map=reference_contour, display='shape')
-        gscript.run_command('d.vect', map=reference_points, display='shape', color='blue')
-        gscript.run_command('d.vect', map=concentrated_points, display='shape', color='red')
-        gscript.run_command('d.vect', map=flow_distance, display='shape')
-        gscript.run_command('d.mon', stop=driver)
+        # queue renders
+        for specification in result['renders']:
+            rendering.enqueue(specification)
 
         # compute number of cells with depressions
-        univar = gscript.parse_command('r.univar', map=sum_depressions, separator='newline', flags='g')
-        nulls = float(univar['null_cells'])
-        depression_cells = total_count - nulls
-        depression_percent = depression_cells/total_count*100
+        depression_percent = (total_count-result['depression_nulls'])/total_count*100
         cells.append(depression_percent)
         print 'percent of cells with depressions in experiment '+str(i)+': ' + str(depression_percent)
 
     return cells, distance
 
 
+def analyze_experiment_in_mapset(experiment):
+    """analyze an experiment in a temporary mapset and return the name of the mapset and the result"""
+
+    return parallel.run_in_mapset(analyze_experiment, experiment, region, search_path=mapset, prefix='series')
+
+
+def analyze_experiment(experiment, env=None):
+    """compute the series statistics, concentrated flow, and distance from the reference of an experiment
+
+    experiment is a tuple of the number of the experiment and the coordinates
+    of the reference concentrated flow points for the kd-tree distance method;
+    returns the statistics, render specifications, and maps of the experiment
+    """
+
+    i, reference_xy = experiment
+
+    # variables
+    diff_pattern = "*diff_"+str(i)
+    depth_pattern = "*depth_"+str(i)
+    depressions_pattern = "*depressions_"+str(i)
+    reference_contour = "contour@PERMANENT"
+    reference_relief = "relief@PERMANENT"
+    mean_diff = "mean_diff_"+str(i)
+    mean_depth = "mean_depth_"+str(i)
+    max_depth = "max_depth_"+str(i)
+    sum_depth = "sum_depth_"+str(i)
+    mean_depressions = "mean_depressions_"+str(i)
+    max_depressions = "max_depressions_"+str(i)
+    sum_depressions = "sum_depressions_"+str(i)
+    concentrated_flow = "concentrated_flow_"+str(i)
+    concentrated_points = "concentrated_points_"+str(i)
+    flow_distance = "flow_distance_"+str(i)
+    copied_points = 'copied_points_'+str(i)
+    renders = []
+    vectors = []
+
+    # list depths
+    depth_list = gscript.list_grouped('rast', pattern=depth_pattern, env=env)[mapset]
+
+    # list of differences of depths
+    diff_list = gscript.list_grouped('rast', pattern=diff_pattern, env=env)[mapset]
+
+    # list depths
+    depressions_list = gscript.list_grouped('rast', pattern=depressions_pattern, env=env)[mapset]
+
+    # compute the mean, maximum, and sum of depths, differences, and depressions
+    statistics = [(depth_pattern, "average", mean_depth, depth_colors),
+                  (diff_pattern, "average", mean_diff, None),
+                  (depth_pattern, "maximum", max_depth, depth_colors),
+                  (depth_pattern, "sum", sum_depth, depth_colors),
+                  (depressions_pattern, "average", mean_depressions, depressions_colors),
+                  (depressions_pattern, "maximum", max_depressions, depressions_colors),
+                  (depressions_pattern, "sum", sum_depressions, depressions_colors)]
+    stacks = {depth_pattern: depth_list, diff_pattern: diff_list, depressions_pattern: depressions_list}
+    if series_engine == "streaming":
+        series_module.update_series(stacks, [(stack, method, output) for stack, method, output, colors in statistics], series_state, env=env)
+    elif series_engine == "numpy":
+        series_module.compute_series(stacks, [(stack, method, output) for stack, method, output, colors in statistics], env=env)
+    else:
+        for stack, method, output, colors in statistics:
+            gscript.run_command('r.series', input=stacks[stack], output=output, method=method, overwrite=overwrite, env=env)
+
+    # set colors and render statistics
+    for stack, method, output, colors in statistics:
+        if colors:
+            gscript.write_command('r.colors', map=output, rules='-', stdin=colors, env=env)
+        else:
+            gscript.run_command('r.colors', map=output, color='differences', env=env)
+        renders.append(rendering.spec(os.path.join(series, output+".png"), reference_relief, output, width, height, overlays=[{'map': reference_contour, 'display': 'shape'}]))
+
+    # extract concentrated flow
+    gscript.run_command('r.mapcalc', expression='{concentrated_flow} = if({mean_depth}>={threshold},{mean_depth},null())'.format(mean_depth=mean_depth, concentrated_flow=concentrated_flow, threshold=threshold), overwrite=overwrite, env=env)
+    gscript.write_command('r.colors', map=concentrated_flow, rules='-', stdin=depth_colors, env=env)
+
+    # compute distance from reference
+    if distance_method == "kd-tree":
+        flow_points = nearest_flow.cell_coordinates(rasters.read_array(concentrated_flow, env=env), env=env)
+        min_distances, nearest = nearest_flow.nearest_distances(reference_xy, flow_points)
+        distance_statistics = nearest_flow.distance_statistics(min_distances)
+        flow_vectors = render_maps and render_flow_distance and len(flow_points) > 0
+        if flow_vectors:
+            nearest_flow.write_points(flow_points, concentrated_points, env=env)
+            nearest_flow.write_lines(reference_xy, flow_points[nearest], flow_distance, env=env)
+            vectors.extend([concentrated_points, flow_distance])
+    else:
+        gscript.run_command('r.random', input=concentrated_flow, npoints='100%', vector=concentrated_points, overwrite=overwrite, env=env)
+        gscript.run_command('g.copy', vector=[reference_map("concentrated_points"), copied_points], overwrite=overwrite, env=env)
+        gscript.run_command('v.db.addcolumn', map=copied_points, columns='distance INTEGER', overwrite=overwrite, env=env)
+        gscript.run_command('v.distance', from_=copied_points, to=concentrated_points, upload='dist', column='distance', output=flow_distance, separator='newline', overwrite=overwrite, env=env)
+        distance_statistics = gscript.parse_command('v.db.univar', map=copied_points, column='distance', flags='g', overwrite=overwrite, env=env)
+        vectors.extend([concentrated_points, copied_points, flow_distance])
+        flow_vectors = True
+
+    # render concentrated flow
+    if render_flow_distance and flow_vectors:
+        renders.append(rendering.spec(os.path.join(series, concentrated_flow+".png"), reference_relief, mean_diff, width*2, height*2, legend=False,
+                                      overlays=[{'map': reference_contour, 'display': 'shape'},
+                                                {'map': reference_map("concentrated_points"), 'display': 'shape', 'color': 'blue'},
+                                                {'map': concentrated_points, 'display': 'shape', 'color': 'red'},
+                                                {'map': flow_distance, 'display': 'shape'}]))
+
+    # tabulate the statistics of each participant's maps and count cells without depressions
+    statistics_table = univar.collect(depth_list+diff_list+depressions_list+[sum_depressions], env=env)
+    if write_statistics:
+        if not os.path.isdir(series):
+            os.makedirs(series)
+        univar.write_table(statistics_table, os.path.join(series, "univar_"+str(i)+".csv"))
+
+    return {'experiment': i,
+            'distance_statistics': dict(distance_statistics),
+            'depression_nulls': float(univar.row(statistics_table, sum_depressions)['null_cells']),
+            'renders': renders,
+            'rasters': [output for stack, method, output, colors in statistics]+[concentrated_flow],
+            'vectors': vectors}
+
+
 def plot_series(cells, distance):
     """plot the percent of cells with depressions and the minumum distance of mean concentrated flow points from the reference for each experiment"""
 
@@ -302,5 +656,11 @@ def plot_series(cells, distance):
 
 
 if __name__ == "__main__":
+    if '--no-render' in sys.argv[1:]:
+        render_maps = False
+    if '--preview' in sys.argv[1:]:
+        water_method = "preview"
+    if '--trace' in sys.argv[1:]:
+        trace = True
     atexit.register(cleanup)
     sys.exit(main())
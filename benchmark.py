@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: benchmarks for the tangible water flow experiment
+
+Compares GRASS modules with the in-process engines on the reference DEM and
+times every analysis stage on synthetic sand table DEMs, with fractal noise,
+pits, and channels, and on synthetic series of participants sculpting them.
+The timings of the synthetic DEMs are appended to a JSON file so that
+regressions can be tracked as the DEM size and number of participants grow.
+Run it with --synthetic to only benchmark the synthetic DEMs.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import atexit
+import tempfile
+import numpy as np
+import grass.script as gscript
+from grass.exceptions import CalledModuleError
+import parallel
+import rasters
+import priority_flood
+import reinterpolation
+import rst
+import flow_preview
+import contours
+import series
+import nearest_flow
+import rendering
+import render_3d_images
+
+# set parameters
+repeat = 3
+region = "dem@PERMANENT"
+
+# set synthetic parameters
+sizes = [(200, 300), (400, 600)]  # rows and columns of the synthetic DEMs
+participants = [5, 20]  # number of participants of the synthetic series
+seed = 0  # seed of the random terrain and series
+synthetic_res = 1  # resolution of the synthetic DEMs
+relief_range = 30  # difference between the lowest and highest elevation of the fractal noise
+roughness = 3.0  # falloff of the power spectrum of the fractal noise with frequency
+tilt = 20  # drop in elevation across the table so that water drains
+pits = 8  # number of pits
+pit_depth = 4  # maximum depth of the pits
+pit_radius = 0.04  # maximum radius of the pits as a fraction of the width
+channels = 3  # number of meandering channels
+channel_depth = 3  # depth of the channels
+channel_width = 0.015  # width of the channels as a fraction of the width
+sculpting = 5  # number of mounds and pits each participant sculpts
+sculpting_height = 3  # maximum height or depth that participants sculpt
+scan_noise = 0.2  # standard deviation of the scanning noise
+threshold = 0.05  # minimum mean depth of concentrated flow
+contour_step = 5
+
+# set results file
+results = os.path.normpath("results/benchmark/benchmark.json")
+
+# temporary maps
+temporary_maps = []
+temporary_vectors = []
+
+
+def main():
+    gscript.use_temp_region()
+    if '--synthetic' not in sys.argv[1:]:
+        gscript.run_command('g.region', raster=region, res=3)
+        benchmark_depressions(region)
+        benchmark_interpolation(region)
+        benchmark_preview(region)
+    runs = [benchmark_synthetic(rows, cols, count) for rows, cols in sizes for count in participants]
+    write_results(runs, results)
+    sys.exit(0)
+
+
+def cleanup():
+    try:
+        # remove temporary maps
+        if temporary_maps:
+            gscript.run_command('g.remove', type='raster', name=temporary_maps, flags='f')
+        if temporary_vectors:
+            gscript.run_command('g.remove', type='vector', name=temporary_vectors, flags='f')
+
+    except CalledModuleError:
+        pass
+
+
+def best_time(function, *args):
+    """return the best wall time of repeated calls of a function"""
+
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        function(*args)
+        times.append(time.time()-start)
+    return min(times)
+
+
+def fill_dir_depressions(dem, depressions):
+    """identify depressions with r.fill.dir and r.mapcalc"""
+
+    depressionless_dem = parallel.temporary_name('depressionless_dem')
+    flow_dir = parallel.temporary_name('flow_dir')
+    gscript.run_command('r.fill.dir', input=dem, output=depressionless_dem, direction=flow_dir, overwrite=True, quiet=True)
+    gscript.run_command('r.mapcalc', expression='{depressions} = if({depressionless_dem} - {dem} > 0, {depressionless_dem} - {dem}, null())'.format(depressions=depressions, depressionless_dem=depressionless_dem, dem=dem), overwrite=True, quiet=True)
+    gscript.run_command('g.remove', flags='f', type='raster', name=[depressionless_dem, flow_dir], quiet=True)
+
+
+def benchmark_depressions(dem):
+    """compare the r.fill.dir path with in-process priority-flood depression filling"""
+
+    module_depressions = parallel.temporary_name('module_depressions')
+    native_depressions = parallel.temporary_name('native_depressions')
+    temporary_maps.extend([module_depressions, native_depressions])
+    array = rasters.read_array(dem)
+
+    module_time = best_time(fill_dir_depressions, dem, module_depressions)
+    native_time = best_time(priority_flood.compute_depressions, dem, native_depressions)
+    core_time = best_time(priority_flood.depression_depth, array)
+
+    # compare the depression maps
+    module_array = rasters.read_array(module_depressions)
+    native_array = rasters.read_array(native_depressions)
+    agreement = np.mean(np.isnan(module_array) == np.isnan(native_array))*100
+    both = ~np.isnan(module_array) & ~np.isnan(native_array)
+    difference = np.abs(module_array[both]-native_array[both]).max() if both.any() else 0.0
+
+    print('cells: ' + str(array.size))
+    print('r.fill.dir, r.mapcalc, g.remove: ' + str(module_time) + ' s')
+    print('priority-flood with raster i/o: ' + str(native_time) + ' s')
+    print('priority-flood without raster i/o: ' + str(core_time) + ' s')
+    print('speedup: ' + str(module_time/native_time))
+    print('percent of cells with matching depressions: ' + str(agreement))
+    print('maximum difference in depression depth: ' + str(difference))
+    return {'cells': array.size, 'module': module_time, 'native': native_time, 'core': core_time, 'agreement': agreement, 'difference': difference}
+
+
+def rst_module(dem, output):
+    """reinterpolate a DEM with r.random and v.surf.rst"""
+
+    points = parallel.temporary_name('points')
+    gscript.run_command('r.random', input=dem, npoints=reinterpolation.resolution, vector=points, flags='bd', overwrite=True, quiet=True)
+    gscript.run_command('v.surf.rst', input=points, elevation=output, tension=reinterpolation.tension, smooth=reinterpolation.smooth,
+                        npmin=reinterpolation.npmin, dmin=reinterpolation.dmin, overwrite=True, quiet=True)
+    gscript.run_command('g.remove', type='vector', name=points, flags='f', quiet=True)
+
+
+def rmse(a, b):
+    """return the root mean square error between two arrays ignoring nulls"""
+
+    valid = ~np.isnan(a) & ~np.isnan(b)
+    return float(np.sqrt(np.mean((a[valid]-b[valid])**2)))
+
+
+def benchmark_interpolation(dem):
+    """compare v.surf.rst with in-process regularized spline with tension interpolation"""
+
+    module_dem = parallel.temporary_name('module_dem')
+    native_dem = parallel.temporary_name('native_dem')
+    temporary_maps.extend([module_dem, native_dem])
+
+    module_time = best_time(rst_module, dem, module_dem)
+    native_time = best_time(rst.reinterpolate, dem, native_dem, reinterpolation.resolution, reinterpolation.tension,
+                            reinterpolation.smooth, reinterpolation.npmin, reinterpolation.dmin)
+
+    # compare both interpolations with the DEM and with each other
+    array = rasters.read_array(dem)
+    module_array = rasters.read_array(module_dem)
+    native_array = rasters.read_array(native_dem)
+
+    print('r.random, v.surf.rst, g.remove: ' + str(module_time) + ' s')
+    print('in-process regularized spline with tension: ' + str(native_time) + ' s')
+    print('speedup: ' + str(module_time/native_time))
+    print('rmse of v.surf.rst: ' + str(rmse(module_array, array)))
+    print('rmse of in-process interpolation: ' + str(rmse(native_array, array)))
+    print('rmse between interpolations: ' + str(rmse(module_array, native_array)))
+    return {'module': module_time, 'native': native_time, 'module_rmse': rmse(module_array, array),
+            'native_rmse': rmse(native_array, array), 'difference_rmse': rmse(module_array, native_array)}
+
+
+def simulate_water(dem, depth, rain_value=300, nwalkers=5000, niterations=4):
+    """simulate water flow with r.slope.aspect and r.sim.water"""
+
+    dx = parallel.temporary_name('dx')
+    dy = parallel.temporary_name('dy')
+    gscript.run_command('r.slope.aspect', elevation=dem, dx=dx, dy=dy, overwrite=True, quiet=True)
+    gscript.run_command('r.sim.water', elevation=dem, dx=dx, dy=dy, rain_value=rain_value, depth=depth, nwalkers=nwalkers, niterations=niterations, overwrite=True, quiet=True)
+    gscript.run_command('g.remove', flags='f', type='raster', name=[dx, dy], quiet=True)
+
+
+def benchmark_preview(dem, rain_value=300):
+    """compare r.sim.water with the flow accumulation preview and report its calibration"""
+
+    module_depth = parallel.temporary_name('module_depth')
+    preview_depth = parallel.temporary_name('preview_depth')
+    temporary_maps.extend([module_depth, preview_depth])
+
+    module_time = best_time(simulate_water, dem, module_depth, rain_value)
+    preview_time = best_time(flow_preview.simulate, dem, preview_depth, rain_value)
+
+    print('r.slope.aspect, r.sim.water, g.remove: ' + str(module_time) + ' s')
+    print(flow_preview.method + ' preview with raster i/o: ' + str(preview_time) + ' s')
+    print('speedup: ' + str(module_time/preview_time))
+    report = flow_preview.calibrate(dem, module_depth, rain_value)
+    report.update({'module': module_time, 'preview': preview_time})
+    return report
+
+
+def fractal_noise(rows, cols, random):
+    """return fractal noise between 0 and 1 from random phases and a power law spectrum"""
+
+    frequency = np.hypot(np.fft.fftfreq(rows)[:, np.newaxis], np.fft.rfftfreq(cols)[np.newaxis, :])
+    frequency[0, 0] = 1
+    spectrum = (random.normal(size=frequency.shape)+1j*random.normal(size=frequency.shape))/frequency**(roughness/2.0)
+    spectrum[0, 0] = 0
+    noise = np.fft.irfft2(spectrum, s=(rows, cols))
+    return (noise-noise.min())/(noise.max()-noise.min())
+
+
+def bumps(rows, cols, random, count, height, radius):
+    """return the sum of gaussian mounds or pits of random position, height up to height, and radius up to radius cells"""
+
+    y, x = np.mgrid[0:rows, 0:cols]
+    surface = np.zeros((rows, cols))
+    for i in range(count):
+        row, col = random.uniform(0, rows), random.uniform(0, cols)
+        size = random.uniform(0.3, 1.0)*radius
+        surface += random.uniform(-1, 1)*height*np.exp(-((x-col)**2+(y-row)**2)/(2*size**2))
+    return surface
+
+
+def synthetic_dem(rows, cols, random):
+    """return a synthetic sand table DEM of fractal noise tilted to drain with pits and meandering channels"""
+
+    dem = relief_range*fractal_noise(rows, cols, random)
+    dem += tilt*(1-np.arange(rows)/float(rows))[:, np.newaxis]
+
+    # dig pits
+    dem -= np.abs(bumps(rows, cols, random, pits, pit_depth, pit_radius*cols))
+
+    # carve channels meandering down the table
+    row = np.arange(rows)[:, np.newaxis]
+    col = np.arange(cols)[np.newaxis, :]
+    for i in range(channels):
+        centre = random.uniform(0.1, 0.9)*cols+random.uniform(0.02, 0.1)*cols*np.sin(2*np.pi*row/random.uniform(0.3, 1.0)/rows+random.uniform(0, 2*np.pi))
+        dem -= channel_depth*np.exp(-((col-centre)/(channel_width*cols))**2)
+    return dem
+
+
+def synthetic_series(dem, count, random):
+    """return scanned DEMs of participants sculpting mounds and pits into a DEM"""
+
+    rows, cols = dem.shape
+    return [dem+bumps(rows, cols, random, sculpting, sculpting_height, pit_radius*cols)+random.normal(0, scan_noise, dem.shape)
+            for i in range(count)]
+
+
+def relief(dem, output):
+    """compute shaded relief with r.relief"""
+
+    gscript.run_command('r.relief', input=dem, output=output, altitude=90, azimuth=45, zscale=1, units="intl", overwrite=True, quiet=True)
+
+
+def module_contours(dem, output):
+    """compute contours with r.contour"""
+
+    gscript.run_command('r.contour', input=dem, output=output, step=contour_step, overwrite=True, quiet=True)
+
+
+def native_contours(dem, output):
+    """compute contours with marching squares and write them as a vector map"""
+
+    lines, levels = contours.contour(rasters.read_array(dem), gscript.region(), contour_step)
+    contours.write_vector(lines, levels, output)
+
+
+def module_series(stack, outputs):
+    """compute the mean, maximum, and sum of a stack of rasters with r.series"""
+
+    for method, output in zip(["average", "maximum", "sum"], outputs):
+        gscript.run_command('r.series', input=stack, output=output, method=method, overwrite=True, quiet=True)
+
+
+def native_series(stack, outputs):
+    """compute the mean, maximum, and sum of a stack of rasters reading each raster once"""
+
+    series.compute_series({'depth': stack}, [('depth', method, output) for method, output in zip(["average", "maximum", "sum"], outputs)])
+
+
+def streaming_series(stack, outputs):
+    """compute the mean, maximum, and sum of a stack of rasters from scratch with streaming statistics"""
+
+    state_dir = tempfile.mkdtemp(prefix='series_')
+    try:
+        series.update_series({'depth': stack}, [('depth', method, output) for method, output in zip(["average", "maximum", "sum"], outputs)], state_dir)
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+def module_distance(concentrated_flow, reference_points, points, distance):
+    """compute the distance from reference points to concentrated flow with r.random and v.distance"""
+
+    copied_points = parallel.temporary_name('copied_points')
+    gscript.run_command('r.random', input=concentrated_flow, npoints='100%', vector=points, overwrite=True, quiet=True)
+    gscript.run_command('g.copy', vector=[reference_points, copied_points], overwrite=True, quiet=True)
+    gscript.run_command('v.db.addcolumn', map=copied_points, columns='distance INTEGER', quiet=True)
+    gscript.run_command('v.distance', from_=copied_points, to=points, upload='dist', column='distance', output=distance, overwrite=True, quiet=True)
+    statistics = gscript.parse_command('v.db.univar', map=copied_points, column='distance', flags='g', quiet=True)
+    gscript.run_command('g.remove', type='vector', name=copied_points, flags='f', quiet=True)
+    return statistics
+
+
+def native_distance(concentrated_flow, reference_xy):
+    """compute the distance from reference points to concentrated flow with a kd-tree"""
+
+    flow_points = nearest_flow.cell_coordinates(rasters.read_array(concentrated_flow))
+    distances, nearest = nearest_flow.nearest_distances(reference_xy, flow_points)
+    return nearest_flow.distance_statistics(distances)
+
+
+def render_3d(dem, color, output):
+    """render a 3D image with m.nviz.image"""
+
+    gscript.run_command('m.nviz.image', elevation_map=dem, color_map=color, output=output, quiet=True, **render_3d_images.nviz_settings)
+
+
+def benchmark_synthetic(rows, cols, count):
+    """time every analysis stage on a synthetic DEM and series of participants with GRASS modules and in-process engines"""
+
+    random = np.random.RandomState(seed)
+    prefix = parallel.temporary_name('synthetic')
+    names = dict((key, prefix+'_'+key) for key in ['dem', 'relief', 'contour', 'native_contour', 'depth', 'preview_depth',
+                                                      'module_depressions', 'native_depressions', 'concentrated_flow',
+                                                      'reference_points', 'points', 'distance'])
+    dems = [prefix+'_dem_'+str(i) for i in range(1, count+1)]
+    depths = [prefix+'_depth_'+str(i) for i in range(1, count+1)]
+    outputs = [prefix+'_'+method for method in ["mean", "max", "sum"]]
+    temporary_maps.extend([names[key] for key in ['dem', 'relief', 'depth', 'preview_depth', 'module_depressions', 'native_depressions', 'concentrated_flow']]+dems+depths+outputs)
+    temporary_vectors.extend([names[key] for key in ['contour', 'native_contour', 'reference_points', 'points', 'distance']])
+    images = tempfile.mkdtemp(prefix='benchmark_')
+
+    # generate the DEM and series in a region of the synthetic size
+    info = gscript.region()
+    gscript.run_command('g.region', n=float(info['s'])+rows*synthetic_res, s=info['s'], w=info['w'], e=float(info['w'])+cols*synthetic_res, res=synthetic_res)
+    dem = synthetic_dem(rows, cols, random)
+    rasters.write_array(dem, names['dem'])
+    gscript.run_command('r.colors', map=names['dem'], color="elevation", quiet=True)
+    for name, array in zip(dems, synthetic_series(dem, count, random)):
+        rasters.write_array(array, name)
+    print('synthetic DEM of ' + str(rows) + ' by ' + str(cols) + ' cells with ' + str(count) + ' participants')
+
+    try:
+        stages = {}
+        stages['relief'] = {'r.relief': best_time(relief, names['dem'], names['relief'])}
+        stages['contours'] = {'r.contour': best_time(module_contours, names['dem'], names['contour']),
+                              'marching-squares': best_time(native_contours, names['dem'], names['native_contour'])}
+        stages['depressions'] = {'r.fill.dir': best_time(fill_dir_depressions, names['dem'], names['module_depressions']),
+                                 'priority-flood': best_time(priority_flood.compute_depressions, names['dem'], names['native_depressions'])}
+        stages['flow'] = {'r.sim.water': best_time(simulate_water, names['dem'], names['depth']),
+                          'preview': best_time(flow_preview.simulate, names['dem'], names['preview_depth'], 300)}
+
+        # previews of the water depth of the participants for the series
+        for name, depth in zip(dems, depths):
+            flow_preview.simulate(name, depth, 300)
+        stages['series'] = {'r.series': best_time(module_series, depths, outputs),
+                            'numpy': best_time(native_series, depths, outputs),
+                            'streaming': best_time(streaming_series, depths, outputs)}
+
+        # distance from the concentrated flow of the synthetic DEM to the mean concentrated flow of the participants
+        gscript.run_command('r.mapcalc', expression='{concentrated_flow} = if({mean}>={threshold},{mean},null())'.format(concentrated_flow=names['concentrated_flow'], mean=outputs[0], threshold=threshold), overwrite=True, quiet=True)
+        reference = rasters.read_array(names['preview_depth'])
+        with np.errstate(invalid='ignore'):
+            reference_xy = nearest_flow.cell_coordinates(np.where(reference >= threshold, reference, np.nan))
+        nearest_flow.write_points(reference_xy, names['reference_points'])
+        stages['distance'] = {'v.distance': best_time(module_distance, names['concentrated_flow'], names['reference_points'], names['points'], names['distance']),
+                              'kd-tree': best_time(native_distance, names['concentrated_flow'], reference_xy)}
+
+        # render the mean depth of the participants
+        specification = rendering.spec(os.path.join(images, 'render.png'), names['relief'], outputs[0], cols, rows, overlays=[{'map': names['contour'], 'display': 'shape'}])
+        renderer = rendering.renderer
+        rendering.renderer = "grass"
+        try:
+            stages['render_2d'] = {'grass': best_time(rendering.render, specification),
+                                   'numpy': best_time(lambda: rendering.composite(specification, rendering.Layers()))}
+        finally:
+            rendering.renderer = renderer
+        stages['render_3d'] = {'m.nviz.image': best_time(render_3d, names['dem'], outputs[0], os.path.join(images, 'render_3d'))}
+    finally:
+        shutil.rmtree(images, ignore_errors=True)
+        gscript.run_command('g.region', **dict((key, info[key]) for key in ['n', 's', 'w', 'e', 'nsres', 'ewres']))
+
+    for stage, times in sorted(stages.items()):
+        print(stage + ': ' + ', '.join(engine + ' ' + str(round(seconds, 3)) + ' s' for engine, seconds in sorted(times.items())))
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'rows': rows,
+            'cols': cols,
+            'cells': rows*cols,
+            'participants': count,
+            'seed': seed,
+            'repeat': repeat,
+            'stages': stages}
+
+
+def write_results(runs, path):
+    """append benchmark runs to a JSON file of earlier runs"""
+
+    earlier = []
+    if os.path.isfile(path):
+        with open(path) as input:
+            earlier = json.load(input)
+    elif not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as output:
+        json.dump(earlier+runs, output, indent=2, sort_keys=True)
+    print('wrote ' + str(len(runs)) + ' runs to ' + path)
+
+
+if __name__ == "__main__":
+    atexit.register(cleanup)
+    sys.exit(main())
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: content-addressed cache of derived maps for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import grass.script as gscript
+from grass.exceptions import CalledModuleError
+
+# set parameters
+block_size = 1024*1024
+null_value = -9999
+key_prefix = "cache key "  # prefix of the cache key recorded in the source metadata of cached rasters
+
+
+def _bytes(text):
+    """encode module output for hashing"""
+
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+
+def raster_digest(raster, env=None):
+    """return a hash of the values of a raster in the current region"""
+
+    digest = hashlib.sha1()
+    digest.update(_bytes(gscript.read_command('g.region', flags='g', env=env)))
+    process = gscript.pipe_command('r.out.bin', input=raster, output='-', null=null_value, quiet=True, env=env)
+    while True:
+        block = process.stdout.read(block_size)
+        if not block:
+            break
+        digest.update(block)
+    returncode = process.wait()
+    if returncode:
+        raise CalledModuleError(module='r.out.bin', code='r.out.bin input={raster}'.format(raster=raster), returncode=returncode)
+    return digest.hexdigest()
+
+
+def cache_key(inputs, parameters, env=None):
+    """return a key for outputs derived from input rasters with the given module parameters"""
+
+    digest = hashlib.sha1()
+    for raster in inputs:
+        digest.update(_bytes(raster_digest(raster, env=env)))
+    digest.update(_bytes(json.dumps(parameters, sort_keys=True)))
+    return digest.hexdigest()
+
+
+def _entry_size(path):
+    """return the size of a cache entry in bytes"""
+
+    size = 0
+    for directory, subdirectories, files in os.walk(path):
+        for filename in files:
+            size += os.path.getsize(os.path.join(directory, filename))
+    return size
+
+
+def recorded_key(raster, env=None):
+    """return the cache key recorded in the metadata of a raster in the current mapset or None"""
+
+    found = gscript.find_file(raster, element='cell', mapset='.', env=env)
+    if not found['name']:
+        return None
+    info = gscript.parse_command('r.info', map=found['fullname'], flags='e', env=env)
+    source = info.get('source2', '').strip().strip('"')
+    return source[len(key_prefix):] if source.startswith(key_prefix) else None
+
+
+def load(cache_dir, key, rasters=(), vectors=(), env=None):
+    """unpack cached maps for a key into the current mapset and return whether the cache was hit
+
+    Rasters that already hold the maps of the key are kept as they are, so
+    that their modification times still match the stamps of the series.
+    """
+
+    entry = os.path.join(cache_dir, key)
+    packs = [os.path.join(entry, raster+".pack") for raster in rasters]
+    packs += [os.path.join(entry, vector+".vpack") for vector in vectors]
+    if not all(os.path.isfile(pack) for pack in packs):
+        return False
+
+    for raster in rasters:
+        if recorded_key(raster, env=env) == key:
+            continue
+        gscript.run_command('r.unpack', input=os.path.join(entry, raster+".pack"), output=raster, overwrite=True, quiet=True, env=env)
+    for vector in vectors:
+        gscript.run_command('v.unpack', input=os.path.join(entry, vector+".vpack"), output=vector, overwrite=True, quiet=True, env=env)
+
+    # mark the entry as recently used
+    try:
+        os.utime(entry, None)
+    except OSError:
+        pass
+    return True
+
+
+def store(cache_dir, key, rasters=(), vectors=(), max_size=None, env=None):
+    """pack maps from the current mapset into the cache under a key"""
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+
+    # pack into a hidden directory so that concurrent readers never see partial entries
+    staging = tempfile.mkdtemp(prefix='.'+key, dir=cache_dir)
+    try:
+        for raster in rasters:
+            gscript.run_command('r.support', map=raster, source2=key_prefix+key, env=env)
+            gscript.run_command('r.pack', input=raster, output=os.path.join(staging, raster+".pack"), overwrite=True, quiet=True, env=env)
+        for vector in vectors:
+            gscript.run_command('v.pack', input=vector, output=os.path.join(staging, vector+".vpack"), overwrite=True, quiet=True, env=env)
+        entry = os.path.join(cache_dir, key)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.rename(staging, entry)
+    except OSError:
+        # another process stored the same key first
+        pass
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    if max_size:
+        evict(cache_dir, max_size)
+
+
+def evict(cache_dir, max_size):
+    """remove least recently used entries until the cache is no larger than max_size bytes"""
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        try:
+            entries.append((os.path.getmtime(path), _entry_size(path), path))
+        except OSError:
+            continue
+
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: marching squares contours for the tangible water flow experiment
+
+Extracts contour segments from a DEM array with a vectorized marching
+squares over the squares between cell centres, like r.contour at levels
+that are multiples of the step. The segments are cached by the hash of the
+DEM and the step and only written to a GRASS vector map on demand.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+import grass.script as gscript
+import cache
+import rasters
+
+# set parameters
+cache_dir = None  # directory of cached contour segments, compute them every time if None
+
+# pairs of crossed edges of squares with two crossed edges
+edge_pairs = [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)]
+
+
+def segments(array, level):
+    """return the segments of a contour level as an array of rows of column and row coordinates col0, row0, col1, row1"""
+
+    # the corners of each square clockwise from the top left
+    with np.errstate(invalid='ignore'):
+        above = array >= level
+    a, b, c, d = above[:-1, :-1], above[:-1, 1:], above[1:, 1:], above[1:, :-1]
+    za, zb, zc, zd = array[:-1, :-1], array[:-1, 1:], array[1:, 1:], array[1:, :-1]
+    valid = ~(np.isnan(za) | np.isnan(zb) | np.isnan(zc) | np.isnan(zd))
+    rows, cols = np.indices(a.shape)
+
+    # crossed edges top, right, bottom, left and where they are crossed
+    crossed = [(a != b) & valid, (b != c) & valid, (c != d) & valid, (d != a) & valid]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        points = [(cols+(level-za)/(zb-za), rows),
+                  (cols+1, rows+(level-zb)/(zc-zb)),
+                  (cols+(level-zd)/(zc-zd), rows+1),
+                  (cols, rows+(level-za)/(zd-za))]
+    count = sum(edge.astype(np.int8) for edge in crossed)
+
+    # squares with two crossed edges have one segment
+    pairs = [(count == 2) & crossed[i] & crossed[j] for i, j in edge_pairs]
+    # saddles have two segments that separate the corners unlike the centre
+    saddle = count == 4
+    centre = (za+zb+zc+zd)/4.0 >= level
+    separate = saddle & (centre == a)
+    pairs += [separate, separate, saddle & ~separate, saddle & ~separate]
+    edges = edge_pairs+[(0, 1), (2, 3), (0, 3), (1, 2)]
+
+    result = []
+    for (i, j), mask in zip(edges, pairs):
+        if mask.any():
+            result.append(np.column_stack((points[i][0][mask], points[i][1][mask], points[j][0][mask], points[j][1][mask])))
+    if not result:
+        return np.zeros((0, 4))
+    result = np.concatenate(result)
+    # drop segments that collapse onto a corner at the level
+    return result[(result[:, 0] != result[:, 2]) | (result[:, 1] != result[:, 3])]
+
+
+def contour(array, info, step):
+    """return contour segments of an array of a region as x0, y0, x1, y1 rows and their levels"""
+
+    minimum, maximum = np.nanmin(array), np.nanmax(array)
+    levels = np.arange(np.ceil(minimum/step)*step, maximum+step/2.0, step)
+    lines = []
+    values = []
+    for level in levels:
+        level_segments = segments(array, level)
+        lines.append(level_segments)
+        values.append(np.full(len(level_segments), level))
+
+    # convert columns and rows of cell centres to coordinates
+    lines = np.concatenate(lines) if lines else np.zeros((0, 4))
+    x = float(info['w'])+(lines[:, [0, 2]]+0.5)*float(info['ewres'])
+    y = float(info['n'])-(lines[:, [1, 3]]+0.5)*float(info['nsres'])
+    return np.column_stack((x[:, 0], y[:, 0], x[:, 1], y[:, 1])), np.concatenate(values) if values else np.zeros(0)
+
+
+def cached_contours(dem, step, env=None):
+    """return the contour segments and levels of a DEM, reusing them if the DEM did not change"""
+
+    info = gscript.region(env=env)
+    if not cache_dir:
+        return contour(rasters.load_array(dem, env=env), info, step)
+    # the format is part of the key so that entries of earlier float32 caches are not reused
+    key = hashlib.sha1((cache.raster_digest(dem, env=env)+str(float(step))+'float64').encode('utf-8')).hexdigest()
+    path = os.path.join(cache_dir, key+'.npz')
+    if os.path.isfile(path):
+        stored = np.load(path)
+        return stored['segments'], stored['levels']
+
+    lines, levels = contour(rasters.load_array(dem, env=env), info, step)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+    fd, staging = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+    with os.fdopen(fd, 'wb') as output:
+        np.savez(output, segments=lines, levels=levels)
+    try:
+        os.rename(staging, path)
+    except OSError:
+        # another process cached the same contours
+        os.remove(staging)
+    return lines, levels
+
+
+def polylines(lines):
+    """join segments that share end points into polylines of coordinates"""
+
+    ends = {}
+    for index, (x0, y0, x1, y1) in enumerate(lines.tolist()):
+        ends.setdefault((x0, y0), []).append(index)
+        ends.setdefault((x1, y1), []).append(index)
+    used = np.zeros(len(lines), dtype=bool)
+    result = []
+    for start in range(len(lines)):
+        if used[start]:
+            continue
+        used[start] = True
+        x0, y0, x1, y1 = lines[start].tolist()
+        line = [(x0, y0), (x1, y1)]
+        # extend the line at both ends
+        for forward in (True, False):
+            while True:
+                point = line[-1] if forward else line[0]
+                following = [index for index in ends.get(point, []) if not used[index]]
+                if not following:
+                    break
+                used[following[0]] = True
+                x0, y0, x1, y1 = lines[following[0]].tolist()
+                point = (x1, y1) if (x0, y0) == point else (x0, y0)
+                if forward:
+                    line.append(point)
+                else:
+                    line.insert(0, point)
+        result.append(line)
+    return result
+
+
+def write_vector(lines, levels, vector, env=None):
+    """write contour segments as a vector map of lines with their levels like r.contour"""
+
+    text = []
+    for level in np.unique(levels):
+        for line in polylines(lines[levels == level]):
+            text.append('L {count} 1'.format(count=len(line)))
+            text.extend(' {x} {y}'.format(x=x, y=y) for x, y in line)
+            text.append(' 1 {cat}'.format(cat=int(round(level))))
+    gscript.write_command('v.in.ascii', input='-', output=vector, format='standard', flags='n', stdin='\n'.join(text)+'\n', overwrite=True, quiet=True, env=env)
+
+
+def rasterize(lines, info):
+    """return a mask of the cells of a region crossed by contour segments"""
+
+    rows, cols = int(info['rows']), int(info['cols'])
+    north, west = float(info['n']), float(info['w'])
+    nsres, ewres = float(info['nsres']), float(info['ewres'])
+    mask = np.zeros((rows, cols), dtype=bool)
+    if not len(lines):
+        return mask
+
+    # sample each segment at least twice per cell
+    length = np.hypot((lines[:, 2]-lines[:, 0])/ewres, (lines[:, 3]-lines[:, 1])/nsres)
+    samples = np.ceil(length*2).astype(np.intp)+1
+    segment = np.repeat(np.arange(len(lines)), samples)
+    fraction = (np.arange(samples.sum())-np.repeat(np.cumsum(samples)-samples, samples))/np.repeat(np.maximum(samples-1, 1), samples).astype(float)
+    x = lines[segment, 0]+fraction*(lines[segment, 2]-lines[segment, 0])
+    y = lines[segment, 1]+fraction*(lines[segment, 3]-lines[segment, 1])
+    row = np.clip(((north-y)/nsres).astype(np.intp), 0, rows-1)
+    col = np.clip(((x-west)/ewres).astype(np.intp), 0, cols-1)
+    mask[row, col] = True
+    return mask
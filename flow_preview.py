@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: fast preview of water flow for the tangible water flow experiment
+
+Approximates the water depth of r.sim.water from D8 or D-infinity flow
+accumulation for interactive feedback. Flow directions are computed for all
+cells at once and accumulated in topological order, one wave of cells with
+no remaining upstream cells at a time. Depth follows from the steady state
+discharge of each cell with Manning's equation.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+import grass.script as gscript
+import rasters
+
+# set parameters
+method = "d-infinity"  # route flow to the steepest neighbour with "d8" or split it between two neighbours with "d-infinity"
+mannings = 0.1  # Manning's roughness coefficient, the default of r.sim.water
+min_slope = 0.001  # slope of flats and pits
+scale = 1.0  # calibration factor of the preview depth, see calibrate
+threshold = 0.05  # depth of concentrated flow for the calibration report
+
+# row and column offsets of the cardinal and diagonal neighbours of the d-infinity facets
+facets = [((0, 1), (-1, 1)), ((-1, 0), (-1, 1)), ((-1, 0), (-1, -1)), ((0, -1), (-1, -1)),
+          ((0, -1), (1, -1)), ((1, 0), (1, -1)), ((1, 0), (1, 1)), ((0, 1), (1, 1))]
+
+
+def _neighbour(padded, offset):
+    """return the neighbours of all cells of a padded array at a row and column offset"""
+
+    rows, cols = padded.shape[0]-2, padded.shape[1]-2
+    return padded[1+offset[0]:1+offset[0]+rows, 1+offset[1]:1+offset[1]+cols]
+
+
+def _index(shape, offset):
+    """return the flat indices of the neighbours of all cells at a row and column offset"""
+
+    rows, cols = np.indices(shape)
+    return (rows+offset[0])*shape[1]+cols+offset[1]
+
+
+def d8(dem, ewres, nsres):
+    """return the receivers, weights, and slopes of steepest descent flow directions"""
+
+    padded = np.pad(dem, 1, mode='constant', constant_values=np.nan)
+    offsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+    slopes = np.array([(dem-_neighbour(padded, offset))/np.hypot(offset[0]*nsres, offset[1]*ewres) for offset in offsets])
+    slopes = np.where(np.isnan(slopes), -np.inf, slopes)
+    steepest = slopes.argmax(axis=0)
+    slope = np.take_along_axis(slopes, steepest[np.newaxis], 0)[0]
+    receivers = np.choose(steepest, [_index(dem.shape, offset) for offset in offsets])
+    weights = (slope > 0).astype(float)
+    return receivers[np.newaxis], weights[np.newaxis], np.maximum(slope, 0)
+
+
+def d_infinity(dem, ewres, nsres):
+    """return the receivers, weights, and slopes of d-infinity flow directions
+
+    Uses the triangular facets of Tarboton (1997) and splits the flow between
+    the two neighbours of the steepest facet by the angle of its slope.
+    """
+
+    padded = np.pad(dem, 1, mode='constant', constant_values=np.nan)
+    best_slope = np.full(dem.shape, -np.inf)
+    best_facet = np.zeros(dem.shape, dtype=np.intp)
+    best_angle = np.zeros(dem.shape)
+    for k, (cardinal, diagonal) in enumerate(facets):
+        d1 = nsres if cardinal[0] else ewres
+        d2 = ewres if cardinal[0] else nsres
+        e1 = _neighbour(padded, cardinal)
+        e2 = _neighbour(padded, diagonal)
+        s1 = (dem-e1)/d1
+        s2 = (e1-e2)/d2
+        with np.errstate(invalid='ignore'):
+            angle = np.arctan2(s2, s1)
+            limit = np.arctan2(d2, d1)
+            slope = np.where(angle < 0, s1, np.where(angle > limit, (dem-e2)/np.hypot(d1, d2), np.hypot(s1, s2)))
+        angle = np.clip(angle, 0, limit)/limit
+        slope = np.where(np.isnan(slope) | np.isnan(e1) | np.isnan(e2), -np.inf, slope)
+        steeper = slope > best_slope
+        best_slope[steeper] = slope[steeper]
+        best_facet[steeper] = k
+        best_angle[steeper] = angle[steeper]
+
+    # flow to the cardinal neighbour and the rest to the diagonal neighbour of the steepest facet
+    downslope = best_slope > 0
+    receivers = np.array([np.choose(best_facet, [_index(dem.shape, facet[i]) for facet in facets]) for i in (0, 1)])
+    weights = np.array([(1-best_angle)*downslope, best_angle*downslope])
+    return receivers, weights, np.maximum(best_slope, 0)
+
+
+def accumulate(receivers, weights, area):
+    """accumulate the contributing area of cells downstream in topological order
+
+    Cells without remaining upstream cells pass their area to their receivers
+    in waves so that every wave is a vectorized operation.
+    """
+
+    size = area.size
+    receivers = receivers.reshape(len(receivers), size)
+    weights = weights.reshape(len(weights), size)
+    flows = weights > 0
+    indegree = np.bincount(receivers[flows], minlength=size)
+    accumulation = area.ravel().copy()
+    frontier = np.flatnonzero(indegree == 0)
+    while frontier.size:
+        outgoing = flows[:, frontier]
+        targets = receivers[:, frontier][outgoing]
+        contributions = (accumulation[frontier]*weights[:, frontier])[outgoing]
+        targets, inverse = np.unique(targets, return_inverse=True)
+        accumulation[targets] += np.bincount(inverse, weights=contributions)
+        indegree[targets] -= np.bincount(inverse)
+        frontier = targets[indegree[targets] == 0]
+    return accumulation.reshape(area.shape)
+
+
+def preview_depth(dem, ewres, nsres, rain_value, routing=None):
+    """return the approximate water depth in meters of an elevation array with nulls as nan
+
+    rain_value is the rainfall excess rate in mm/hr like in r.sim.water and
+    routing overrides the method of routing flow
+    """
+
+    directions = d8 if (routing or method) == "d8" else d_infinity
+    receivers, weights, slope = directions(dem, ewres, nsres)
+    area = np.where(np.isnan(dem), 0, ewres*nsres)
+    accumulation = accumulate(receivers, weights, area)
+
+    # steady state depth of the discharge per unit width with Manning's equation
+    discharge = rain_value/3600000.0*accumulation/ewres
+    depth = scale*(discharge*mannings/np.sqrt(np.maximum(slope, min_slope)))**0.6
+    return np.where(np.isnan(dem), np.nan, depth)
+
+
+def simulate(elevation, depth, rain_value, colors=None, env=None):
+    """write a preview of the water depth of an elevation raster with colors copied from a raster or set by rules"""
+
+    info = gscript.region(env=env)
+    array = rasters.load_array(elevation, env=env)
+    rasters.write_array(preview_depth(array, float(info['ewres']), float(info['nsres']), rain_value), depth, env=env)
+    if colors and '\n' in colors:
+        gscript.write_command('r.colors', map=depth, rules='-', stdin=colors, env=env)
+    elif colors:
+        gscript.run_command('r.colors', map=depth, raster=colors, env=env)
+
+
+def calibrate(elevation, reference_depth, rain_value, env=None):
+    """compare the preview with the water depth simulated by r.sim.water and return the calibration
+
+    The calibration scale is the least squares factor of the preview depth;
+    set scale to it to calibrate the preview.
+    """
+
+    info = gscript.region(env=env)
+    preview = preview_depth(rasters.load_array(elevation, env=env), float(info['ewres']), float(info['nsres']), rain_value)/scale
+    reference = rasters.load_array(reference_depth, env=env)
+    valid = ~np.isnan(preview) & ~np.isnan(reference)
+    preview, reference = preview[valid], reference[valid]
+
+    fitted = float(np.dot(preview, reference)/np.dot(preview, preview)) if preview.any() else 1.0
+    concentrated = (preview*fitted >= threshold), (reference >= threshold)
+    report = {'cells': int(valid.sum()),
+              'scale': fitted,
+              'correlation': float(np.corrcoef(preview, reference)[0, 1]) if preview.std() and reference.std() else 0.0,
+              'rmse': float(np.sqrt(np.mean((preview*scale-reference)**2))),
+              'calibrated_rmse': float(np.sqrt(np.mean((preview*fitted-reference)**2))),
+              'concentrated_agreement': float(np.mean(concentrated[0] == concentrated[1])*100),
+              'concentrated_overlap': float((concentrated[0] & concentrated[1]).sum()/float(max((concentrated[0] | concentrated[1]).sum(), 1))*100)}
+
+    print('calibration of the ' + method + ' preview against ' + reference_depth)
+    for key in ('cells', 'scale', 'correlation', 'rmse', 'calibrated_rmse', 'concentrated_agreement', 'concentrated_overlap'):
+        print(key + ': ' + str(report[key]))
+    return report
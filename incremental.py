@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: incremental updates of successive scans for the tangible water flow experiment
+
+Finds where a scan changed from the previous scan and the cells whose flow
+is influenced by the change, i.e. the changed cells and the cells downstream
+of them before and after the change. The maps of the new scan only need to
+be recomputed in the bounding boxes of the influenced cells and the cells
+upstream of them and patched into the maps of the previous scan. Flow paths
+are followed for a limited number of cells since water only travels so far
+during a simulation.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import numpy as np
+from scipy import ndimage
+import grass.script as gscript
+import flow_preview
+import mapcalc
+
+# set parameters
+tolerance = 0.01  # minimum change in elevation of changed cells
+halo = 3  # number of cells added around the influenced cells and the cells that must be recomputed
+reach = 100  # number of cells followed along flow paths, about as far as water flows during the simulation
+max_fraction = 0.3  # recompute the whole region if a larger fraction of it must be recomputed
+
+
+def changed_cells(previous, current):
+    """return a mask of cells that changed between two elevation arrays with nulls as nan"""
+
+    with np.errstate(invalid='ignore'):
+        return (np.abs(current-previous) > tolerance) | (np.isnan(current) != np.isnan(previous))
+
+
+def _directions(dem, ewres, nsres):
+    """return the flat index of the receiver of each cell and a mask of cells that drain"""
+
+    receivers, weights, slope = flow_preview.d8(dem, ewres, nsres)
+    drains = weights[0].ravel() > 0
+    return np.where(drains, receivers[0].ravel(), 0), drains
+
+
+def downstream(dem, mask, ewres, nsres):
+    """return a mask of the cells of a mask and the cells up to reach cells downstream of them"""
+
+    receivers, drains = _directions(dem, ewres, nsres)
+    result = mask.ravel().copy()
+    frontier = np.flatnonzero(result)
+    for step in range(reach):
+        frontier = np.unique(receivers[frontier[drains[frontier]]])
+        frontier = frontier[~result[frontier]]
+        if not frontier.size:
+            break
+        result[frontier] = True
+    return result.reshape(mask.shape)
+
+
+def upstream(dem, mask, ewres, nsres):
+    """return a mask of the cells of a mask and the cells up to reach cells upstream of them"""
+
+    receivers, drains = _directions(dem, ewres, nsres)
+    result = mask.ravel().copy()
+    for step in range(reach):
+        grown = result | (drains & result[receivers])
+        if (grown == result).all():
+            break
+        result = grown
+    return result.reshape(mask.shape)
+
+
+def influence(previous, current, ewres, nsres):
+    """return masks of the changed cells, the influenced cells, and the cells that must be recomputed"""
+
+    changed = changed_cells(previous, current)
+    if not changed.any():
+        return changed, changed, changed
+    influenced = downstream(current, changed, ewres, nsres) | downstream(previous, changed, ewres, nsres)
+    influenced = ndimage.binary_dilation(influenced, iterations=halo)
+    recompute = ndimage.binary_dilation(upstream(current, influenced, ewres, nsres), iterations=halo)
+    return changed, influenced, recompute
+
+
+def boxes(mask):
+    """return the row and column slices of the bounding boxes of the connected regions of a mask"""
+
+    labels, count = ndimage.label(mask, structure=np.ones((3, 3)))
+    return [box for box in ndimage.find_objects(labels) if box]
+
+
+def box_environment(box, info, env=None):
+    """return an environment with the region of a bounding box of cells of a region"""
+
+    rows, cols = box
+    north = float(info['n'])
+    west = float(info['w'])
+    nsres = float(info['nsres'])
+    ewres = float(info['ewres'])
+    box_env = dict(env or os.environ)
+    box_env['GRASS_REGION'] = gscript.region_env(n=north-rows.start*nsres, s=north-rows.stop*nsres,
+                                                 w=west+cols.start*ewres, e=west+cols.stop*ewres,
+                                                 nsres=nsres, ewres=ewres, env=env)
+    return box_env
+
+
+def patch(patched, update, mask, env=None):
+    """replace the cells of a raster where a mask and an update are not null"""
+
+    patch_maps([(patched, update)], mask, env=env)
+
+
+def patch_maps(patches, mask, env=None):
+    """replace the cells of rasters where a mask and their updates are not null in one pass
+
+    patches is a list of (patched raster, update raster) pairs
+    """
+
+    batch = mapcalc.Batch(env=env)
+    for patched, update in patches:
+        batch.add(patched+'_patched', 'if(isnull({mask}) || isnull({update}), {patched}, {update})'.format(mask=mask, update=update, patched=patched),
+                  raster=patched)
+    batch.run()
+    for patched, update in patches:
+        gscript.run_command('g.rename', raster=[patched+'_patched', patched], overwrite=True, quiet=True, env=env)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: batched map algebra for the tangible water flow experiment
+
+Collects the map algebra expressions of a stage and evaluates them with one
+r.mapcalc call. r.mapcalc computes all the expressions of a file row by row
+in the same pass, so every input is read once however many expressions share
+it and the module is only started once. Expressions that read the output of
+another expression of the batch are evaluated in a later pass.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import re
+import grass.script as gscript
+
+# names of maps and functions in expressions
+name_pattern = re.compile(r'[A-Za-z_][\w.]*(?:@[\w.]+)?')
+
+
+def inputs(expression):
+    """return the names in an expression that may be maps"""
+
+    # drop quoted strings and function names
+    expression = re.sub(r'"[^"]*"|\'[^\']*\'', '', expression)
+    return set(match.group(0) for match in name_pattern.finditer(expression)
+               if not expression[match.end():].lstrip().startswith('('))
+
+
+class Batch(object):
+    """map algebra expressions that are evaluated together by r.mapcalc"""
+
+    def __init__(self, env=None):
+        self.env = env
+        self.expressions = []
+        self.colors = []
+        self.temporary = []
+
+    def add(self, output, expression, **colors):
+        """add an expression for an output map with optional r.colors parameters, e.g. color or rules"""
+
+        self.expressions.append((output, expression))
+        if colors:
+            self.colors.append((output, colors))
+
+    def remove(self, *maps):
+        """remove raster maps after the batch has been evaluated"""
+
+        self.temporary.extend(maps)
+
+    def passes(self):
+        """return the expressions in passes so that no pass reads the output of an expression in the same pass"""
+
+        levels = {}
+        passes = []
+        for output, expression in self.expressions:
+            level = max([levels[name]+1 for name in inputs(expression) if name in levels] or [0])
+            levels[output] = level
+            if level == len(passes):
+                passes.append([])
+            passes[level].append((output, expression))
+        return passes
+
+    def run(self):
+        """evaluate the expressions, set the colors of their outputs, and empty the batch"""
+
+        for expressions in self.passes():
+            text = '\n'.join('{output} = {expression}'.format(output=output, expression=expression) for output, expression in expressions)
+            gscript.write_command('r.mapcalc', file='-', stdin=text+'\n', overwrite=True, quiet=True, env=self.env)
+        for output, colors in self.colors:
+            if 'rules' in colors:
+                gscript.write_command('r.colors', map=output, rules='-', stdin=colors['rules'], quiet=True, env=self.env)
+            else:
+                gscript.run_command('r.colors', map=output, quiet=True, env=self.env, **colors)
+        if self.temporary:
+            gscript.run_command('g.remove', flags='f', type='raster', name=self.temporary, quiet=True, env=self.env)
+        self.expressions, self.colors, self.temporary = [], [], []
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: distance between concentrated flow for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+import grass.script as gscript
+
+# set parameters
+percentiles = (25, 50, 75, 90)
+
+
+def cell_coordinates(array, env=None):
+    """return the coordinates of the centers of non-null cells in an array of the current region"""
+
+    region = gscript.region(env=env)
+    rows, cols = np.nonzero(~np.isnan(array))
+    x = float(region['w'])+(cols+0.5)*float(region['ewres'])
+    y = float(region['n'])-(rows+0.5)*float(region['nsres'])
+    return np.column_stack((x, y))
+
+
+def read_points(vector, env=None):
+    """return the coordinates of the points in a vector map"""
+
+    output = gscript.read_command('v.out.ascii', input=vector, format='point', separator='comma', quiet=True, env=env)
+    points = [line.split(',')[:2] for line in output.splitlines() if line.strip()]
+    return np.array(points, dtype=np.float64).reshape(-1, 2)
+
+
+def nearest_distances(from_points, to_points):
+    """return the distance from each point to the nearest of another set of points and the index of that point"""
+
+    if not len(to_points):
+        return np.full(len(from_points), np.nan), np.zeros(len(from_points), dtype=int)
+    return cKDTree(to_points).query(from_points, k=1)
+
+
+def distance_statistics(distances):
+    """return the count, sum, mean, minimum, maximum, and percentiles of distances"""
+
+    distances = distances[~np.isnan(distances)]
+    statistics = {'n': len(distances)}
+    if not len(distances):
+        statistics.update((key, np.nan) for key in ('sum', 'mean', 'min', 'max'))
+        statistics.update(('percentile_'+str(p), np.nan) for p in percentiles)
+        return statistics
+    statistics['sum'] = float(distances.sum())
+    statistics['mean'] = float(distances.mean())
+    statistics['min'] = float(distances.min())
+    statistics['max'] = float(distances.max())
+    for p, value in zip(percentiles, np.percentile(distances, percentiles)):
+        statistics['percentile_'+str(p)] = float(value)
+    return statistics
+
+
+def write_points(points, vector, env=None):
+    """write coordinates as a vector map of points"""
+
+    text = '\n'.join('{x}|{y}'.format(x=x, y=y) for x, y in points)
+    gscript.write_command('v.in.ascii', input='-', output=vector, format='point', separator='pipe', stdin=text, overwrite=True, quiet=True, env=env)
+
+
+def write_lines(from_points, to_points, vector, env=None):
+    """write lines connecting pairs of coordinates as a vector map"""
+
+    lines = []
+    for cat, (start, end) in enumerate(zip(from_points, to_points), 1):
+        lines.append('L 2 1')
+        lines.append(' {x} {y}'.format(x=start[0], y=start[1]))
+        lines.append(' {x} {y}'.format(x=end[0], y=end[1]))
+        lines.append(' 1 {cat}'.format(cat=cat))
+    gscript.write_command('v.in.ascii', input='-', output=vector, format='standard', flags='n', stdin='\n'.join(lines)+'\n', overwrite=True, quiet=True, env=env)
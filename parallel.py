@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: parallel execution in temporary mapsets for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import shutil
+import tempfile
+import uuid
+import multiprocessing
+import grass.script as gscript
+import tracing
+
+
+def temporary_name(prefix):
+    """return a map name that will not collide with other processes"""
+
+    return "{prefix}_{pid}_{uid}".format(prefix=prefix, pid=os.getpid(), uid=uuid.uuid4().hex[:8])
+
+
+def create_mapset(prefix="tmp"):
+    """create an empty mapset in the current location and return its name"""
+
+    env = gscript.gisenv()
+    location_path = os.path.join(env['GISDBASE'], env['LOCATION_NAME'])
+    mapset = temporary_name(prefix)
+    mapset_path = os.path.join(location_path, mapset)
+    os.mkdir(mapset_path)
+    shutil.copy(os.path.join(location_path, 'PERMANENT', 'DEFAULT_WIND'), os.path.join(mapset_path, 'WIND'))
+    return mapset
+
+
+def remove_mapset(mapset):
+    """delete a temporary mapset and everything in it"""
+
+    env = gscript.gisenv()
+    if mapset in ('PERMANENT', env['MAPSET']):
+        raise ValueError("refusing to remove mapset {mapset}".format(mapset=mapset))
+    shutil.rmtree(os.path.join(env['GISDBASE'], env['LOCATION_NAME'], mapset), ignore_errors=True)
+
+
+def mapset_environment(mapset, search_path=None):
+    """return a copy of the process environment that runs modules in the given mapset"""
+
+    gisenv = gscript.gisenv()
+    fd, gisrc = tempfile.mkstemp(prefix='gisrc_')
+    with os.fdopen(fd, 'w') as rc:
+        rc.write("GISDBASE: {gisdbase}\n".format(gisdbase=gisenv['GISDBASE']))
+        rc.write("LOCATION_NAME: {location}\n".format(location=gisenv['LOCATION_NAME']))
+        rc.write("MAPSET: {mapset}\n".format(mapset=mapset))
+        rc.write("GUI: text\n")
+
+    env = os.environ.copy()
+    env['GISRC'] = gisrc
+    env['GRASS_OVERWRITE'] = '1'
+
+    # the parent's temporary region lives in the parent's mapset
+    env.pop('WIND_OVERRIDE', None)
+    env.pop('GRASS_REGION', None)
+
+    if search_path:
+        gscript.run_command('g.mapsets', mapset=search_path, operation='add', env=env)
+    return env
+
+
+def release_environment(env):
+    """remove the private gisrc file of an environment"""
+
+    try:
+        os.remove(env['GISRC'])
+    except OSError:
+        pass
+
+
+def merge_mapset(mapset, rasters=(), vectors=(), env=None):
+    """copy maps from a temporary mapset into the current mapset and remove the temporary mapset"""
+
+    try:
+        for raster in rasters:
+            gscript.run_command('g.copy', raster=[raster+'@'+mapset, raster], overwrite=True, env=env)
+        for vector in vectors:
+            gscript.run_command('g.copy', vector=[vector+'@'+mapset, vector], overwrite=True, env=env)
+    finally:
+        remove_mapset(mapset)
+
+
+def run_in_pool(function, items, nprocs=None):
+    """map a picklable function over items with a pool of worker processes"""
+
+    if not nprocs:
+        nprocs = multiprocessing.cpu_count()
+    nprocs = min(nprocs, len(items)) or 1
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        if tracing.trace_dir:
+            # report progress as the results come in
+            progress = tracing.Progress(len(items), function.__name__)
+            results = []
+            for result in pool.imap(function, items):
+                results.append(result)
+                progress.step()
+        else:
+            results = pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def run_in_mapset(function, item, region, res=3, search_path=None, prefix="tmp"):
+    """run function(item, env) in a new temporary mapset with its own region and return (mapset, result)
+
+    region is the name of a raster or a dictionary of g.region parameters
+    """
+
+    mapset = create_mapset(prefix)
+    env = mapset_environment(mapset, search_path)
+    try:
+        if isinstance(region, dict):
+            gscript.run_command('g.region', env=env, **region)
+        else:
+            gscript.run_command('g.region', raster=region, res=res, env=env)
+        result = function(item, env)
+    except Exception:
+        remove_mapset(mapset)
+        raise
+    finally:
+        release_environment(env)
+    return mapset, result
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: incremental pipeline for the tangible water flow experiment
+
+Declares every map and image of the experiment as the output of a node
+with its inputs and parameters and rebuilds only stale nodes, running
+independent nodes concurrently. Run it in the 'analysis' mapset; the
+reference maps are built in PERMANENT.
+
+Usage: python pipeline.py [--dry-run] [node ...]
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import sys
+import json
+import hashlib
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+import grass.script as gscript
+import parallel
+
+# set parameters
+nprocs = None  # number of nodes built at the same time, defaults to the number of cores
+scripts = os.path.dirname(os.path.abspath(__file__))
+
+
+def node(name, action, inputs=(), outputs=(), parameters=None):
+    """return a pipeline node
+
+    inputs and outputs are resources named 'raster:name@mapset',
+    'vector:name@mapset', or 'file:path' and action is a callable without
+    arguments that builds the outputs
+    """
+
+    return {'name': name,
+            'action': action,
+            'inputs': list(inputs),
+            'outputs': list(outputs),
+            'parameters': parameters or {}}
+
+
+def raster(name, mapset=None):
+    """return the resource name of a raster"""
+
+    return 'raster:'+(name+'@'+mapset if mapset and '@' not in name else name)
+
+
+def vector(name, mapset=None):
+    """return the resource name of a vector"""
+
+    return 'vector:'+(name+'@'+mapset if mapset and '@' not in name else name)
+
+
+def image(path):
+    """return the resource name of a file"""
+
+    return 'file:'+os.path.abspath(path)
+
+
+def stamp(resource):
+    """return the modification time of a resource or None if it does not exist"""
+
+    kind, name = resource.split(':', 1)
+    if kind == 'file':
+        path = name
+    else:
+        element = 'cell' if kind == 'raster' else 'vector'
+        mapname, mapset = name.split('@') if '@' in name else (name, '')
+        path = gscript.find_file(mapname, element=element, mapset=mapset)['file']
+        if path and kind == 'vector':
+            path = os.path.join(path, 'coor')
+    if not path or not os.path.exists(path):
+        return None
+    return os.path.getmtime(path)
+
+
+def parameter_hash(parameters):
+    """return a hash of node parameters"""
+
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def state_file():
+    """return the path of the file that records the parameters of built nodes"""
+
+    env = gscript.gisenv()
+    return os.path.join(env['GISDBASE'], env['LOCATION_NAME'], env['MAPSET'], 'pipeline.json')
+
+
+def load_state():
+    """load the parameters of built nodes"""
+
+    path = state_file()
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as state:
+        return json.load(state)
+
+
+def save_state(state):
+    """save the parameters of built nodes"""
+
+    with open(state_file(), 'w') as output:
+        json.dump(state, output, indent=1, sort_keys=True)
+
+
+def is_stale(item, state):
+    """check whether a node is missing outputs, has changed parameters, or has inputs newer than its outputs"""
+
+    if state.get(item['name']) != parameter_hash(item['parameters']):
+        return True
+    outputs = [stamp(resource) for resource in item['outputs']]
+    if not outputs or None in outputs:
+        return True
+    inputs = [t for t in (stamp(resource) for resource in item['inputs']) if t is not None]
+    return bool(inputs) and max(inputs) > min(outputs)
+
+
+def dependencies(nodes):
+    """return the names of the nodes that produce the inputs of each node"""
+
+    producers = {}
+    for item in nodes:
+        for resource in item['outputs']:
+            producers[resource] = item['name']
+    return dict((item['name'], set(producers[resource] for resource in item['inputs'] if resource in producers) - set([item['name']]))
+                for item in nodes)
+
+
+def select(nodes, targets):
+    """return the nodes needed to build the target nodes"""
+
+    if not targets:
+        return nodes
+    upstream = dependencies(nodes)
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(upstream[name])
+    return [item for item in nodes if item['name'] in needed]
+
+
+def build(nodes, dry_run=False):
+    """build stale nodes in dependency order, running independent nodes concurrently, and return the names of the built nodes"""
+
+    upstream = dependencies(nodes)
+    by_name = dict((item['name'], item) for item in nodes)
+    state = load_state()
+    done = set()
+    rebuilt = set()
+    running = set()
+    failures = []
+    lock = threading.Condition()
+    pool = ThreadPool(nprocs or None)
+
+    def finish(name, error=None):
+        with lock:
+            running.discard(name)
+            done.add(name)
+            if error:
+                failures.append((name, error))
+            else:
+                state[name] = parameter_hash(by_name[name]['parameters'])
+            lock.notify_all()
+
+    def run(name):
+        try:
+            by_name[name]['action']()
+        except Exception as error:
+            finish(name, error)
+        else:
+            finish(name)
+
+    try:
+        with lock:
+            while len(done) < len(nodes) and not failures:
+                ready = [name for name in by_name if name not in done and name not in running and upstream[name] <= done]
+                if not ready:
+                    if not running:
+                        raise RuntimeError("dependency cycle between nodes")
+                    lock.wait()
+                    continue
+                for name in ready:
+                    item = by_name[name]
+                    if not (upstream[name] & rebuilt) and not is_stale(item, state):
+                        done.add(name)
+                        continue
+                    rebuilt.add(name)
+                    print('building ' + name)
+                    if dry_run:
+                        done.add(name)
+                        continue
+                    running.add(name)
+                    pool.apply_async(run, (name,))
+            while running:
+                lock.wait()
+    finally:
+        pool.close()
+        pool.join()
+        if not dry_run:
+            save_state(state)
+
+    if failures:
+        name, error = failures[0]
+        raise RuntimeError("node {name} failed: {error}".format(name=name, error=error))
+    return sorted(rebuilt)
+
+
+def script_action(script, mapset=None, function='main'):
+    """return an action that runs a function of a script in a separate process, optionally in another mapset"""
+
+    def action():
+        env = parallel.mapset_environment(mapset) if mapset else None
+        code = "import sys; sys.path.insert(0, {path!r}); import {module}; {module}.{function}()".format(
+            path=scripts, module=os.path.splitext(script)[0], function=function)
+        try:
+            subprocess.check_call([sys.executable, '-c', code], env=env)
+        finally:
+            if env:
+                parallel.release_environment(env)
+    return action
+
+
+def experiment_nodes():
+    """declare the nodes of the tangible water flow experiment"""
+
+    import analysis
+    import reinterpolation
+    import render_3d_images
+
+    nodes = []
+    mapset = gscript.gisenv()['MAPSET']
+
+    # reference maps
+    reference_rasters = ['relief', 'slope', 'depth', 'depressions', 'diff', 'concentrated_flow']
+    reference_vectors = ['contour', 'concentrated_points']
+    nodes.append(node('reference', script_action('reference.py', 'PERMANENT', 'analyze_reference'),
+                      inputs=[raster('dem', 'PERMANENT'), image(os.path.join(scripts, 'reference.py'))],
+                      outputs=[raster(name, 'PERMANENT') for name in reference_rasters]+[vector(name, 'PERMANENT') for name in reference_vectors]))
+
+    # reinterpolated DEMs
+    dems = []
+    for pattern, source in sorted(reinterpolation.experiment_mapsets.items()):
+        for dem in gscript.list_grouped('rast', pattern=pattern).get(source, []):
+            dems.append(dem)
+            nodes.append(node('reinterpolate:'+dem, lambda dem=dem, source=source: reinterpolation.reinterpolate(dem, source),
+                              inputs=[raster(dem, source), raster('dem', 'PERMANENT')],
+                              outputs=[raster(dem, mapset)],
+                              parameters={'tension': reinterpolation.tension, 'smooth': reinterpolation.smooth, 'npmin': reinterpolation.npmin,
+                                          'dmin': reinterpolation.dmin, 'resolution': reinterpolation.resolution}))
+
+    # maps and images derived from each scanned DEM
+    for dem in sorted(set(dems) | set(gscript.list_grouped('rast', pattern='*dem*').get(mapset, []))):
+        model_rasters, model_vectors = analysis.model_maps(dem)
+        model_maps = [raster(name, mapset) for name in model_rasters]+[vector(name, mapset) for name in model_vectors]
+        nodes.append(node('model:'+dem, lambda dem=dem: analysis.analyze_model(dem),
+                          inputs=[raster(dem, mapset), raster('depth', 'PERMANENT')],
+                          outputs=model_maps,
+                          parameters=analysis.model_parameters()))
+        for specification in analysis.model_renders(dem):
+            nodes.append(node('render:'+os.path.basename(specification['output']), lambda specification=specification: analysis.rendering.render(specification),
+                              inputs=model_maps,
+                              outputs=[image(specification['output'])],
+                              parameters=specification))
+
+    # series statistics, concentrated flow, and plots
+    series_inputs = [resource for item in nodes if item['name'].startswith('model:') for resource in item['outputs']]
+    series_outputs = []
+    for i in range(1, analysis.iterator):
+        for name in ('mean_depth', 'max_depth', 'sum_depth', 'mean_diff', 'mean_depressions', 'max_depressions', 'sum_depressions', 'concentrated_flow'):
+            series_outputs.append(raster(name+'_'+str(i), mapset))
+    series_outputs += [image(os.path.join(analysis.series, 'depression_cells.png')), image(os.path.join(analysis.series, 'distance.png'))]
+
+    def analyze_series():
+        cells, distance = analysis.analyze_series()
+        if analysis.render_maps:
+            analysis.rendering.render_queue(analysis.nprocs)
+        else:
+            analysis.rendering.clear_queue()
+        analysis.plot_series(cells, distance)
+
+    nodes.append(node('series', analyze_series,
+                      inputs=series_inputs+[raster(name, 'PERMANENT') for name in ('depressions', 'relief')]+[vector(name, 'PERMANENT') for name in ('contour', 'concentrated_points')],
+                      outputs=series_outputs,
+                      parameters={'series_engine': analysis.series_engine, 'distance_method': analysis.distance_method,
+                                  'threshold': analysis.threshold, 'rain_value': analysis.rain_value, 'nwalkers': analysis.nwalkers,
+                                  'depth_colors': analysis.depth_colors, 'depressions_colors': analysis.depressions_colors,
+                                  'render_maps': analysis.render_maps, 'width': analysis.width, 'height': analysis.height}))
+
+    # 3D renders
+    for item in render_3d_images.jobs:
+        inputs = [raster(name, 'PERMANENT' if name in reference_rasters+['dem'] else mapset) for name in (item['elevation'], item['color'])]
+        inputs += [vector(name, mapset) for name in (item['vpoint'], item['vline']) if name]
+
+        def render_3d(item=item):
+            if item['colors']:
+                gscript.write_command('r.colors', map=item['color'], rules='-', stdin=item['colors'])
+            render_3d_images.render_job(item)
+
+        nodes.append(node('render_3d:'+item['output'], render_3d,
+                          inputs=inputs,
+                          outputs=[image(render_3d_images.output_file(item))],
+                          parameters={'job': item, 'nviz': render_3d_images.nviz_settings, 'vector': render_3d_images.vector_settings}))
+
+    return nodes
+
+
+def main():
+    arguments = sys.argv[1:]
+    dry_run = '--dry-run' in arguments
+    targets = [argument for argument in arguments if not argument.startswith('--')]
+    nodes = select(experiment_nodes(), targets)
+    built = build(nodes, dry_run=dry_run)
+    print('built ' + str(len(built)) + ' of ' + str(len(nodes)) + ' nodes')
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
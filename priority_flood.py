@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: priority-flood depression filling for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import heapq
+from collections import deque
+import numpy as np
+import rasters
+
+
+def _seeds(closed):
+    """return a mask of open cells next to closed cells"""
+
+    near_closed = np.zeros(closed.shape, dtype=bool)
+    near_closed[1:, :] |= closed[:-1, :]
+    near_closed[:-1, :] |= closed[1:, :]
+    near_closed[:, 1:] |= closed[:, :-1]
+    near_closed[:, :-1] |= closed[:, 1:]
+    near_closed[1:, 1:] |= closed[:-1, :-1]
+    near_closed[1:, :-1] |= closed[:-1, 1:]
+    near_closed[:-1, 1:] |= closed[1:, :-1]
+    near_closed[:-1, :-1] |= closed[1:, 1:]
+    return near_closed & ~closed
+
+
+def fill(dem, epsilon=0.0):
+    """fill depressions in an elevation array with nulls as nan
+
+    Uses the priority-flood algorithm of Barnes et al. (2014). Without epsilon
+    depressions are filled flat and cells inside them are processed through a
+    plain queue instead of the heap; with epsilon filled cells are raised by
+    epsilon above their spill neighbour so that every cell drains.
+    """
+
+    rows, cols = dem.shape
+    width = cols+2
+    padded = np.full((rows+2, width), np.nan)
+    padded[1:-1, 1:-1] = dem
+    closed = np.isnan(padded)
+    seeds = np.flatnonzero(_seeds(closed))
+
+    # use python lists for fast scalar access
+    elevation = padded.ravel().tolist()
+    closed = closed.ravel().tolist()
+    offsets = (-width-1, -width, -width+1, -1, 1, width-1, width, width+1)
+
+    heap = [(elevation[cell], cell) for cell in seeds]
+    heapq.heapify(heap)
+    for cell in seeds:
+        closed[cell] = True
+
+    pit = deque()
+    while heap or pit:
+        if pit:
+            cell = pit.popleft()
+            cell_elevation = elevation[cell]
+        else:
+            cell_elevation, cell = heapq.heappop(heap)
+        for offset in offsets:
+            neighbour = cell+offset
+            if closed[neighbour]:
+                continue
+            closed[neighbour] = True
+            if epsilon:
+                if elevation[neighbour] <= cell_elevation+epsilon:
+                    elevation[neighbour] = cell_elevation+epsilon
+                heapq.heappush(heap, (elevation[neighbour], neighbour))
+            elif elevation[neighbour] <= cell_elevation:
+                elevation[neighbour] = cell_elevation
+                pit.append(neighbour)
+            else:
+                heapq.heappush(heap, (elevation[neighbour], neighbour))
+
+    return np.array(elevation).reshape(rows+2, width)[1:-1, 1:-1]
+
+
+def depression_depth(dem, epsilon=0.0, depth=0):
+    """return the depth of depressions in an elevation array with cells outside depressions as nan"""
+
+    difference = fill(dem, epsilon)-dem
+    with np.errstate(invalid='ignore'):
+        return np.where(difference > depth, difference, np.nan)
+
+
+def compute_depressions(dem, depressions, epsilon=0.0, depth=0, env=None):
+    """write the depth of depressions in a DEM to a raster"""
+
+    rasters.write_array(depression_depth(rasters.load_array(dem, env=env), epsilon, depth), depressions, env=env)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: coarse to fine analysis for the tangible water flow experiment
+
+Screens a scanned DEM at a coarse resolution and selects the areas with
+concentrated flow, depressions, or water flow that differs from the
+reference, so that only these areas are computed at full resolution.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import numpy as np
+from scipy import ndimage
+import grass.script as gscript
+
+# set parameters
+factor = 4  # coarse resolution as a multiple of the resolution
+halo = 2  # number of coarse cells added around the refined areas
+depth_threshold = 0.05  # minimum depth of concentrated flow
+difference_threshold = 0.05  # minimum difference in depth from the reference
+
+
+def coarse_environment(info, env=None):
+    """return an environment with the extent of a region at the coarse resolution"""
+
+    coarse_env = dict(env or os.environ)
+    coarse_env['GRASS_REGION'] = gscript.region_env(n=info['n'], s=info['s'], e=info['e'], w=info['w'],
+                                                    nsres=float(info['nsres'])*factor, ewres=float(info['ewres'])*factor, env=env)
+    return coarse_env
+
+
+def refine_mask(depth, depressions, reference_depth):
+    """return a mask of coarse cells with concentrated flow, depressions, or differences in depth from the reference"""
+
+    with np.errstate(invalid='ignore'):
+        refined = ((depth >= depth_threshold) | ~np.isnan(depressions) |
+                   (np.abs(np.nan_to_num(depth)-np.nan_to_num(reference_depth)) > difference_threshold))
+    return ndimage.binary_dilation(refined, iterations=halo)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: raster and array conversion for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import grass.script as gscript
+
+# set parameters
+null_value = -1.0e300
+store_dir = None  # directory of the shared store of memory mapped arrays, read rasters directly if None
+store_size = 4*1024**3  # maximum size of the store in bytes, least recently used entries are removed beyond it
+
+
+def _temporary_file():
+    """return the path of a new temporary file"""
+
+    fd, path = tempfile.mkstemp(suffix='.bin')
+    os.close(fd)
+    return path
+
+
+def read_array(raster, env=None):
+    """read a raster in the current region into a float array with nulls as nan"""
+
+    region = gscript.region(env=env)
+    path = _temporary_file()
+    try:
+        gscript.run_command('r.out.bin', flags='f', input=raster, output=path, bytes=8, null=null_value, quiet=True, env=env)
+        array = np.fromfile(path, dtype=np.float64).reshape(int(region['rows']), int(region['cols']))
+    finally:
+        os.remove(path)
+    array[array == null_value] = np.nan
+    return array
+
+
+def write_array(array, raster, env=None):
+    """write a float array with nulls as nan to a raster in the current region"""
+
+    region = gscript.region(env=env)
+    path = _temporary_file()
+    try:
+        np.where(np.isnan(array), null_value, array).astype(np.float64).tofile(path)
+        gscript.run_command('r.in.bin', flags='d', input=path, output=raster, bytes=8, anull=null_value,
+                            north=region['n'], south=region['s'], east=region['e'], west=region['w'],
+                            rows=int(region['rows']), cols=int(region['cols']), overwrite=True, quiet=True, env=env)
+    finally:
+        os.remove(path)
+
+
+def _store_entry(raster, region, env=None):
+    """return the path and metadata of the store entry of a raster in a region or None if it does not exist"""
+
+    name, mapset = raster.split('@') if '@' in raster else (raster, '')
+    found = gscript.find_file(name, element='cell', mapset=mapset, env=env)
+    if not found['file']:
+        return None, None
+    extent = dict((key, region[key]) for key in ('n', 's', 'e', 'w', 'rows', 'cols'))
+    metadata = {'raster': found['fullname'], 'stamp': os.path.getmtime(found['file']), 'region': extent}
+    key = hashlib.sha1(json.dumps([metadata['raster'], extent], sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(store_dir, key), metadata
+
+
+def load_array(raster, env=None):
+    """return a read-only array of a raster in the current region with nulls as nan
+
+    The array is exported once to a .npy file in the shared store with the
+    region and the timestamp of the raster and then memory mapped, so that
+    processes reading the same raster share one copy in the page cache. The
+    entry is exported again when the raster changes.
+    """
+
+    if not store_dir:
+        return read_array(raster, env=env)
+    region = gscript.region(env=env)
+    entry, metadata = _store_entry(raster, region, env=env)
+    if not entry:
+        return read_array(raster, env=env)
+
+    # reuse the entry if the raster did not change since it was exported
+    if os.path.isfile(entry+'.npy') and os.path.isfile(entry+'.json'):
+        try:
+            with open(entry+'.json') as stored:
+                current = json.load(stored) == metadata
+            if current:
+                # mark the entry as recently used
+                os.utime(entry+'.json', None)
+                return np.load(entry+'.npy', mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            # the entry was evicted or replaced while it was read
+            pass
+
+    # export the raster and move it into place so that readers never see a partial file
+    if not os.path.isdir(store_dir):
+        try:
+            os.makedirs(store_dir)
+        except OSError:
+            pass
+    fd, path = tempfile.mkstemp(suffix='.npy', dir=store_dir)
+    with os.fdopen(fd, 'wb') as output:
+        np.save(output, read_array(raster, env=env))
+    _replace(path, entry+'.npy')
+    fd, path = tempfile.mkstemp(suffix='.json', dir=store_dir)
+    with os.fdopen(fd, 'w') as output:
+        json.dump(metadata, output, sort_keys=True)
+    _replace(path, entry+'.json')
+    array = np.load(entry+'.npy', mmap_mode='r')
+    if store_size:
+        evict_store(store_size)
+    return array
+
+
+def _replace(path, destination):
+    """move a file into place so that readers never see a partial file"""
+
+    try:
+        os.rename(path, destination)
+    except OSError:
+        # windows does not replace existing files
+        os.remove(destination)
+        os.rename(path, destination)
+
+
+def evict_store(max_size):
+    """remove least recently used entries until the store is no larger than max_size bytes"""
+
+    entries = []
+    for name in os.listdir(store_dir):
+        if not name.endswith('.json') or name.startswith('tmp'):
+            continue
+        entry = os.path.join(store_dir, name[:-len('.json')])
+        try:
+            entries.append((os.path.getmtime(entry+'.json'), os.path.getsize(entry+'.npy'), entry))
+        except OSError:
+            continue
+
+    total = sum(size for mtime, size, entry in entries)
+    for mtime, size, entry in sorted(entries):
+        if total <= max_size:
+            break
+        for path in (entry+'.json', entry+'.npy'):
+            try:
+                os.remove(path)
+            except OSError:
+                # still memory mapped on windows
+                pass
+        total -= size
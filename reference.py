@@ -14,9 +14,18 @@ import sys
 import atexit
 import grass.script as gscript
 from grass.exceptions import CalledModuleError
-
-# set graphics driver
-driver = "cairo"
+import cache
+import priority_flood
+import rendering
+import rasters as array_store
+import simwe
+import flow_preview
+import mapcalc
+import univar
+
+# set rendering
+render_maps = True  # render images, disable with --no-render for analysis only runs
+nprocs = 1  # number of workers for rendering in parallel
 
 def main():
     analyze_reference()
@@ -51,6 +60,20 @@ def analyze_reference():
 
     # set paramters
     overwrite = True
+    rain_value = 300
+    nwalkers = 5000
+    niterations = 4
+    contour_step = 5
+    water_method = "r.sim.water"  # simulate water flow in one run with "r.sim.water", with batches of walkers until convergence with "ensemble", or approximate it from flow accumulation with "preview"
+    threshold = 0.05
+    depression_method = "r.fill.dir"  # fill depressions with "r.fill.dir" or in process with "priority-flood", which only partly agrees with r.fill.dir
+    epsilon = 0
+
+    # set cache
+    use_cache = True  # reuse derived maps if the DEM and parameters are unchanged
+    cache_dir = os.path.join(grassdata, os.path.normpath("cache/reference/"))
+    cache_size = 1024**3  # maximum size of the cache in bytes
+    array_store.store_dir = os.path.join(grassdata, os.path.normpath("cache/arrays/"))  # share memory mapped arrays of rasters between stages and processes, disable with None
 
     # set DEM
     dem = "dem"
@@ -67,77 +90,93 @@ def analyze_reference():
     depressions=dem.replace("dem","depressions")
     concentrated_flow='concentrated_flow'
     concentrated_points='concentrated_points'
+    rasters = [relief, slope, depth, depressions, difference, concentrated_flow]
+    vectors = [contour, concentrated_points]
+    parameters = {'relief': {'altitude': 90, 'azimuth': 45, 'zscale': 1, 'units': "intl"},
+                  'contour': {'step': contour_step},
+                  'slope': {'size': 9},
+                  'water': {'rain_value': rain_value, 'nwalkers': nwalkers, 'niterations': niterations},
+                  'depressions': {'depth': 0, 'method': depression_method, 'epsilon': epsilon},
+                  'concentrated_flow': {'threshold': threshold}}
+    if water_method == "preview":
+        parameters['water'] = {'rain_value': rain_value, 'method': water_method, 'routing': flow_preview.method,
+                               'mannings': flow_preview.mannings, 'min_slope': flow_preview.min_slope, 'scale': flow_preview.scale}
+    elif water_method == "ensemble":
+        parameters['water'] = {'rain_value': rain_value, 'niterations': niterations, 'method': water_method,
+                               'batch_walkers': simwe.batch_walkers, 'min_batches': simwe.min_batches, 'max_batches': simwe.max_batches,
+                               'tolerance': simwe.tolerance, 'min_depth': simwe.min_depth, 'coverage': simwe.coverage}
+        rasters.append('depth_stderr')
 
     # set region
     gscript.run_command('g.region', rast=region, res=3)
 
-    # render DEM
+    # driver settings
     info = gscript.parse_command('r.info', map=dem, flags='g')
     width=int(info.cols)+int(info.cols)/2
     height=int(info.rows)
-    gscript.run_command('d.mon', start=driver, width=width, height=height,  output=os.path.join(render,dem+".png"), overwrite=overwrite)
+
+    # reuse cached maps if neither the DEM nor the parameters changed
     gscript.run_command('r.colors', map=dem, color="elevation")
     gscript.run_command('g.region', rast="dem")
-    gscript.run_command('r.relief', input=dem, output=relief, altitude=90, azimuth=45, zscale=1, units="intl", overwrite=overwrite)
-    gscript.run_command('g.region', rast=region)
-    gscript.run_command('r.contour', input=dem, output=contour, step=5, overwrite=overwrite)
-    gscript.run_command('d.shade', shade=relief, color=dem, brighten=75)
-    gscript.run_command('d.vect', map=contour, display="shape")
-    gscript.run_command('d.legend', raster=dem, fontsize=9, at=(10,70,1,4))
-    gscript.run_command('d.mon', stop=driver)
-
-    # compute slope
-    gscript.run_command('d.mon', start=driver, width=width, height=height,  output=os.path.join(render,slope+".png"), overwrite=overwrite)
-    gscript.run_command('r.param.scale', input=dem, output=slope, size=9, method="slope", overwrite=overwrite)
-    gscript.run_command('r.colors', map=slope, color="slope")
-    gscript.run_command('d.shade', shade=relief, color=slope, brighten=75)
-    gscript.run_command('d.vect', map=contour, display='shape')
-    gscript.run_command('d.legend', raster=slope, fontsize=9, at=(10,90,1,4))
-    gscript.run_command('d.mon', stop=driver)
-
-    # simulate water flow
-    gscript.run_command('d.mon', start=driver, width=width, height=height,  output=os.path.join(render,depth+".png"), overwrite=overwrite)
-    gscript.run_command('r.slope.aspect', elevation=dem, dx='dx', dy='dy', overwrite=overwrite)
-    gscript.run_command('r.sim.water', elevation=dem, dx='dx', dy='dy', rain_value=300, depth=depth, nwalkers=5000, niterations=4, overwrite=overwrite)
-    gscript.run_command('g.remove', flags='f', type='raster', name=['dx', 'dy'])
-    gscript.run_command('d.shade', shade=relief, color=depth, brighten=75)
-    gscript.run_command('d.vect', map=contour, display='shape')
-    gscript.run_command('d.legend', raster=depth, fontsize=9, at=(10,90,1,4))
-    gscript.run_command('d.mon', stop=driver)
-
-    # identify depressions
-    gscript.run_command('r.fill.dir', input=dem, output='depressionless_dem', direction='flow_dir',overwrite=overwrite)
-    gscript.run_command('r.mapcalc', expression='{depressions} = if({depressionless_dem} - {dem} > {depth}, {depressionless_dem} - {dem}, null())'.format(depressions=depressions, depressionless_dem='depressionless_dem', dem=dem, depth=0), overwrite=overwrite)
-    gscript.write_command('r.colors', map=depressions, rules='-', stdin=depressions_colors)
-    gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(render,depressions+".png"), overwrite=overwrite)
-    gscript.run_command('d.shade', shade=relief, color=depressions, brighten=75)
-    gscript.run_command('d.vect', map=contour, display='shape')
-    gscript.run_command('d.legend', raster=depressions, fontsize=9, at=(10,90,1,4))
-    gscript.run_command('d.mon', stop=driver)
-
-    # compute the difference between the modeled and reference flow depth
-    gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(render,difference+".png"), overwrite=overwrite)
-    gscript.run_command('r.mapcalc', expression='{difference} = {before} - {after}'.format(before=before,after=after,difference=difference), overwrite=overwrite)
-    gscript.write_command('r.colors', map=difference, rules='-', stdin=difference_colors)
-    gscript.run_command('d.shade', shade=relief, color=difference, brighten=75)
-    gscript.run_command('d.vect', map=contour, display='shape')
-    gscript.run_command('d.legend', raster=difference, fontsize=9, at=(10,90,1,4))
-    gscript.run_command('d.mon', stop=driver)
-
-    # extract concentrated flow
-    gscript.run_command('r.mapcalc', expression='{concentrated_flow} = if({depth}>=0.05,{depth},null())'.format(depth=depth,concentrated_flow=concentrated_flow), overwrite=overwrite)
-    gscript.write_command('r.colors', map=concentrated_flow, rules='-', stdin=depth_colors)
-    gscript.run_command('r.random', input=concentrated_flow, npoints='100%', vector=concentrated_points, overwrite=overwrite)
-    gscript.run_command('d.mon', start=driver, width=width, height=height, output=os.path.join(render,concentrated_flow+".png"), overwrite=overwrite)
-    gscript.run_command('d.shade', shade=relief, color=concentrated_flow, brighten=75)
-    gscript.run_command('d.vect', map=concentrated_points, display='shape')
-    gscript.run_command('d.legend', raster=concentrated_flow, fontsize=9, at=(10,90,1,4))
-    gscript.run_command('d.mon', stop=driver)
+    key = cache.cache_key([dem], parameters) if use_cache else None
+    if not key or not cache.load(cache_dir, key, rasters, vectors):
+
+        # compute relief and contours
+        gscript.run_command('r.relief', input=dem, output=relief, altitude=90, azimuth=45, zscale=1, units="intl", overwrite=overwrite)
+        gscript.run_command('g.region', rast=region)
+        gscript.run_command('r.contour', input=dem, output=contour, step=contour_step, overwrite=overwrite)
+
+        # compute slope
+        gscript.run_command('r.param.scale', input=dem, output=slope, size=9, method="slope", overwrite=overwrite)
+        gscript.run_command('r.colors', map=slope, color="slope")
+
+        # simulate water flow
+        if water_method == "preview":
+            flow_preview.simulate(dem, depth, rain_value, colors=depth_colors)
+        else:
+            gscript.run_command('r.slope.aspect', elevation=dem, dx='dx', dy='dy', overwrite=overwrite)
+            if water_method == "ensemble":
+                simwe.simulate(dem, 'dx', 'dy', depth, rain_value, niterations, stderr='depth_stderr')
+                gscript.write_command('r.colors', map=depth, rules='-', stdin=depth_colors)
+            else:
+                gscript.run_command('r.sim.water', elevation=dem, dx='dx', dy='dy', rain_value=rain_value, depth=depth, nwalkers=nwalkers, niterations=niterations, overwrite=overwrite)
+            gscript.run_command('g.remove', flags='f', type='raster', name=['dx', 'dy'])
+
+        # identify depressions, compute the difference between the modeled and reference flow depth, and extract concentrated flow in one pass
+        batch = mapcalc.Batch()
+        if depression_method == "priority-flood":
+            priority_flood.compute_depressions(dem, depressions, epsilon=epsilon, depth=0)
+            gscript.write_command('r.colors', map=depressions, rules='-', stdin=depressions_colors)
+        else:
+            gscript.run_command('r.fill.dir', input=dem, output='depressionless_dem', direction='flow_dir',overwrite=overwrite)
+            batch.add(depressions, 'if({depressionless_dem} - {dem} > {depth}, {depressionless_dem} - {dem}, null())'.format(depressionless_dem='depressionless_dem', dem=dem, depth=0), rules=depressions_colors)
+        batch.add(difference, '{before} - {after}'.format(before=before,after=after), rules=difference_colors)
+        batch.add(concentrated_flow, 'if({depth}>={threshold},{depth},null())'.format(depth=depth,threshold=threshold), rules=depth_colors)
+        batch.run()
+        gscript.run_command('r.random', input=concentrated_flow, npoints='100%', vector=concentrated_points, overwrite=overwrite)
+
+        if key:
+            cache.store(cache_dir, key, rasters, vectors, max_size=cache_size)
+    else:
+        gscript.run_command('g.region', rast=region)
+
+    # queue renders
+    rendering.enqueue(rendering.spec(os.path.join(render,dem+".png"), relief, dem, width, height, overlays=[{'map': contour, 'display': 'shape'}], legend_at=(10,70,1,4)))
+    for raster in [slope, depth, depressions, difference]:
+        rendering.enqueue(rendering.spec(os.path.join(render,raster+".png"), relief, raster, width, height, overlays=[{'map': contour, 'display': 'shape'}]))
+    rendering.enqueue(rendering.spec(os.path.join(render,concentrated_flow+".png"), relief, concentrated_flow, width, height, overlays=[{'map': concentrated_points, 'display': 'shape'}]))
+
+    # render
+    if render_maps:
+        rendering.render_queue(nprocs)
+    else:
+        rendering.clear_queue()
 
     # compute number of cells with depressions
-    univar = gscript.parse_command('r.univar', map=depressions, separator='newline', flags='g')
-    depression_cells =  float(univar['sum'])
+    depression_cells = float(univar.row(univar.collect([depressions]), depressions)['sum'])
     print 'cells with depressions: ' + str(depression_cells)
 
 if __name__ == "__main__":
+    if '--no-render' in sys.argv[1:]:
+        render_maps = False
     main()
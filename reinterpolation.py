@@ -11,8 +11,12 @@ This program is free software under the GNU General Public License
 
 import sys
 import atexit
+import numpy as np
 import grass.script as gscript
 from grass.exceptions import CalledModuleError
+import parallel
+import rasters
+import rst
 
 # set graphics driver
 driver = "cairo"
@@ -23,52 +27,188 @@ def cleanup():
     except CalledModuleError:
         pass
 
+# set parameters
+overwrite = True
+tension = 25
+smooth = 5
+npmin = 300
+dmin = 0.5
+resolution = 10000
+nprocs = 1  # number of worker processes for reinterpolating DEMs or tiles in parallel
+tile_size = None  # split DEMs with more rows or columns than this into tiles
+tile_overlap = 20  # number of cells that neighbouring tiles overlap on each side of a seam
+interpolation_method = "v.surf.rst"  # interpolate with "v.surf.rst" or in process from the DEM array with "numpy"
+sampling = "uniform"  # sample resolution random points with "uniform" or sample by curvature until target_rmse with "adaptive"
+target_rmse = 0.5  # target root mean square error of the interpolated DEM for adaptive sampling
+initial_points = 2000  # number of points of the first adaptive sample
+step_points = 1000  # number of points added in each adaptive step
+
+# set region
+region = "dem@PERMANENT"
+
+# mapsets with scanned DEMs for each experiment
+experiment_mapsets = {'*dem_1': 'data', '*dem_2': 'reinterpolation'}
+
 def main():
     # temporary region
     gscript.use_temp_region()
+    gscript.run_command('g.region', raster=region, res=3)
 
-    # set parameters
-    overwrite = True
-    tension = 25
-    smooth = 5
-    npmin = 300
-    dmin = 0.5
-    resolution = 10000
-
-    # set region
-    region = "dem@PERMANENT"
-
-    # list scanned DEMs for experiment 1
-    dems = gscript.list_grouped('rast', pattern='*dem_1')['data']
+    # list scanned DEMs for each experiment
+    dems = []
+    for pattern, mapset in sorted(experiment_mapsets.items()):
+        dems.extend((dem, mapset) for dem in gscript.list_grouped('rast', pattern=pattern)[mapset])
 
     # iterate through scanned DEMs
-    for dem in dems:
-
-        # check alignment
-        gscript.run_command('r.region', map=dem, raster=region)
-
-        # reinterpolate DEM from random points using regularized spline with tension
-        gscript.run_command('g.region', raster=region, res=3)
-        gscript.run_command('r.random', input=dem, npoints=resolution, vector=dem.replace("dem","points"), flags='bd', overwrite=overwrite)
-        gscript.run_command('v.surf.rst', input=dem.replace("dem","points"), elevation=dem,  tension=tension, smooth=smooth, npmin=npmin, dmin=dmin, overwrite=overwrite)
-        gscript.run_command('r.colors', map=dem, color="elevation")
-        gscript.run_command('g.remove', type='vector', pattern='*points*', flags='f')
+    if nprocs == 1 and not tile_size:
+        for dem, mapset in dems:
+            reinterpolate(dem, mapset)
+        return
+
+    # reinterpolate DEMs or their tiles in parallel in temporary mapsets
+    tasks = []
+    for dem, mapset in dems:
+        align(dem)
+        tasks.extend(tile_tasks(dem, mapset))
+    results = parallel.run_in_pool(reinterpolate_task, tasks, nprocs)
+    for dem, mapset in dems:
+        merge(dem, [(task, result) for task, result in zip(tasks, results) if task['dem'] == dem])
+
+def align(dem):
+    """check the alignment of a scanned DEM with the reference region"""
+
+    gscript.run_command('r.region', map=dem, raster=region)
+
+def reinterpolate(dem, mapset=None):
+    """reinterpolate a scanned DEM from random points using regularized spline with tension
+
+    the scan is read from mapset so that an earlier reinterpolation of the DEM
+    in the current mapset is replaced rather than reinterpolated again
+    """
+
+    # check alignment
+    align(dem)
+
+    # reinterpolate DEM from random points using regularized spline with tension
+    gscript.run_command('g.region', raster=region, res=3)
+    interpolate(dem+'@'+mapset if mapset else dem, dem, resolution)
+    gscript.run_command('r.colors', map=dem, color="elevation")
+
+def interpolate(dem, output, npoints, env=None):
+    """interpolate a DEM in the current region from random points using regularized spline with tension"""
+
+    if sampling == "adaptive":
+        adaptive_interpolate(dem, output, npoints, env=env)
+        return
+
+    if interpolation_method == "numpy":
+        rst.reinterpolate(dem, output, npoints, tension, smooth, npmin, dmin, env=env)
+        return
+
+    # variables
+    points = parallel.temporary_name(output.replace("dem","points"))
+
+    gscript.run_command('r.random', input=dem, npoints=npoints, vector=points, flags='bd', overwrite=overwrite, env=env)
+    gscript.run_command('v.surf.rst', input=points, elevation=output,  tension=tension, smooth=smooth, npmin=npmin, dmin=dmin, overwrite=overwrite, env=env)
+    gscript.run_command('g.remove', type='vector', name=points, flags='f', env=env)
+
+def adaptive_interpolate(dem, output, npoints, env=None):
+    """interpolate a DEM from points sampled by curvature and error until the target rmse or npoints is reached"""
+
+    info = gscript.region(env=env)
+    points, surface, error = rst.adaptive_sample(rasters.load_array(dem, env=env), info, target_rmse, tension, smooth, npmin,
+                                                 initial=min(initial_points, npoints), step=step_points, maximum=npoints)
+    print(dem + ': ' + str(len(points)) + ' points with rmse ' + str(error))
+    if interpolation_method == "numpy":
+        rasters.write_array(surface, output, env=env)
+        return
+
+    points_map = parallel.temporary_name(output.replace("dem","points"))
+    rst.write_points(points, points_map, env=env)
+    gscript.run_command('v.surf.rst', input=points_map, elevation=output,  tension=tension, smooth=smooth, npmin=npmin, dmin=dmin, overwrite=overwrite, env=env)
+    gscript.run_command('g.remove', type='vector', name=points_map, flags='f', env=env)
+
+def tile_tasks(dem, mapset):
+    """split the reinterpolation of a DEM into tasks for overlapping tiles of the reference region"""
+
+    info = gscript.region()
+    rows = int(info['rows'])
+    cols = int(info['cols'])
+    size = tile_size or max(rows, cols)
+    tasks = []
+    for row in range(0, rows, size):
+        for col in range(0, cols, size):
+            # extend each tile beyond its core by the overlap
+            top = max(row-tile_overlap, 0)
+            bottom = min(row+size+tile_overlap, rows)
+            left = max(col-tile_overlap, 0)
+            right = min(col+size+tile_overlap, cols)
+            extent = {'n': float(info['n'])-top*float(info['nsres']),
+                      's': float(info['n'])-bottom*float(info['nsres']),
+                      'w': float(info['w'])+left*float(info['ewres']),
+                      'e': float(info['w'])+right*float(info['ewres']),
+                      'nsres': info['nsres'],
+                      'ewres': info['ewres']}
+            tasks.append({'dem': dem,
+                          'input': dem+'@'+mapset,
+                          'output': "tile_{row}_{col}_{dem}".format(row=row, col=col, dem=dem),
+                          'region': extent,
+                          'rows': (top, row, min(row+size, rows), bottom),
+                          'cols': (left, col, min(col+size, cols), right),
+                          'npoints': max(int(round(resolution*float((bottom-top)*(right-left))/(rows*cols))), npmin),
+                          'search_path': mapset})
+    return tasks
+
+def reinterpolate_task(task):
+    """reinterpolate a DEM or one of its tiles in a temporary mapset and return the name of the mapset"""
+
+    mapset, result = parallel.run_in_mapset(_interpolate_task, task, task['region'], search_path=task['search_path'], prefix='reinterpolation')
+    return mapset
+
+def _interpolate_task(task, env):
+    """interpolate the DEM or tile of a task"""
+
+    interpolate(task['input'], task['output'], task['npoints'], env=env)
+
+def feather(extent, size):
+    """return weights along one axis of the region that ramp across the overlaps of a tile"""
+
+    start, core_start, core_end, end = extent
+    index = np.arange(size)+0.5
+    weights = np.zeros(size)
+    inside = (index > start) & (index < end)
+    weights[inside] = 1.0
+    if core_start > start:
+        weights = np.minimum(weights, np.clip((index-start)/(2.0*(core_start-start)), 0, 1))
+    if end > core_end:
+        weights = np.minimum(weights, np.clip((end-index)/(2.0*(end-core_end)), 0, 1))
+    return weights
+
+def merge(dem, results):
+    """blend the reinterpolated tiles of a DEM into a single raster and remove the temporary mapsets"""
 
-    # list scanned DEMs for experiment 2
-    dems = gscript.list_grouped('rast', pattern='*dem_2')['reinterpolation']
-
-    # iterate through scanned DEMs
-    for dem in dems:
-
-        # check alignment
-        gscript.run_command('r.region', map=dem, raster=region)
-
-        # reinterpolate DEM from random points using regularized spline with tension
-        gscript.run_command('g.region', raster=region, res=3)
-        gscript.run_command('r.random', input=dem, npoints=resolution, vector=dem.replace("dem","points"), flags='bd', overwrite=overwrite)
-        gscript.run_command('v.surf.rst', input=dem.replace("dem","points"), elevation=dem,  tension=tension, smooth=smooth, npmin=npmin, dmin=dmin, overwrite=overwrite)
+    try:
+        if len(results) == 1:
+            task, mapset = results[0]
+            gscript.run_command('g.copy', raster=[task['output']+'@'+mapset, dem], overwrite=overwrite)
+        else:
+            info = gscript.region()
+            rows = int(info['rows'])
+            cols = int(info['cols'])
+            total = np.zeros((rows, cols))
+            weights = np.zeros((rows, cols))
+            for task, mapset in results:
+                tile = rasters.read_array(task['output']+'@'+mapset)
+                weight = np.outer(feather(task['rows'], rows), feather(task['cols'], cols))
+                weight[np.isnan(tile)] = 0
+                total += weight*np.nan_to_num(tile)
+                weights += weight
+            with np.errstate(invalid='ignore', divide='ignore'):
+                rasters.write_array(np.where(weights > 0, total/weights, np.nan), dem)
         gscript.run_command('r.colors', map=dem, color="elevation")
-        gscript.run_command('g.remove', type='vector', pattern='*points*', flags='f')
+    finally:
+        for task, mapset in results:
+            parallel.remove_mapset(mapset)
 
 if __name__ == "__main__":
     atexit.register(cleanup)
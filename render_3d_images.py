@@ -11,10 +11,9 @@ This program is free software under the GNU General Public License
 """
 
 import os
+import sys
 import grass.script as gscript
-
-# temporary region
-gscript.use_temp_region()
+import parallel
 
 # set environment
 env = gscript.gisenv()
@@ -32,6 +31,7 @@ render_3d = os.path.join(gisdbase, location, 'render_3d')
 
 # set variables
 res = 3 # resolution of the region
+nprocs = None # number of worker processes, defaults to the number of cores
 
 # 3d variables
 color_3d = "192:192:192"
@@ -77,372 +77,144 @@ grey = '0% 192:192:192\n100% 192:192:192\nnv 192:192:192\ndefault 192:192:192'
 url="http://soliton.vm.bytemark.co.uk/pub/cpt-city/mpl/viridis.cpt" # http://soliton.vm.bytemark.co.uk/pub/cpt-city/mpl/inferno.cpt
 
 
-# variables
-region_1 = "mean_dem_1"
-region_2 = "mean_dem_2"
-mean_dem_1 = "mean_dem_1"
-mean_dem_2 = "mean_dem_2"
-mean_depth_1 = "mean_depth_1"
-mean_depth_2 = "mean_depth_2"
-mean_diff_1 = "mean_diff_1"
-mean_diff_2 = "mean_diff_2"
-mean_diff_bright_1 = "mean_diff_bright_1"
-mean_diff_bright_2 = "mean_diff_bright_2"
-mean_depressions_1 = "mean_depressions_1"
-mean_depressions_2 = "mean_depressions_2"
-concentrated_points_1 = "concentrated_points_1"
-concentrated_points_2 = "concentrated_points_2"
-flow_distance_1 = "flow_distance_1"
-flow_distance_2 = "flow_distance_2"
-
-# set region
-gscript.run_command('g.region',
-                    rast="dem",
-                    res=res)
-
-# 3D render elevation
-gscript.write_command('r.colors',
-    map="dem",
-    rules='-',
-    stdin=dem_colors_3d)
-gscript.run_command('m.nviz.image',
-    elevation_map="dem",
-    color_map="dem",
-    #color=color_3d,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, "dem"),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# 3D render depth
-gscript.write_command('r.colors',
-    map="depth",
-    rules='-',
-    stdin=depth_colors_3d)
-gscript.run_command('m.nviz.image',
-    elevation_map="dem",
-    color_map="depth",
-    #color=color_3d,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, "depth"),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# 3D render depressions
-gscript.write_command('r.colors',
-    map="depressions",
-    rules='-',
-    stdin=depressions_colors_3d)
-gscript.run_command('m.nviz.image',
-    elevation_map="dem",
-    color_map="depressions",
-    #color=color_3d,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, "depressions"),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# 3D render mean flow difference
-gscript.write_command('r.colors',
-    map="diff",
-    rules='-',
-    stdin=grey)
-gscript.run_command('m.nviz.image',
-    elevation_map="dem",
-    color_map="diff",
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, "diff"),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# set region
-gscript.run_command('g.region',
-                    rast=region_1,
-                    res=res)
-
-# 3D render elevation
-gscript.write_command('r.colors',
-    map=mean_dem_1,
-    rules='-',
-    stdin=dem_colors_3d)
-gscript.run_command('m.nviz.image',
-    elevation_map=mean_dem_1,
-    color_map=mean_dem_1,
-    #color=color_3d,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, mean_dem_1),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# 3D render depth
-gscript.write_command('r.colors',
-    map=mean_depth_1,
-    rules='-',
-    stdin=depth_colors_3d)
-gscript.run_command('m.nviz.image',
-    elevation_map=mean_dem_1,
-    color_map=mean_depth_1,
-    #color=color_3d,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, mean_depth_1),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# 3D render depressions
-gscript.write_command('r.colors',
-    map=mean_depressions_1,
-    rules='-',
-    stdin=depressions_colors_3d)
-gscript.run_command('m.nviz.image',
-    elevation_map=mean_dem_1,
-    color_map=mean_depressions_1,
-    #color=color_3d,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, mean_depressions_1),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# 3D render mean flow difference
-gscript.write_command('r.colors',
-    map=mean_diff_1,
-    rules='-',
-    stdin=flow_difference_colors_3d)
-gscript.run_command('m.nviz.image',
-    elevation_map=mean_dem_1,
-    color_map=mean_diff_1,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, mean_diff_1),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# 3D render mean flow distance
-gscript.run_command('m.nviz.image',
-    elevation_map=mean_dem_1,
-    color_map=mean_diff_1,
-    vpoint=concentrated_points_1,
-    vpoint_size=vpoint_size,
-    vpoint_marker=vpoint_marker,
-    vpoint_color=vpoint_color,
-    vline=flow_distance_1,
-    vline_width=vline_width,
-    vline_color=vline_color,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, flow_distance_1),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# set region
-gscript.run_command('g.region',
-                    rast=region_2,
-                    res=res)
-
-# 3D render elevation
-gscript.write_command('r.colors',
-    map=mean_dem_2,
-    rules='-',
-    stdin=dem_colors_3d)
-gscript.run_command('m.nviz.image',
-    elevation_map=mean_dem_2,
-    color_map=mean_dem_2,
-    #color=color_3d,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, mean_dem_2),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# 3D render depth
-gscript.write_command('r.colors',
-    map=mean_depth_2,
-    rules='-',
-    stdin=depth_colors_3d)
-gscript.run_command('m.nviz.image',
-    elevation_map=mean_dem_2,
-    color_map=mean_depth_2,
-    #color=color_3d,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, mean_depth_2),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# 3D render depressions
-gscript.write_command('r.colors',
-    map=mean_depressions_2,
-    rules='-',
-    stdin=depressions_colors_3d)
-gscript.run_command('m.nviz.image',
-    elevation_map=mean_dem_2,
-    color_map=mean_depressions_2,
-    #color=color_3d,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, mean_depressions_2),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# 3D render mean flow difference
-gscript.write_command('r.colors',
-    map=mean_diff_2,
-    rules='-',
-    stdin=flow_difference_colors_3d)
-gscript.run_command('m.nviz.image',
-    elevation_map=mean_dem_2,
-    color_map=mean_diff_2,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, mean_diff_2),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
-
-# 3D render mean flow distance
-gscript.run_command('m.nviz.image',
-    elevation_map=mean_dem_2,
-    color_map=mean_diff_2,
-    vpoint=concentrated_points_2,
-    vpoint_size=vpoint_size,
-    vpoint_marker=vpoint_marker,
-    vpoint_color=vpoint_color,
-    vline=flow_distance_2,
-    vline_width=vline_width,
-    vline_color=vline_color,
-    resolution_fine=res_3d,
-    height=height_3d,
-    perspective=perspective,
-    light_position=light_position,
-    fringe=fringe,
-    fringe_color=color_3d,
-    fringe_elevation=fringe_elevation,
-    #arrow_position=arrow_position,
-    #arrow_size=arrow_size,
-    output=os.path.join(render_3d, flow_distance_2),
-    format=format_3d,
-    size=size_3d,
-    errors='ignore'
-    )
+# 3d settings shared by all renders
+nviz_settings = {
+    'resolution_fine': res_3d,
+    'height': height_3d,
+    'perspective': perspective,
+    'light_position': light_position,
+    'fringe': fringe,
+    'fringe_color': color_3d,
+    'fringe_elevation': fringe_elevation,
+    #'arrow_position': arrow_position,
+    #'arrow_size': arrow_size,
+    'format': format_3d,
+    'size': size_3d,
+    'errors': 'ignore'
+    }
+vector_settings = {
+    'vpoint_size': vpoint_size,
+    'vpoint_marker': vpoint_marker,
+    'vpoint_color': vpoint_color,
+    'vline_width': vline_width,
+    'vline_color': vline_color
+    }
+
+
+def job(region, elevation, color, colors, output, vpoint=None, vline=None):
+    """return a 3D render job
+
+    colors are the color rules set for the color map before rendering or None
+    to keep its current color table
+    """
+
+    return {'region': region,
+            'elevation': elevation,
+            'color': color,
+            'colors': colors,
+            'output': output,
+            'vpoint': vpoint,
+            'vline': vline}
+
+
+# render jobs for the reference and the mean surfaces of each experiment
+jobs = [
+    job("dem", "dem", "dem", dem_colors_3d, "dem"),
+    job("dem", "dem", "depth", depth_colors_3d, "depth"),
+    job("dem", "dem", "depressions", depressions_colors_3d, "depressions"),
+    job("dem", "dem", "diff", grey, "diff")
+    ]
+for i in range(1, 3):
+    region_i = "mean_dem_"+str(i)
+    mean_dem = "mean_dem_"+str(i)
+    mean_diff = "mean_diff_"+str(i)
+    jobs.extend([
+        job(region_i, mean_dem, mean_dem, dem_colors_3d, mean_dem),
+        job(region_i, mean_dem, "mean_depth_"+str(i), depth_colors_3d, "mean_depth_"+str(i)),
+        job(region_i, mean_dem, "mean_depressions_"+str(i), depressions_colors_3d, "mean_depressions_"+str(i)),
+        job(region_i, mean_dem, mean_diff, flow_difference_colors_3d, mean_diff),
+        job(region_i, mean_dem, mean_diff, flow_difference_colors_3d, "flow_distance_"+str(i), vpoint="concentrated_points_"+str(i), vline="flow_distance_"+str(i))
+        ])
+
+
+def main():
+    # render stale jobs in parallel
+    stale = []
+    for item in jobs:
+        missing = missing_inputs(item)
+        if missing:
+            gscript.warning("skipping {output}, missing {maps}".format(output=item['output'], maps=', '.join(missing)))
+        elif is_stale(item):
+            stale.append(item)
+    for item in stale:
+        if item['colors']:
+            gscript.write_command('r.colors', map=item['color'], rules='-', stdin=item['colors'])
+    parallel.run_in_pool(render_job, stale, nprocs)
+    sys.exit(0)
+
+
+def output_file(item):
+    """return the path of the image rendered by a job"""
+
+    return os.path.join(render_3d, item['output'])+"."+format_3d
+
+
+def map_time(name, element):
+    """return the modification time of a raster or vector map or None if it does not exist"""
+
+    path = gscript.find_file(name, element=element)['file']
+    if path and element == 'vector':
+        path = os.path.join(path, 'coor')
+    if not path or not os.path.exists(path):
+        return None
+    return os.path.getmtime(path)
+
+
+def input_maps(item):
+    """return the raster and vector maps read by a job with their elements"""
+
+    maps = [(item['elevation'], 'cell'), (item['color'], 'cell')]
+    maps += [(vector, 'vector') for vector in [item['vpoint'], item['vline']] if vector]
+    return maps
+
+
+def missing_inputs(item):
+    """return the names of the maps read by a job that do not exist"""
+
+    return [name for name, element in input_maps(item) if map_time(name, element) is None]
+
+
+def is_stale(item):
+    """check whether the output of a job is missing or older than its inputs, treating missing inputs as changed"""
+
+    if not os.path.isfile(output_file(item)):
+        return True
+    inputs = [map_time(name, element) for name, element in input_maps(item)]
+    if None in inputs:
+        return True
+    return os.path.getmtime(output_file(item)) < max(inputs)
+
+
+def render_job(item):
+    """render a job with its own region"""
+
+    # set region in the environment of this worker
+    job_env = os.environ.copy()
+    job_env.pop('WIND_OVERRIDE', None)
+    job_env['GRASS_REGION'] = gscript.region_env(raster=item['region'], res=res)
+
+    parameters = dict(nviz_settings)
+    if item['vpoint'] or item['vline']:
+        parameters.update(vector_settings)
+        parameters.update(vpoint=item['vpoint'], vline=item['vline'])
+    gscript.run_command('m.nviz.image',
+        elevation_map=item['elevation'],
+        color_map=item['color'],
+        output=os.path.join(render_3d, item['output']),
+        env=job_env,
+        **parameters)
+    return output_file(item)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: batched 2D rendering for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+import grass.script as gscript
+import parallel
+import rasters
+import contours
+
+# set graphics driver
+driver = "cairo"
+renderer = "grass"  # draw with GRASS display modules with "grass" or composite arrays in process with "numpy"
+table_size = 4096  # number of colors of compiled color tables
+
+# queued render specifications
+queue = []
+
+
+def spec(output, shade, color, width, height, overlays=(), legend=True, legend_at=(10, 90, 1, 4), brighten=75):
+    """return the specification of a shaded map image with vector overlays and a legend
+
+    overlays is a list of dictionaries of d.vect parameters drawn in order;
+    an overlay with a source of the dem and step of contours is drawn from
+    the cached contour segments by the in-process renderer
+    """
+
+    return {'output': output,
+            'shade': shade,
+            'color': color,
+            'width': int(width),
+            'height': int(height),
+            'overlays': [dict(overlay) for overlay in overlays],
+            'legend': color if legend is True else legend,
+            'legend_at': legend_at,
+            'brighten': brighten}
+
+
+def enqueue(specification):
+    """add a render specification to the queue"""
+
+    queue.append(specification)
+
+
+def clear_queue():
+    """discard queued render specifications"""
+
+    del queue[:]
+
+
+def render_environment(specification):
+    """return an environment that renders directly to the output file of a specification"""
+
+    env = os.environ.copy()
+    env['GRASS_RENDER_IMMEDIATE'] = driver
+    env['GRASS_RENDER_FILE'] = specification['output']
+    env['GRASS_RENDER_FILE_READ'] = 'TRUE'
+    env['GRASS_RENDER_WIDTH'] = str(specification['width'])
+    env['GRASS_RENDER_HEIGHT'] = str(specification['height'])
+    return env
+
+
+def render(specification):
+    """render a specification to its output file"""
+
+    if renderer == "numpy":
+        return composite(specification, Layers())
+    env = render_environment(specification)
+    if os.path.exists(specification['output']):
+        os.remove(specification['output'])
+    gscript.run_command('d.shade', shade=specification['shade'], color=specification['color'], brighten=specification['brighten'], env=env)
+    for overlay in specification['overlays']:
+        gscript.run_command('d.vect', env=env, **dict((key, value) for key, value in overlay.items() if key != 'source'))
+    if specification['legend']:
+        gscript.run_command('d.legend', raster=specification['legend'], fontsize=9, at=specification['legend_at'], env=env)
+    return specification['output']
+
+
+def render_queue(nprocs=None):
+    """render all queued specifications with a pool of workers and empty the queue"""
+
+    specifications = list(queue)
+    clear_queue()
+    if not specifications:
+        return []
+    pool = ThreadPool(nprocs or None)
+    try:
+        if renderer == "numpy":
+            layers = Layers()
+            return pool.map(lambda specification: composite(specification, layers), specifications)
+        return pool.map(render, specifications)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def lookup_table(rules):
+    """compile the output of r.colors.out into a color lookup table"""
+
+    values = []
+    colors = []
+    null_color = (255, 255, 255)
+    for line in rules.splitlines():
+        if not line.strip():
+            continue
+        value, color = line.split()
+        color = tuple(int(channel) for channel in color.split(':'))
+        if value == 'nv':
+            null_color = color
+        elif value != 'default':
+            values.append(float(value))
+            colors.append(color)
+    order = np.argsort(values, kind='mergesort')
+    values = np.array(values)[order]
+    colors = np.array(colors, dtype=float)[order]
+    samples = np.linspace(values[0], values[-1], table_size)
+    table = np.column_stack([np.interp(samples, values, colors[:, channel]) for channel in range(3)])
+    return {'minimum': values[0], 'maximum': values[-1], 'table': table.astype(np.uint8), 'null': np.array(null_color, dtype=np.uint8)}
+
+
+def apply_table(table, array):
+    """return the colors of an array with nulls as nan looked up in a color table"""
+
+    span = (table['maximum']-table['minimum']) or 1.0
+    null = np.isnan(array)
+    index = np.clip((np.where(null, table['minimum'], array)-table['minimum'])/span*(table_size-1), 0, table_size-1).astype(np.intp)
+    colors = table['table'][index]
+    colors[null] = table['null']
+    return colors
+
+
+def overlay_color(color):
+    """return the rgb values of a GRASS color name or r:g:b triplet"""
+
+    if ':' in color:
+        return tuple(int(channel) for channel in color.split(':'))
+    return ImageColor.getrgb(color)
+
+
+class Layers(object):
+    """arrays, color tables, and rasterized vectors shared by the images of one render queue
+
+    Maps do not change while a queue is rendered, so every layer is read or
+    rasterized once and reused by every image that draws it.
+    """
+
+    def __init__(self):
+        self.region = gscript.region()
+        self.layers = {}
+        self.lock = threading.Lock()
+
+    def _get(self, key, function, *args):
+        with self.lock:
+            if key not in self.layers:
+                self.layers[key] = threading.Event(), []
+                owner = True
+            else:
+                owner = False
+            event, value = self.layers[key]
+        if owner:
+            try:
+                value.append(function(*args))
+            finally:
+                event.set()
+        event.wait()
+        if not value:
+            raise RuntimeError("failed to read layer {key}".format(key=key))
+        return value[0]
+
+    def array(self, raster):
+        """return the array of a raster"""
+
+        return self._get(('array', raster), rasters.load_array, raster)
+
+    def table(self, raster):
+        """return the compiled color table of a raster"""
+
+        return self._get(('table', raster), lambda: lookup_table(gscript.read_command('r.colors.out', map=raster)))
+
+    def colors(self, raster):
+        """return the colors of a raster"""
+
+        return self._get(('colors', raster), lambda: apply_table(self.table(raster), self.array(raster)))
+
+    def shade(self, raster, brighten):
+        """return the hillshade intensity of a shaded relief raster between 0 and 1"""
+
+        return self._get(('shade', raster, brighten), lambda: np.clip(self.colors(raster).mean(axis=2)/255.0*(1+brighten/100.0), 0, 1))
+
+    def vector(self, vector):
+        """return a mask of the cells crossed by the lines or points of a vector"""
+
+        def rasterize():
+            raster = parallel.temporary_name('overlay')
+            gscript.run_command('v.to.rast', input=vector, output=raster, type='point,line,boundary', use='val', overwrite=True, quiet=True)
+            try:
+                return ~np.isnan(rasters.read_array(raster))
+            finally:
+                gscript.run_command('g.remove', flags='f', type='raster', name=raster, quiet=True)
+        return self._get(('vector', vector), rasterize)
+
+    def contours(self, source):
+        """return a mask of the cells crossed by the cached contours of a DEM without a vector map"""
+
+        return self._get(('contours', source['dem'], source['step']),
+                         lambda: contours.rasterize(contours.cached_contours(source['dem'], source['step'])[0], self.region))
+
+
+def composite(specification, layers):
+    """render a specification by compositing arrays like d.shade, d.vect, and d.legend"""
+
+    width = specification['width']
+    height = specification['height']
+    rows, cols = int(layers.region['rows']), int(layers.region['cols'])
+
+    # shade the colors of the color raster with the relief
+    colors = layers.colors(specification['color'])*layers.shade(specification['shade'], specification['brighten'])[:, :, np.newaxis]
+    colors = colors.astype(np.uint8)
+    colors[np.isnan(layers.array(specification['color']))] = 255
+    for overlay in specification['overlays']:
+        mask = layers.contours(overlay['source']) if 'source' in overlay else layers.vector(overlay['map'])
+        colors[mask] = overlay_color(overlay.get('color', 'black'))
+
+    # fit the map into the center of the frame
+    scale = min(width/float(cols), height/float(rows))
+    map_width, map_height = int(round(cols*scale)), int(round(rows*scale))
+    row_index = np.minimum((np.arange(map_height)/scale).astype(np.intp), rows-1)
+    col_index = np.minimum((np.arange(map_width)/scale).astype(np.intp), cols-1)
+    frame = np.full((height, width, 3), 255, dtype=np.uint8)
+    top, left = (height-map_height)//2, (width-map_width)//2
+    frame[top:top+map_height, left:left+map_width] = colors[row_index][:, col_index]
+    image = Image.fromarray(frame)
+
+    # draw a legend at bottom, top, left, right percent of the frame
+    if specification['legend']:
+        table = layers.table(specification['legend'])
+        bottom, top, left, right = specification['legend_at']
+        y0, y1 = int(height*(1-top/100.0)), int(height*(1-bottom/100.0))
+        x0, x1 = int(width*left/100.0), max(int(width*right/100.0), int(width*left/100.0)+1)
+        ramp = np.linspace(table['maximum'], table['minimum'], max(y1-y0, 1))
+        image.paste(Image.fromarray(np.repeat(apply_table(table, ramp)[:, np.newaxis], x1-x0, axis=1)), (x0, y0))
+        draw = ImageDraw.Draw(image)
+        for fraction in np.linspace(0, 1, 5):
+            value = table['maximum']-fraction*(table['maximum']-table['minimum'])
+            draw.text((x1+4, y0+fraction*(y1-y0)-5), '{value:.3g}'.format(value=value), fill=(0, 0, 0))
+
+    if os.path.exists(specification['output']):
+        os.remove(specification['output'])
+    image.save(specification['output'])
+    return specification['output']
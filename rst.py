@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: regularized spline with tension interpolation for the tangible water flow experiment
+
+Interpolates sampled DEM cells in process with the regularized spline with
+tension of Mitasova and Mitas (1993), following the normalization and
+quadtree segmentation of v.surf.rst: points are split into segments of at
+most segmax points and each segment is interpolated from the npmin points
+nearest to it, so that the windows of neighbouring segments overlap.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+from scipy.special import exp1
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+import grass.script as gscript
+import rasters
+
+# set parameters
+segmax = 40
+euler_gamma = 0.5772156649015329
+series_terms = 18  # number of terms of the series of the basis function of short distances
+
+
+def basis(squared_distance, fi):
+    """return the regularized spline with tension basis function of squared normalized distances
+
+    Like IL_crst of v.surf.rst the basis of short distances is summed as a
+    series, since E1(x)+ln(x)+gamma cancels to a few digits for small x.
+    """
+
+    rho = squared_distance*(fi*fi/4.0)
+    result = np.zeros(rho.shape)
+    short = rho < 1
+    # x-x^2/4+x^3/18-... = sum of (-1)^(k+1) x^k/(k k!)
+    x = rho[short]
+    total = np.zeros(x.shape)
+    factorial = 1.0
+    for k in range(1, series_terms+1):
+        factorial *= k
+        total += (-1)**(k+1)*x**k/(k*factorial)
+    result[short] = -total
+    far = ~short
+    result[far] = -(exp1(rho[far])+np.log(rho[far])+euler_gamma)
+    return result
+
+
+def sample_points(array, info, npoints, seed=None):
+    """return x, y, z of randomly sampled non-null cell centres of an array of a region"""
+
+    rows, cols = np.nonzero(~np.isnan(array))
+    if npoints < len(rows):
+        chosen = np.random.RandomState(seed).choice(len(rows), npoints, replace=False)
+        rows, cols = rows[chosen], cols[chosen]
+    x = float(info['w'])+(cols+0.5)*float(info['ewres'])
+    y = float(info['n'])-(rows+0.5)*float(info['nsres'])
+    return np.column_stack((x, y, array[rows, cols]))
+
+
+def sampling_weights(array):
+    """return sampling weights of cells that increase with local curvature and slope variance"""
+
+    filled = np.where(np.isnan(array), np.nanmean(array), array)
+    dy, dx = np.gradient(filled)
+    dyy = np.gradient(dy)[0]
+    dxx = np.gradient(dx)[1]
+    curvature = np.abs(dxx+dyy)
+    slope = np.hypot(dx, dy)
+    mean_slope = (slope+np.roll(slope, 1, 0)+np.roll(slope, -1, 0)+np.roll(slope, 1, 1)+np.roll(slope, -1, 1))/5.0
+    slope_variance = (slope-mean_slope)**2
+    weights = curvature/(curvature.mean() or 1)+slope_variance/(slope_variance.mean() or 1)
+    weights = weights+0.1*weights.mean()+np.finfo(float).tiny
+    weights[np.isnan(array)] = 0
+    return weights
+
+
+def adaptive_sample(array, info, target_rmse, tension, smooth, npmin, initial=2000, step=1000, maximum=10000, seed=None):
+    """sample cells with density driven by curvature and interpolation error until a target rmse is met
+
+    returns the sampled points, the interpolated surface, and its rmse
+    """
+
+    random = np.random.RandomState(seed)
+    valid = np.flatnonzero(~np.isnan(array).ravel())
+    weights = sampling_weights(array).ravel()
+    chosen = np.zeros(array.size, dtype=bool)
+    count = min(initial, maximum, len(valid))
+    while True:
+        # draw new cells with probability proportional to their weights
+        candidates = valid[~chosen[valid]]
+        new = count-chosen.sum()
+        if new > 0 and len(candidates):
+            probability = weights[candidates]/weights[candidates].sum()
+            chosen[random.choice(candidates, min(new, len(candidates)), replace=False, p=probability)] = True
+
+        rows, cols = np.unravel_index(np.flatnonzero(chosen), array.shape)
+        x = float(info['w'])+(cols+0.5)*float(info['ewres'])
+        y = float(info['n'])-(rows+0.5)*float(info['nsres'])
+        points = np.column_stack((x, y, array[rows, cols]))
+        surface = interpolate(points, info, tension, smooth, npmin, segmax)
+        error = np.abs(surface-array)
+        error_rmse = float(np.sqrt(np.nanmean(error**2)))
+        if error_rmse <= target_rmse or count >= min(maximum, len(valid)):
+            return points, surface, error_rmse
+
+        # refine where the terrain is complex and the interpolation is poor
+        weights = sampling_weights(array).ravel()*np.nan_to_num(error.ravel())+np.finfo(float).tiny
+        count = min(count+step, maximum, len(valid))
+
+
+def write_points(points, vector, env=None):
+    """write x, y, z coordinates as a vector map of 3D points"""
+
+    text = '\n'.join('{x}|{y}|{z}'.format(x=x, y=y, z=z) for x, y, z in points)
+    gscript.write_command('v.in.ascii', input='-', output=vector, format='point', separator='pipe', z=3, flags='zbt', stdin=text, overwrite=True, quiet=True, env=env)
+
+
+def thin(points, distance):
+    """remove points closer than a minimum distance to another point"""
+
+    if not distance or len(points) < 2:
+        return points
+    keep = np.ones(len(points), dtype=bool)
+    for i, j in sorted(cKDTree(points[:, :2]).query_pairs(distance)):
+        if keep[i] and keep[j]:
+            keep[j] = False
+    return points[keep]
+
+
+def quadtree(points, bounds, maximum, depth=0):
+    """split bounds into quadtree leaves holding at most a maximum number of points"""
+
+    west, south, east, north = bounds
+    if len(points) <= maximum or depth >= 16:
+        return [bounds]
+    x = (west+east)/2.0
+    y = (south+north)/2.0
+    leaves = []
+    for quadrant in [(west, y, x, north), (x, y, east, north), (west, south, x, y), (x, south, east, y)]:
+        inside = ((points[:, 0] >= quadrant[0]) & (points[:, 0] < quadrant[2]) &
+                  (points[:, 1] >= quadrant[1]) & (points[:, 1] < quadrant[3]))
+        leaves.extend(quadtree(points[inside], quadrant, maximum, depth+1))
+    return leaves
+
+
+def interpolate(points, info, tension, smooth, npmin, segmax=segmax):
+    """interpolate points onto the grid of a region and return the array"""
+
+    rows = int(info['rows'])
+    cols = int(info['cols'])
+    north = float(info['n'])
+    west = float(info['w'])
+    nsres = float(info['nsres'])
+    ewres = float(info['ewres'])
+    south = north-rows*nsres
+    east = west+cols*ewres
+
+    # normalize distances and elevations like v.surf.rst
+    dnorm = np.sqrt((east-west)*(north-south)*npmin/float(len(points)))
+    fi = tension*dnorm/1000.0
+    xy = (points[:, :2]-[west, south])/dnorm
+    zmin = points[:, 2].min()
+    z = (points[:, 2]-zmin)/dnorm
+    tree = cKDTree(xy)
+    k = min(npmin, len(points))
+
+    x_centres = west+(np.arange(cols)+0.5)*ewres
+    y_centres = north-(np.arange(rows)+0.5)*nsres
+    surface = np.full((rows, cols), np.nan)
+    for leaf in quadtree(points, (west, south, east, north), segmax):
+        leaf_cols = np.flatnonzero((x_centres >= leaf[0]) & (x_centres < leaf[2]))
+        leaf_rows = np.flatnonzero((y_centres >= leaf[1]) & (y_centres < leaf[3]))
+        if not len(leaf_cols) or not len(leaf_rows):
+            continue
+
+        # select the overlapping window of points nearest to the segment
+        centre = ((leaf[0]+leaf[2])/2.0-west)/dnorm, ((leaf[1]+leaf[3])/2.0-south)/dnorm
+        distances, window = tree.query(centre, k=k)
+        window = np.atleast_1d(window)
+        window_xy = xy[window]
+
+        # solve for the spline coefficients and the trend
+        n = len(window)
+        matrix = np.ones((n+1, n+1))
+        matrix[n, n] = 0
+        matrix[:n, :n] = basis(cdist(window_xy, window_xy, 'sqeuclidean'), fi)
+        matrix[np.arange(n), np.arange(n)] = smooth
+        coefficients = np.linalg.solve(matrix, np.append(z[window], 0))
+
+        # evaluate the spline at the cell centres of the segment
+        grid_x, grid_y = np.meshgrid((x_centres[leaf_cols]-west)/dnorm, (y_centres[leaf_rows]-south)/dnorm)
+        cells = np.column_stack((grid_x.ravel(), grid_y.ravel()))
+        values = basis(cdist(cells, window_xy, 'sqeuclidean'), fi).dot(coefficients[:n])+coefficients[n]
+        surface[np.ix_(leaf_rows, leaf_cols)] = values.reshape(len(leaf_rows), len(leaf_cols))*dnorm+zmin
+    return surface
+
+
+def reinterpolate(dem, output, npoints, tension, smooth, npmin, dmin, seed=None, env=None):
+    """reinterpolate a DEM from randomly sampled cells without writing a vector map of points
+
+    tension, smooth, npmin, and dmin are the parameters of v.surf.rst
+    """
+
+    info = gscript.region(env=env)
+    points = thin(sample_points(rasters.load_array(dem, env=env), info, npoints, seed), dmin)
+    rasters.write_array(interpolate(points, info, tension, smooth, npmin, segmax), output, env=env)
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: single pass series statistics for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import re
+import numpy as np
+import grass.script as gscript
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+import rasters
+
+# set parameters
+block_rows = 64  # number of rows read from each map at a time
+cell_null = -2147483648
+
+
+def _read_block(raster, start, stop):
+    """read rows from an open raster into a float array with nulls as nan"""
+
+    block = np.array([raster.get_row(row) for row in range(start, stop)], dtype=np.float64)
+    if raster.mtype == 'CELL':
+        block[block == cell_null] = np.nan
+    return block
+
+
+def reduce_stack(stack, method):
+    """reduce a stack of blocks along the first axis like r.series, ignoring nulls"""
+
+    valid = ~np.isnan(stack)
+    count = valid.sum(axis=0)
+    if method == 'count':
+        return count.astype(np.float64)
+    if method == 'sum':
+        result = np.where(valid, stack, 0).sum(axis=0)
+    elif method == 'average':
+        result = np.where(valid, stack, 0).sum(axis=0)/np.maximum(count, 1)
+    elif method == 'maximum':
+        result = np.fmax.reduce(stack, axis=0)
+    elif method == 'minimum':
+        result = np.fmin.reduce(stack, axis=0)
+    else:
+        raise ValueError("unsupported method {method}".format(method=method))
+    return np.where(count > 0, result, np.nan)
+
+
+def _compute_arrays(stacks, reductions, env=None):
+    """compute reductions over stacks of rasters read as whole arrays in the region of an environment"""
+
+    arrays = dict((name, np.array([read_raster(raster, env) for raster in maps])) for name, maps in stacks.items() if maps)
+    for name, method, output in reductions:
+        if name in arrays:
+            write_raster(reduce_stack(arrays[name], method), output, env)
+        else:
+            region = gscript.region(env=env)
+            write_raster(np.full((int(region['rows']), int(region['cols'])), np.nan), output, env)
+
+
+def compute_series(stacks, reductions, rows=None, env=None):
+    """compute reductions over stacks of rasters reading each raster only once
+
+    stacks maps a stack name to a list of rasters and reductions is a list of
+    (stack name, method, output raster) tuples using r.series method names;
+    with an environment, e.g. of another mapset, whole rasters are read
+    through GRASS modules instead of block by block
+    """
+
+    if env is not None:
+        return _compute_arrays(stacks, reductions, env)
+
+    region = Region()
+    rows = rows or block_rows
+
+    # open inputs and outputs
+    inputs = {}
+    outputs = []
+    try:
+        for name, maps in stacks.items():
+            inputs[name] = []
+            for raster in maps:
+                raster = RasterRow(raster)
+                raster.open('r')
+                inputs[name].append(raster)
+        for name, method, output in reductions:
+            raster = RasterRow(output)
+            raster.open('w', mtype='DCELL', overwrite=True)
+            outputs.append((name, method, raster))
+
+        # read each stack block by block and compute every reduction in the same pass
+        buffer = Buffer((region.cols,), mtype='DCELL')
+        for start in range(0, region.rows, rows):
+            stop = min(start+rows, region.rows)
+            blocks = {}
+            for name, rasters in inputs.items():
+                if rasters:
+                    blocks[name] = np.array([_read_block(raster, start, stop) for raster in rasters])
+                else:
+                    blocks[name] = np.full((1, stop-start, region.cols), np.nan)
+            for name, method, raster in outputs:
+                result = reduce_stack(blocks[name], method)
+                for row in result:
+                    buffer[:] = row
+                    raster.put_row(buffer)
+    finally:
+        for rasters in inputs.values():
+            for raster in rasters:
+                raster.close()
+        for name, method, raster in outputs:
+            raster.close()
+
+
+class SeriesAccumulator(object):
+    """streaming mean, maximum, sum, count, and variance of a series of rasters using Welford's method"""
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.count = np.zeros(shape, dtype=np.int32)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        self.total = np.zeros(shape, dtype=np.float64)
+        self.maximum = np.full(shape, np.nan)
+        self.members = {}
+
+    def update(self, array, name=None, stamp=None):
+        """add a raster array with nulls as nan to the series"""
+
+        valid = ~np.isnan(array)
+        values = array[valid]
+        self.count[valid] += 1
+        delta = values-self.mean[valid]
+        self.mean[valid] += delta/self.count[valid]
+        self.m2[valid] += delta*(values-self.mean[valid])
+        self.total[valid] += values
+        self.maximum = np.fmax(self.maximum, array)
+        if name:
+            self.members[name] = stamp
+
+    def result(self, method):
+        """return a statistic of the series like r.series with nulls as nan"""
+
+        count = self.count
+        if method == 'count':
+            return count.astype(np.float64)
+        if method == 'average':
+            result = self.mean
+        elif method == 'sum':
+            result = self.total
+        elif method == 'maximum':
+            result = self.maximum
+        elif method == 'variance':
+            result = self.m2/np.maximum(count, 1)
+        elif method == 'stddev':
+            result = np.sqrt(self.m2/np.maximum(count, 1))
+        else:
+            raise ValueError("unsupported method {method}".format(method=method))
+        return np.where(count > 0, result, np.nan)
+
+    def save(self, path):
+        """save the state of the accumulator"""
+
+        names = sorted(self.members)
+        np.savez(path, count=self.count, mean=self.mean, m2=self.m2, total=self.total, maximum=self.maximum,
+                 names=np.array(names), stamps=np.array([self.members[name] for name in names], dtype=np.float64))
+
+    @classmethod
+    def load(cls, path):
+        """load the state of an accumulator"""
+
+        state = np.load(path)
+        accumulator = cls(state['count'].shape)
+        accumulator.count = state['count']
+        accumulator.mean = state['mean']
+        accumulator.m2 = state['m2']
+        accumulator.total = state['total']
+        accumulator.maximum = state['maximum']
+        accumulator.members = dict(zip([str(name) for name in state['names']], state['stamps'].tolist()))
+        return accumulator
+
+
+def read_raster(name, env=None):
+    """read a raster in the current region into a float array with nulls as nan"""
+
+    if env is not None:
+        return rasters.read_array(name, env=env)
+    region = Region()
+    raster = RasterRow(name)
+    raster.open('r')
+    try:
+        return _read_block(raster, 0, region.rows)
+    finally:
+        raster.close()
+
+
+def write_raster(array, name, env=None):
+    """write a float array with nulls as nan to a raster in the current region"""
+
+    if env is not None:
+        return rasters.write_array(array, name, env=env)
+    raster = RasterRow(name)
+    raster.open('w', mtype='DCELL', overwrite=True)
+    try:
+        buffer = Buffer((array.shape[1],), mtype='DCELL')
+        for row in array:
+            buffer[:] = row
+            raster.put_row(buffer)
+    finally:
+        raster.close()
+
+
+def raster_stamp(name, env=None):
+    """return the modification time of a raster"""
+
+    return os.path.getmtime(gscript.find_file(name, element='cell', env=env)['file'])
+
+
+def update_series(stacks, reductions, state_dir, env=None):
+    """update streaming statistics of stacks of rasters with new rasters and write the reductions
+
+    stacks maps a stack name to a list of rasters and reductions is a list of
+    (stack name, method, output raster) tuples; the accumulated state of each
+    stack is kept in state_dir so that only rasters that are new or changed
+    since the last update are read
+    """
+
+    if env is not None:
+        region = gscript.region(env=env)
+        shape = (int(region['rows']), int(region['cols']))
+    else:
+        region = Region()
+        shape = (region.rows, region.cols)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+
+    accumulators = {}
+    for name, maps in stacks.items():
+        path = os.path.join(state_dir, re.sub(r'\W', '', name)+".npz")
+        stamps = dict((raster, raster_stamp(raster, env)) for raster in maps)
+
+        # start over if the region changed or a raster was removed or recomputed
+        accumulator = None
+        if os.path.isfile(path):
+            accumulator = SeriesAccumulator.load(path)
+            if accumulator.shape != shape or any(stamps.get(member) != stamp for member, stamp in accumulator.members.items()):
+                accumulator = None
+        if accumulator is None:
+            accumulator = SeriesAccumulator(shape)
+
+        # add new rasters one at a time
+        for raster in maps:
+            if raster not in accumulator.members:
+                accumulator.update(read_raster(raster, env), raster, stamps[raster])
+        accumulator.save(path)
+        accumulators[name] = accumulator
+
+    for name, method, output in reductions:
+        write_raster(accumulators[name].result(method), output, env)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: convergence driven water flow simulation for the tangible water flow experiment
+
+Runs r.sim.water as an ensemble of seeded walker batches in parallel and
+merges their depths as they finish until the per-cell standard error of
+the mean depth is small enough.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import grass.script as gscript
+import parallel
+import rasters
+from series import SeriesAccumulator
+
+# set parameters
+batch_walkers = 1000  # number of walkers in each batch
+min_batches = 3
+max_batches = 50
+tolerance = 0.05  # maximum relative standard error of the mean depth
+min_depth = 0.001  # only cells with at least this mean depth must converge
+coverage = 0.95  # fraction of wet cells that must converge
+nprocs = None  # number of batches simulated at the same time, defaults to the number of cores
+
+
+def standard_error(accumulator):
+    """return the standard error of the mean of an accumulated series with nulls as nan"""
+
+    count = accumulator.count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        error = np.sqrt(accumulator.m2/(count-1)/count)
+    return np.where(count > 1, error, np.nan)
+
+
+def converged(accumulator):
+    """check whether the mean depth of enough wet cells has a small relative standard error"""
+
+    if accumulator.count.max() < min_batches:
+        return False
+    relative = relative_error(accumulator)
+    return not relative.size or np.mean(relative <= tolerance) >= coverage
+
+
+def simulate_batch(elevation, dx, dy, seed, rain_value, niterations, env=None):
+    """simulate water flow with a seeded batch of walkers and return its depth array"""
+
+    depth = parallel.temporary_name('depth_batch')
+    try:
+        gscript.run_command('r.sim.water', elevation=elevation, dx=dx, dy=dy, rain_value=rain_value, depth=depth,
+                            nwalkers=batch_walkers, niterations=niterations, random_seed=seed, overwrite=True, quiet=True, env=env)
+        return rasters.read_array(depth, env=env)
+    finally:
+        gscript.run_command('g.remove', flags='f', type='raster', name=depth, quiet=True, env=env)
+
+
+def relative_error(accumulator):
+    """return the relative standard error of the mean depth of wet cells"""
+
+    mean = accumulator.result('average')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wet = mean >= min_depth
+        return standard_error(accumulator)[wet]/mean[wet]
+
+
+def simulate(elevation, dx, dy, depth, rain_value, niterations, stderr=None, seed=0, env=None):
+    """simulate water flow with batches of walkers until the mean depth converges
+
+    writes the mean depth and optionally its standard error and returns the
+    number of walkers used
+    """
+
+    workers = nprocs or cpu_count()
+    accumulator = None
+    batches = 0
+    pool = ThreadPool(workers)
+    try:
+        while batches < max_batches:
+            # run a wave of batches and merge them as they finish
+            wave = range(batches, min(batches+workers, max_batches))
+            for result in pool.imap_unordered(lambda i: simulate_batch(elevation, dx, dy, seed+i+1, rain_value, niterations, env), wave):
+                if accumulator is None:
+                    accumulator = SeriesAccumulator(result.shape)
+                accumulator.update(np.where(np.isnan(result), 0, result))
+                batches += 1
+            if converged(accumulator):
+                break
+    finally:
+        pool.close()
+        pool.join()
+
+    rasters.write_array(accumulator.result('average'), depth, env=env)
+    if stderr:
+        rasters.write_array(standard_error(accumulator), stderr, env=env)
+
+    walkers = batches*batch_walkers
+    relative = relative_error(accumulator)
+    print(depth + ': ' + str(walkers) + ' walkers in ' + str(batches) + ' batches, median relative standard error ' + str(np.median(relative) if relative.size else 0))
+    return walkers
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: parameter sweeps for the tangible water flow experiment
+
+Reruns the reinterpolation, water flow, and series analysis for every
+combination of a grid of parameters and writes the depression and distance
+statistics of each combination to one table. Each stage runs once for each
+distinct combination of its own and its upstream parameters in a temporary
+mapset, so combinations that only differ downstream share the upstream
+maps. The reference water depth is simulated once for each combination of
+the water parameters and the reference concentrated flow is extracted with
+the threshold of each series, so that every combination is compared with a
+reference computed with the same parameters. Run it in the 'analysis'
+mapset.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import sys
+import csv
+import shutil
+import itertools
+import numpy as np
+import grass.script as gscript
+import parallel
+import rasters
+import nearest_flow
+import reinterpolation
+import analysis
+import univar
+
+# set parameters
+nprocs = None  # number of stages run at the same time, defaults to the number of cores
+grid = {'tension': [25],
+        'smooth': [5],
+        'rain_value': [300],
+        'nwalkers': [5000],
+        'contour_step': [5],
+        'threshold': [0.05]}
+
+# stages and the parameters that they depend on in order
+stages = [('reinterpolation', ('tension', 'smooth')),
+          ('model', ('rain_value', 'nwalkers', 'contour_step')),
+          ('series', ('threshold',))]
+
+# parameters of the reference water depth
+reference_parameters = ('rain_value', 'nwalkers')
+
+# set results file
+results = os.path.join(analysis.grassdata, os.path.normpath("results/sweep/sweep.csv"))
+state_dir = os.path.join(analysis.series_state, "sweep")
+
+
+def combinations(grid):
+    """return every combination of the values of a grid of parameters"""
+
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def stage_key(combination, index):
+    """return the parameters of a stage and its upstream stages for a combination"""
+
+    return tuple((name, combination[name]) for stage, names in stages[:index+1] for name in names)
+
+
+def reference_key(combination):
+    """return the water parameters of the reference of a combination"""
+
+    return tuple((name, combination[name]) for name in reference_parameters)
+
+
+def reference_stage(task, env):
+    """simulate the reference water depth of the reference DEM with the parameters of a task"""
+
+    parameters, source, reference = task
+    analysis.rain_value = parameters['rain_value']
+    analysis.nwalkers = parameters['nwalkers']
+    analysis.simulate_water("dem@PERMANENT", "depth", env=env)
+
+
+def reinterpolate_stage(task, env):
+    """reinterpolate the scanned DEMs of every experiment with the parameters of a task"""
+
+    parameters, source, reference = task
+    reinterpolation.tension = parameters['tension']
+    reinterpolation.smooth = parameters['smooth']
+    for pattern, mapset in sorted(reinterpolation.experiment_mapsets.items()):
+        for dem in gscript.list_grouped('rast', pattern=pattern, env=env).get(mapset, []):
+            reinterpolation.interpolate(dem+'@'+mapset, dem, reinterpolation.resolution, env=env)
+            gscript.run_command('r.colors', map=dem, color="elevation", env=env)
+
+
+def model_stage(task, env):
+    """compute the maps derived from the reinterpolated DEMs of an upstream mapset found through the search path"""
+
+    parameters, source, reference = task
+    analysis.rain_value = parameters['rain_value']
+    analysis.nwalkers = parameters['nwalkers']
+    analysis.contour_step = parameters['contour_step']
+    analysis.reference_mapset = reference
+    for dem in gscript.list_grouped('rast', pattern='*dem*', env=env).get(source, []):
+        analysis.analyze_model(dem, env=env)
+
+
+def series_stage(task, env):
+    """compute the series statistics of every experiment from the maps of an upstream mapset"""
+
+    parameters, source, reference = task
+    analysis.threshold = parameters['threshold']
+    analysis.mapset = source
+    analysis.render_maps = False
+    analysis.render_flow_distance = False
+    analysis.write_statistics = False
+    analysis.series_state = os.path.join(state_dir, gscript.gisenv(env=env)['MAPSET'])
+
+    # extract the reference concentrated flow with the threshold of the series
+    depth = rasters.read_array("depth@"+reference, env=env)
+    with np.errstate(invalid='ignore'):
+        reference_xy = nearest_flow.cell_coordinates(np.where(depth >= analysis.threshold, depth, np.nan), env=env)
+    analysis.reference_mapset = gscript.gisenv(env=env)['MAPSET']
+    if analysis.distance_method != "kd-tree":
+        nearest_flow.write_points(reference_xy, "concentrated_points", env=env)
+    return [analysis.analyze_experiment((i, reference_xy), env=env) for i in range(1, analysis.iterator)]
+
+
+def run_stage(item):
+    """run a stage in a temporary mapset that can read the mapsets of its upstream stage and its reference"""
+
+    stage, parameters, source, reference = item
+    if stage == 'reference':
+        function = reference_stage
+        search_path = ['PERMANENT']
+    elif stage == 'reinterpolation':
+        function = reinterpolate_stage
+        search_path = sorted(set(reinterpolation.experiment_mapsets.values()))+['PERMANENT']
+    else:
+        function = model_stage if stage == 'model' else series_stage
+        search_path = [source, reference, 'PERMANENT']
+    return parallel.run_in_mapset(function, (parameters, source, reference), analysis.region, search_path=search_path, prefix='sweep')
+
+
+def table_row(combination, experiments, total_count):
+    """return a row of the results table for the series results of a combination"""
+
+    row = dict(combination)
+    for result in experiments:
+        i = str(result['experiment'])
+        row['depression_percent_'+i] = (total_count-result['depression_nulls'])/total_count*100
+        for statistic in ['sum', 'mean']+['percentile_'+str(p) for p in nearest_flow.percentiles]:
+            if statistic in result['distance_statistics']:
+                row['distance_'+statistic+'_'+i] = float(result['distance_statistics'][statistic])
+    return row
+
+
+def write_table(rows, path):
+    """write the rows of the results table as comma separated values"""
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    names = sorted(grid)
+    columns = names+sorted(set(column for row in rows for column in row) - set(names))
+    with open(path, 'w') as output:
+        writer = csv.DictWriter(output, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def sweep(grid):
+    """run every stage once for each distinct combination of its parameters and return the rows of the results table"""
+
+    total_count = float(univar.row(univar.collect(["depressions@PERMANENT"]), "depressions@PERMANENT")['cells'])
+    combos = combinations(grid)
+    mapsets = {}
+    outputs = {}
+    references = {}
+    try:
+        keys = sorted(set(reference_key(combination) for combination in combos))
+        print('reference: ' + str(len(keys)) + ' runs')
+        for key, (mapset, result) in zip(keys, parallel.run_in_pool(run_stage, [('reference', dict(key), None, None) for key in keys], nprocs)):
+            references[key] = mapset
+
+        for index, (stage, names) in enumerate(stages):
+            keys = sorted(set(stage_key(combination, index) for combination in combos))
+            items = [(stage, dict(key), mapsets[key[:-len(names)]] if index else None,
+                      references[reference_key(dict(key))] if index else None) for key in keys]
+            print(stage + ': ' + str(len(items)) + ' runs')
+            for key, (mapset, result) in zip(keys, parallel.run_in_pool(run_stage, items, nprocs)):
+                mapsets[key] = mapset
+                outputs[key] = result
+        last = len(stages)-1
+        return [table_row(combination, outputs[stage_key(combination, last)], total_count) for combination in combos]
+    finally:
+        for mapset in list(mapsets.values())+list(references.values()):
+            parallel.remove_mapset(mapset)
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+def main():
+    rows = sweep(grid)
+    write_table(rows, results)
+    print('wrote ' + str(len(rows)) + ' combinations to ' + results)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
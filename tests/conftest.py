@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: test configuration for the tangible water flow experiment
+
+The tests only cover array code that runs without GRASS, so empty stand-ins
+for the GRASS python modules are installed if GRASS is not on the path.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import grass.script
+    import grass.pygrass.raster
+except ImportError:
+    for name in ['grass', 'grass.script', 'grass.exceptions', 'grass.pygrass', 'grass.pygrass.gis',
+                 'grass.pygrass.gis.region', 'grass.pygrass.raster', 'grass.pygrass.raster.buffer']:
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules['grass'].script = sys.modules['grass.script']
+    sys.modules['grass.exceptions'].CalledModuleError = RuntimeError
+    sys.modules['grass.pygrass.gis.region'].Region = None
+    sys.modules['grass.pygrass.raster'].RasterRow = None
+    sys.modules['grass.pygrass.raster.buffer'].Buffer = None
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of marching squares contours for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+import contours
+
+
+def cone(size=41, centre=20.0):
+    """return the distance of each cell from the centre of an array"""
+
+    rows, cols = np.indices((size, size))
+    return np.hypot(cols-centre, rows-centre)
+
+
+def sorted_segments(lines):
+    """return segments with their endpoints in order as sorted tuples for comparison"""
+
+    result = []
+    for col0, row0, col1, row1 in np.round(lines, 6).tolist():
+        result.append(tuple(sorted([(col0, row0), (col1, row1)])))
+    return sorted(result)
+
+
+def test_circle_has_the_radius_of_its_level():
+    radius = 12.5
+    lines = contours.segments(cone(), radius)
+    distance = np.hypot(lines[:, [0, 2]]-20, lines[:, [1, 3]]-20)
+    assert np.all(np.abs(distance-radius) < 0.05)
+    length = np.hypot(lines[:, 2]-lines[:, 0], lines[:, 3]-lines[:, 1]).sum()
+    assert abs(length-2*np.pi*radius) < 0.01*2*np.pi*radius
+
+
+def test_circle_is_closed():
+    lines = contours.segments(cone(), 7.3)
+    ends = {}
+    for end in np.round(lines, 6).reshape(-1, 2).tolist():
+        ends[tuple(end)] = ends.get(tuple(end), 0)+1
+    assert all(count == 2 for count in ends.values())
+
+
+def test_saddles_follow_the_centre():
+    # the high corners are joined through a high centre
+    lines = contours.segments(np.array([[1.0, 0.0], [0.0, 1.0]]), 0.5)
+    assert sorted_segments(lines) == [((0.0, 0.5), (0.5, 1.0)), ((0.5, 0.0), (1.0, 0.5))]
+
+    # the low corners are joined through a low centre
+    lines = contours.segments(np.array([[1.0, 0.0], [0.0, 1.0]]), 0.6)
+    assert sorted_segments(lines) == [((0.0, 0.4), (0.4, 0.0)), ((0.6, 1.0), (1.0, 0.6))]
+
+
+def test_nulls_and_flat_levels():
+    array = np.array([[0.0, 1.0, np.nan], [0.0, 1.0, 2.0]])
+    assert sorted_segments(contours.segments(array, 0.5)) == [((0.5, 0.0), (0.5, 1.0))]
+    assert len(contours.segments(np.ones((3, 3)), 1.0)) == 0
+
+
+def test_contour_coordinates():
+    info = {'n': 100.0, 'w': 10.0, 'nsres': 2.0, 'ewres': 3.0}
+    array = np.array([[0.0, 2.0], [0.0, 2.0]])
+    lines, levels = contours.contour(array, info, 1.0)
+    np.testing.assert_allclose(levels, [1.0, 2.0])
+    np.testing.assert_allclose(lines, [[13.0, 99.0, 13.0, 97.0], [14.5, 99.0, 14.5, 97.0]])
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of the flow preview for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+import flow_preview
+
+
+def random_dem(seed, shape=(25, 30)):
+    """return a rough sloping elevation array"""
+
+    rows, cols = np.indices(shape)
+    return rows*0.5+np.random.RandomState(seed).rand(*shape)*3
+
+
+def test_accumulate_conserves_area():
+    for routing in (flow_preview.d8, flow_preview.d_infinity):
+        for seed in range(3):
+            dem = random_dem(seed)
+            receivers, weights, slope = routing(dem, 2.0, 3.0)
+            area = np.full(dem.shape, 6.0)
+            accumulation = flow_preview.accumulate(receivers, weights, area)
+
+            # all area ends in cells that do not pass it on
+            sinks = weights.sum(axis=0) == 0
+            np.testing.assert_allclose(accumulation[sinks].sum(), area.sum())
+            assert np.all(accumulation >= area)
+
+
+def test_weights_split_all_flow():
+    dem = random_dem(0)
+    receivers, weights, slope = flow_preview.d_infinity(dem, 1.0, 1.0)
+    total = weights.sum(axis=0)
+    assert np.allclose(total[slope > 0], 1)
+    assert np.all(total[slope == 0] == 0)
+
+
+def test_d8_accumulates_down_a_plane():
+    rows, cols = np.indices((6, 4))
+    dem = -rows.astype(float)
+    receivers, weights, slope = flow_preview.d8(dem, 1.0, 1.0)
+    accumulation = flow_preview.accumulate(receivers, weights, np.ones(dem.shape))
+    np.testing.assert_array_equal(accumulation, np.tile(np.arange(1, 7)[:, np.newaxis], (1, 4)))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of incremental recomputation for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+import incremental
+
+
+def slope(shape=(40, 30)):
+    """return a plane that drains towards the last row"""
+
+    rows, cols = np.indices(shape)
+    return 100-rows+0.01*cols
+
+
+def test_unchanged_dems_need_no_recomputation():
+    dem = slope()
+    for mask in incremental.influence(dem, dem.copy(), 1.0, 1.0):
+        assert not mask.any()
+
+
+def test_influence_follows_the_flow():
+    previous = slope()
+    current = previous.copy()
+    current[10, 15] += 1
+    changed, influenced, recompute = incremental.influence(previous, current, 1.0, 1.0)
+    assert changed.sum() == 1 and changed[10, 15]
+
+    # the change reaches the cells downslope, which drain west along the last row, but not upslope
+    assert influenced[10:, 15].all()
+    assert influenced[-1, :15].all()
+    assert not influenced[:10-incremental.halo, :].any()
+    assert not influenced[:, 15+incremental.halo+1:].any()
+
+    # cells that drain into the influenced cells are recomputed too
+    assert (recompute >= influenced).all()
+    assert recompute[:10-incremental.halo, 15].all()
+
+
+def test_changed_cells_include_nulls():
+    previous = slope((5, 5))
+    current = previous.copy()
+    current[0, 0] = np.nan
+    current[1, 1] += incremental.tolerance/2
+    changed = incremental.changed_cells(previous, current)
+    assert changed.sum() == 1 and changed[0, 0]
+
+
+def test_boxes_of_separate_regions():
+    mask = np.zeros((10, 10), dtype=bool)
+    mask[1:3, 1:4] = True
+    mask[6:9, 7] = True
+    assert sorted(incremental.boxes(mask)) == sorted([(slice(1, 3), slice(1, 4)), (slice(6, 9), slice(7, 8))])
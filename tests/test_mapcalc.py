@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of batched map algebra for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import mapcalc
+
+
+def test_inputs_skip_functions_and_strings():
+    expression = 'if(isnull(depth_1), 0, depth_1@data - "depth_2") + float(diff)'
+    assert mapcalc.inputs(expression) == set(['depth_1', 'depth_1@data', 'diff'])
+
+
+def test_passes_follow_dependencies():
+    batch = mapcalc.Batch()
+    batch.add('a', 'x + 1')
+    batch.add('b', 'a * 2')
+    batch.add('c', 'y', color='viridis')
+    batch.add('d', 'if(b > c, b, c)')
+    batch.add('e', 'a@PERMANENT')
+    passes = batch.passes()
+    assert [[output for output, expression in expressions] for expressions in passes] == [['a', 'c', 'e'], ['b'], ['d']]
+    assert batch.colors == [('c', {'color': 'viridis'})]
+
+
+def test_independent_expressions_share_a_pass():
+    batch = mapcalc.Batch()
+    for i in range(5):
+        batch.add('diff_'+str(i), 'depth_{i} - depth'.format(i=i))
+    assert len(batch.passes()) == 1
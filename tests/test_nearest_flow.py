@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of the distance from reference concentrated flow for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+from scipy.spatial.distance import cdist
+import nearest_flow
+
+
+def test_nearest_distances_match_brute_force():
+    random = np.random.RandomState(0)
+    reference = random.rand(50, 2)*100
+    points = random.rand(80, 2)*100
+    distances, nearest = nearest_flow.nearest_distances(reference, points)
+    all_distances = cdist(reference, points)
+    np.testing.assert_allclose(distances, all_distances.min(axis=1))
+    np.testing.assert_allclose(all_distances[np.arange(50), nearest], distances)
+
+
+def test_nearest_distances_without_points():
+    distances, nearest = nearest_flow.nearest_distances(np.zeros((3, 2)), np.zeros((0, 2)))
+    assert np.isnan(distances).all()
+    assert len(nearest) == 3
+
+
+def test_distance_statistics():
+    statistics = nearest_flow.distance_statistics(np.array([1.0, 2.0, np.nan, 5.0]))
+    assert statistics['n'] == 3
+    assert statistics['sum'] == 8.0
+    assert statistics['min'] == 1.0
+    assert statistics['max'] == 5.0
+    assert statistics['percentile_50'] == 2.0
+    assert np.isnan(nearest_flow.distance_statistics(np.array([np.nan]))['mean'])
+
+
+def test_cell_coordinates(monkeypatch):
+    region = {'n': 100.0, 'w': 10.0, 'nsres': 2.0, 'ewres': 3.0}
+    monkeypatch.setattr(nearest_flow.gscript, 'region', lambda env=None: region, raising=False)
+    array = np.array([[np.nan, 1.0], [2.0, np.nan]])
+    np.testing.assert_allclose(nearest_flow.cell_coordinates(array), [[14.5, 99.0], [11.5, 97.0]])
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of depression filling for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+import priority_flood
+
+
+def iterative_fill(dem):
+    """fill depressions by lowering water from the top until no cell changes"""
+
+    rows, cols = dem.shape
+    ground = np.nan_to_num(dem)
+    # water drains off the edges and into nulls
+    surface = np.full((rows+2, cols+2), -np.inf)
+    surface[1:-1, 1:-1] = np.where(np.isnan(dem), -np.inf, np.inf)
+    while True:
+        lowest = np.full((rows, cols), np.inf)
+        for row in (-1, 0, 1):
+            for col in (-1, 0, 1):
+                if row or col:
+                    lowest = np.minimum(lowest, surface[1+row:1+row+rows, 1+col:1+col+cols])
+        level = np.where(np.isnan(dem), -np.inf, np.maximum(ground, lowest))
+        if np.array_equal(level, surface[1:-1, 1:-1]):
+            return np.where(np.isnan(dem), np.nan, level)
+        surface[1:-1, 1:-1] = level
+
+
+def random_dem(seed, shape=(30, 40)):
+    """return a rough elevation array with a hole of nulls"""
+
+    dem = np.random.RandomState(seed).rand(*shape)*10
+    dem[12:15, 20:23] = np.nan
+    return dem
+
+
+def test_fill_matches_iterative_fill():
+    for seed in range(5):
+        dem = random_dem(seed)
+        np.testing.assert_allclose(priority_flood.fill(dem), iterative_fill(dem))
+
+
+def test_fill_keeps_surfaces_without_depressions():
+    rows, cols = np.indices((20, 20))
+    dem = (rows+cols).astype(float)
+    np.testing.assert_array_equal(priority_flood.fill(dem), dem)
+
+
+def test_epsilon_fill_drains_every_cell():
+    dem = random_dem(0)
+    filled = priority_flood.fill(dem, epsilon=1e-3)
+    assert np.all(filled[~np.isnan(dem)] >= dem[~np.isnan(dem)])
+
+    # every cell has a lower neighbour or borders the edge or nulls
+    padded = np.pad(filled, 1, mode='constant', constant_values=np.nan)
+    lowest = np.full(dem.shape, np.inf)
+    for row in (-1, 0, 1):
+        for col in (-1, 0, 1):
+            if row or col:
+                neighbour = padded[1+row:1+row+dem.shape[0], 1+col:1+col+dem.shape[1]]
+                lowest = np.minimum(lowest, np.where(np.isnan(neighbour), -np.inf, neighbour))
+    valid = ~np.isnan(dem)
+    assert np.all(lowest[valid] < filled[valid])
+
+
+def test_depression_depth():
+    dem = np.full((5, 5), 2.0)
+    dem[2, 2] = 0.5
+    depth = priority_flood.depression_depth(dem)
+    assert depth[2, 2] == 1.5
+    assert np.isnan(depth).sum() == 24
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of the multiresolution water flow simulation for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+import pyramid
+
+
+def test_refine_mask():
+    shape = (20, 20)
+    depth = np.full(shape, 0.01)
+    depressions = np.full(shape, np.nan)
+    reference_depth = depth.copy()
+    assert not pyramid.refine_mask(depth, depressions, reference_depth).any()
+
+    # concentrated flow, depressions, and differences from the reference are refined with a halo
+    depth[2, 2] = pyramid.depth_threshold
+    depressions[10, 10] = 0.2
+    reference_depth[17, 3] = 0.01+2*pyramid.difference_threshold
+    mask = pyramid.refine_mask(depth, depressions, reference_depth)
+    for row, col in ((2, 2), (10, 10), (17, 3)):
+        assert mask[row, col]
+        assert mask[row, col+pyramid.halo] and not mask[row, col+pyramid.halo+1]
+    # the halo grows through edge neighbours
+    assert mask.sum() == 3*(2*pyramid.halo*(pyramid.halo+1)+1)
+
+
+def test_nulls_are_not_refined():
+    depth = np.full((5, 5), np.nan)
+    assert not pyramid.refine_mask(depth, depth.copy(), depth.copy()).any()
+    reference_depth = np.zeros((5, 5))
+    reference_depth[2, 2] = 1.0
+    assert pyramid.refine_mask(depth, depth.copy(), reference_depth)[2, 2]
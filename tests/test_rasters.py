@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of the shared store of memory mapped arrays for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import numpy as np
+import pytest
+import rasters
+
+
+@pytest.fixture
+def store(tmpdir, monkeypatch):
+    """return a store of arrays of fake rasters with cell files in a temporary directory and the list of exported rasters"""
+
+    cells = tmpdir.mkdir('cell')
+    exported = []
+    region = {'n': 10, 's': 0, 'e': 10, 'w': 0, 'rows': 10, 'cols': 10}
+
+    def find_file(name, element=None, mapset=None, env=None):
+        path = os.path.join(str(cells), name)
+        if not os.path.exists(path):
+            open(path, 'w').close()
+        return {'file': path, 'fullname': name+'@PERMANENT', 'name': name}
+
+    def read_array(raster, env=None):
+        exported.append(raster)
+        return np.full((10, 10), float(len(exported)))
+
+    monkeypatch.setattr(rasters.gscript, 'find_file', find_file, raising=False)
+    monkeypatch.setattr(rasters.gscript, 'region', lambda env=None: region, raising=False)
+    monkeypatch.setattr(rasters, 'read_array', read_array)
+    monkeypatch.setattr(rasters, 'store_dir', str(tmpdir.mkdir('arrays')))
+    monkeypatch.setattr(rasters, 'store_size', None)
+    return str(cells), exported
+
+
+def entries():
+    """return the names of the complete entries of the store"""
+
+    names = os.listdir(rasters.store_dir)
+    return sorted(name[:-5] for name in names if name.endswith('.json') and name[:-5]+'.npy' in names)
+
+
+def test_arrays_are_exported_once(store):
+    cells, exported = store
+    first = rasters.load_array('dem')
+    second = rasters.load_array('dem')
+    assert exported == ['dem']
+    np.testing.assert_array_equal(first, second)
+    assert len(entries()) == 1
+    assert all(not name.startswith('tmp') for name in os.listdir(rasters.store_dir))
+
+
+def test_changed_rasters_are_exported_again(store):
+    cells, exported = store
+    rasters.load_array('dem')
+    stamp = os.path.getmtime(os.path.join(cells, 'dem'))
+    os.utime(os.path.join(cells, 'dem'), (stamp+10, stamp+10))
+    assert rasters.load_array('dem')[0, 0] == 2
+    assert exported == ['dem', 'dem']
+    assert len(entries()) == 1
+
+
+def test_least_recently_used_entries_are_evicted(store):
+    cells, exported = store
+    rasters.load_array('a')
+    rasters.load_array('b')
+    region = rasters.gscript.region()
+    a, b = [rasters._store_entry(name, region)[0] for name in ('a', 'b')]
+    os.utime(a+'.json', (1000, 1000))
+    os.utime(b+'.json', (2000, 2000))
+
+    # using an entry keeps it when the store is full
+    rasters.load_array('a')
+    rasters.store_size = 2*os.path.getsize(a+'.npy')
+    rasters.load_array('c')
+    assert len(entries()) == 2
+    assert os.path.isfile(a+'.npy') and not os.path.isfile(b+'.npy') and not os.path.isfile(b+'.json')
+    assert exported == ['a', 'b', 'c']
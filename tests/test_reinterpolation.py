@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of tiled reinterpolation for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+import reinterpolation
+
+
+def test_feather_ramps_across_the_overlaps():
+    weights = reinterpolation.feather((20, 30, 60, 70), 100)
+    assert np.all(weights[:20] == 0)
+    assert np.all(weights[70:] == 0)
+    assert np.all(weights[40:50] == 1)
+    # the weights are halfway at the edges of the core
+    np.testing.assert_allclose(weights[[29, 30, 59, 60]], [0.475, 0.525, 0.525, 0.475])
+    assert np.all(np.diff(weights[20:40]) > 0)
+    assert np.all(np.diff(weights[50:70]) < 0)
+
+
+def test_feather_does_not_ramp_at_the_region_edges():
+    assert np.all(reinterpolation.feather((0, 0, 60, 70), 100)[:50] == 1)
+    assert np.all(reinterpolation.feather((40, 50, 100, 100), 100)[60:] == 1)
+
+
+def test_neighbouring_tiles_blend_across_the_seam():
+    first = reinterpolation.feather((0, 0, 50, 60), 100)
+    second = reinterpolation.feather((40, 50, 100, 100), 100)
+    assert np.all(first+second > 0)
+    # the tiles mirror each other across the seam
+    np.testing.assert_allclose(first[40:60], second[40:60][::-1])
+
+    # blending two tiles of the same surface gives the surface
+    surface = np.linspace(0, 10, 100)
+    blended = (first*surface+second*surface)/(first+second)
+    np.testing.assert_allclose(blended, surface)
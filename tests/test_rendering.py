@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of the in-process renderer for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+import rendering
+
+# rules in the format of r.colors.out
+rules = """0 0:0:255
+50 0:255:0
+100 255:0:0
+nv 255:255:255
+default 0:0:0
+"""
+
+
+def test_lookup_table():
+    table = rendering.lookup_table(rules)
+    assert table['minimum'] == 0 and table['maximum'] == 100
+    assert tuple(table['table'][0]) == (0, 0, 255)
+    assert tuple(table['table'][-1]) == (255, 0, 0)
+    assert tuple(table['null']) == (255, 255, 255)
+
+
+def test_apply_table_interpolates_colors():
+    table = rendering.lookup_table(rules)
+    colors = rendering.apply_table(table, np.array([[0.0, 25.0, 50.0], [100.0, 200.0, np.nan]]))
+    assert colors.shape == (2, 3, 3) and colors.dtype == np.uint8
+    assert tuple(colors[0, 0]) == (0, 0, 255)
+    assert np.all(np.abs(colors[0, 1].astype(int)-(0, 127, 127)) <= 1)
+    assert np.all(np.abs(colors[0, 2].astype(int)-(0, 255, 0)) <= 1)
+    # values beyond the rules take the color of the nearest rule
+    assert tuple(colors[1, 0]) == (255, 0, 0) and tuple(colors[1, 1]) == (255, 0, 0)
+    assert tuple(colors[1, 2]) == (255, 255, 255)
+
+
+def test_rules_in_any_order():
+    reversed_rules = '\n'.join(reversed(rules.splitlines()))
+    np.testing.assert_array_equal(rendering.lookup_table(reversed_rules)['table'], rendering.lookup_table(rules)['table'])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of the in-process regularized spline with tension for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+from scipy.special import exp1
+import rst
+
+
+def analytic_surface(res=3.0, size=100):
+    """return a smooth surface of about 15 meters of relief and its region"""
+
+    info = {'n': size*res, 'w': 0.0, 'nsres': res, 'ewres': res, 'rows': size, 'cols': size}
+    rows, cols = np.indices((size, size))
+    return 15*np.sin(cols/15.0)*np.cos(rows/20.0)+100, info
+
+
+def residuals(surface, points, info):
+    """return the difference between an interpolated surface and the sampled points"""
+
+    cols = np.floor((points[:, 0]-float(info['w']))/float(info['ewres'])).astype(int)
+    rows = np.floor((float(info['n'])-points[:, 1])/float(info['nsres'])).astype(int)
+    return surface[rows, cols]-points[:, 2]
+
+
+def test_basis_series_matches_exponential_integral():
+    # with fi of 2 the argument of the basis is the squared distance
+    rho = np.array([1e-3, 0.1, 0.5, 0.999, 1.0, 1.001, 4.0, 100.0])
+    expected = -(exp1(rho)+np.log(rho)+rst.euler_gamma)
+    np.testing.assert_allclose(rst.basis(rho, 2.0), expected, rtol=1e-12)
+    # the series keeps the digits of short distances
+    np.testing.assert_allclose(rst.basis(np.array([1e-12]), 2.0), [-1e-12], rtol=1e-9)
+
+
+def test_interpolation_reproduces_samples():
+    surface, info = analytic_surface()
+    points = rst.sample_points(surface, info, 300, seed=1)
+    interpolated = rst.interpolate(points, info, 25, 0, 300, segmax=300)
+    assert np.abs(residuals(interpolated, points, info)).max() < 1e-3
+
+
+def test_interpolation_error_on_analytic_surface():
+    surface, info = analytic_surface()
+    points = rst.sample_points(surface, info, 2000, seed=1)
+    for smooth, tolerance in ((0, 0.01), (0.1, 0.2)):
+        interpolated = rst.interpolate(points, info, 25, smooth, 300)
+        rmse = np.sqrt(np.mean((interpolated-surface)**2))
+        assert rmse < tolerance, (smooth, rmse)
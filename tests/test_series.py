@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of the series statistics for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import warnings
+import numpy as np
+import series
+
+
+def random_stack(seed, shape=(6, 8, 9)):
+    """return a stack of arrays with nulls and a cell that is null in every array"""
+
+    state = np.random.RandomState(seed)
+    stack = state.rand(*shape)*5
+    stack[state.rand(*shape) < 0.3] = np.nan
+    stack[:, 0, 0] = np.nan
+    return stack
+
+
+def expected(stack, method):
+    """return a statistic of a stack with numpy reductions that ignore nans"""
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        count = (~np.isnan(stack)).sum(axis=0)
+        if method == 'count':
+            return count.astype(float)
+        result = {'average': np.nanmean, 'sum': np.nansum, 'maximum': np.nanmax, 'minimum': np.nanmin,
+                  'variance': np.nanvar, 'stddev': np.nanstd}[method](stack, axis=0)
+    return np.where(count > 0, result, np.nan)
+
+
+def test_accumulator_matches_numpy():
+    stack = random_stack(0)
+    accumulator = series.SeriesAccumulator(stack.shape[1:])
+    for array in stack:
+        accumulator.update(array)
+    for method in ('count', 'average', 'sum', 'maximum', 'variance', 'stddev'):
+        np.testing.assert_allclose(accumulator.result(method), expected(stack, method), err_msg=method)
+
+
+def test_accumulator_state_is_saved(tmpdir):
+    stack = random_stack(1)
+    accumulator = series.SeriesAccumulator(stack.shape[1:])
+    for i, array in enumerate(stack[:3]):
+        accumulator.update(array, "depth_"+str(i), float(i))
+    path = os.path.join(str(tmpdir), "depth.npz")
+    accumulator.save(path)
+
+    # continue the series after loading the state
+    accumulator = series.SeriesAccumulator.load(path)
+    assert accumulator.members == {'depth_0': 0.0, 'depth_1': 1.0, 'depth_2': 2.0}
+    for array in stack[3:]:
+        accumulator.update(array)
+    np.testing.assert_allclose(accumulator.result('stddev'), expected(stack, 'stddev'))
+
+
+def test_reduce_stack_matches_numpy():
+    stack = random_stack(2)
+    for method in ('count', 'average', 'sum', 'maximum', 'minimum'):
+        np.testing.assert_allclose(series.reduce_stack(stack, method), expected(stack, method), err_msg=method)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tests of the univariate statistics for the tangible water flow experiment
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import numpy as np
+import univar
+
+
+def test_block_rows_match_the_whole_map():
+    array = np.random.RandomState(0).rand(50, 40)*100
+    array[array < 10] = np.nan
+    values = array[~np.isnan(array)]
+    row = univar._row('depth', array.size, [array[start:start+7] for start in range(0, 50, 7)])
+    assert row[:4] == ('depth', array.size, np.isnan(array).sum(), len(values))
+    expected = (values.sum(), values.mean(), values.min(), values.max(), values.std())+tuple(np.percentile(values, univar.percentiles))
+    np.testing.assert_allclose(row[4:], expected)
+
+
+def test_row_of_a_null_map():
+    row = univar._row('depth', 4, [np.full((2, 2), np.nan)])
+    assert row[:5] == ('depth', 4, 4, 0, 0.0)
+    assert all(np.isnan(value) for value in row[5:])
+
+
+def test_table_rows():
+    table = np.array([univar._row('depth_'+str(i), 4, [np.array([[i, 1.0], [np.nan, 3.0]])]) for i in range(3)], dtype=univar.columns())
+    assert univar.row(table, 'depth_2')['max'] == 3.0
+    assert univar.row(table, 'depth_0')['null_cells'] == 1
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: tracing of GRASS module calls for the tangible water flow experiment
+
+Wraps gscript.run_command, write_command, read_command, and parse_command
+to record the module, its key parameters, the wall time, the CPU time and
+peak resident memory of the child processes, and the map that it produced
+for every call. Calls are appended as lines of JSON to an events file in the
+trace directory so that worker processes forked after tracing is enabled
+record their calls too. The report turns the events into a timeline for
+chrome://tracing or Perfetto and a summary table of time per module.
+
+CPU time and memory come from the resource usage of the child processes
+that have finished, which is unavailable on Windows. CPU time is exact for
+serial calls and shared between calls that overlap in threads. Memory is
+only known as the running maximum of the peak resident memory of all
+children, so a call records the peak of its child only if it raised that
+maximum.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import threading
+import grass.script as gscript
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# set parameters
+trace_dir = None  # directory of the events, timeline, and summary, tracing is disabled if None
+max_value = 80  # maximum number of characters of recorded parameter values
+progress_interval = 1.0  # minimum number of seconds between progress lines
+
+# commands that are traced
+commands = ['run_command', 'write_command', 'read_command', 'parse_command']
+
+# parameters that name the maps produced by each module, output for other modules
+module_outputs = {'r.sim.water': ['depth', 'discharge', 'error'],
+                  'r.slope.aspect': ['dx', 'dy', 'slope', 'aspect'],
+                  'r.fill.dir': ['output', 'direction'],
+                  'r.random': ['vector', 'raster'],
+                  'v.surf.rst': ['elevation'],
+                  'v.distance': ['output']}
+
+# untraced commands
+_originals = {}
+_lock = threading.Lock()
+
+
+def _usage():
+    """return the CPU time in seconds and peak resident memory in kilobytes of finished child processes"""
+
+    if not resource:
+        return None, None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # peak memory is in bytes on mac os and in kilobytes elsewhere
+    peak = usage.ru_maxrss/1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    return usage.ru_utime+usage.ru_stime, peak
+
+
+def _value(value):
+    """return a parameter value as a short string"""
+
+    if isinstance(value, (list, tuple)):
+        value = ','.join(str(item) for item in value)
+    value = str(value)
+    return value if len(value) <= max_value else value[:max_value-3]+'...'
+
+
+def produced(module, parameters, stdin=None):
+    """return the names of the maps produced by a module call or None"""
+
+    if module == 'r.mapcalc' and 'expression' in parameters:
+        return parameters['expression'].split('=')[0].strip()
+    if module == 'r.mapcalc' and stdin:
+        # batched expressions are read from standard input, one per line
+        if isinstance(stdin, bytes):
+            stdin = stdin.decode('utf-8')
+        names = [line.split('=')[0].strip() for line in stdin.splitlines() if '=' in line]
+        return _value(names) if names else None
+    if module in ('g.copy', 'g.rename'):
+        for key in ('raster', 'vector'):
+            if key in parameters:
+                names = parameters[key]
+                return (names.split(',') if isinstance(names, str) else names)[-1]
+    names = [_value(parameters[key]) for key in module_outputs.get(module, ['output']) if key in parameters]
+    return ','.join(names) if names else None
+
+
+def record(event):
+    """append an event to the events file of the trace directory"""
+
+    with _lock:
+        with open(os.path.join(trace_dir, 'events.jsonl'), 'a') as events:
+            events.write(json.dumps(event, sort_keys=True)+'\n')
+
+
+def _traced(command):
+    """return a traced version of a gscript command"""
+
+    original = _originals[command]
+
+    def traced(*args, **kwargs):
+        if not trace_dir:
+            return original(*args, **kwargs)
+        module = args[0] if args else kwargs.get('prog', '')
+        parameters = dict((key, value) for key, value in kwargs.items() if key not in ('env', 'stdin'))
+        cpu, peak = _usage()
+        start = time.time()
+        failed = False
+        try:
+            return original(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            end = time.time()
+            cpu_after, peak_after = _usage()
+            record({'module': module,
+                    'command': command,
+                    'parameters': dict((key, _value(value)) for key, value in parameters.items()),
+                    'start': start,
+                    'wall': end-start,
+                    'cpu': cpu_after-cpu if cpu is not None else None,
+                    'max_rss': peak_after,
+                    'raised_max_rss': peak_after is not None and peak_after > peak,
+                    'output': produced(module, parameters, kwargs.get('stdin')),
+                    'failed': failed,
+                    'pid': os.getpid(),
+                    'thread': threading.current_thread().name})
+
+    traced.__name__ = original.__name__
+    traced.__doc__ = original.__doc__
+    return traced
+
+
+def enable(directory):
+    """trace gscript commands and record them in a directory"""
+
+    global trace_dir
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    trace_dir = directory
+    for command in commands:
+        if command not in _originals:
+            _originals[command] = getattr(gscript, command)
+            setattr(gscript, command, _traced(command))
+
+
+def disable():
+    """restore the untraced gscript commands"""
+
+    global trace_dir
+    trace_dir = None
+    for command, original in _originals.items():
+        setattr(gscript, command, original)
+    _originals.clear()
+
+
+def read_events(directory):
+    """return the recorded events of a trace directory in order of their start"""
+
+    path = os.path.join(directory, 'events.jsonl')
+    if not os.path.isfile(path):
+        return []
+    with open(path) as events:
+        return sorted((json.loads(line) for line in events if line.strip()), key=lambda event: event['start'])
+
+
+def timeline(events):
+    """return events in the trace event format of chrome://tracing"""
+
+    if not events:
+        return {'traceEvents': []}
+    origin = min(event['start'] for event in events)
+    threads = {}
+    trace = []
+    for event in events:
+        thread = threads.setdefault((event['pid'], event['thread']), len(threads))
+        args = dict(event['parameters'])
+        for key in ('cpu', 'max_rss', 'raised_max_rss', 'output', 'failed'):
+            if event[key] is not None:
+                args[key] = event[key]
+        trace.append({'name': event['module'],
+                      'cat': event['command'],
+                      'ph': 'X',
+                      'ts': int((event['start']-origin)*1e6),
+                      'dur': int(event['wall']*1e6),
+                      'pid': event['pid'],
+                      'tid': thread,
+                      'args': args})
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+
+def summary(events):
+    """return rows of the number of calls, wall time, CPU time, and peak memory of each module by total wall time
+
+    The peak memory of a module is the largest peak of its calls that raised
+    the running maximum of all children, so it is a lower bound of the true
+    peak and zero for modules that never raised it.
+    """
+
+    modules = {}
+    for event in events:
+        row = modules.setdefault(event['module'], {'module': event['module'], 'calls': 0, 'failed': 0,
+                                                   'wall': 0.0, 'max_wall': 0.0, 'cpu': 0.0, 'peak_rss': 0})
+        row['calls'] += 1
+        row['failed'] += int(event['failed'])
+        row['wall'] += event['wall']
+        row['max_wall'] = max(row['max_wall'], event['wall'])
+        row['cpu'] += event['cpu'] or 0.0
+        if event['raised_max_rss']:
+            row['peak_rss'] = max(row['peak_rss'], event['max_rss'])
+    total = sum(row['wall'] for row in modules.values()) or 1.0
+    rows = sorted(modules.values(), key=lambda row: row['wall'], reverse=True)
+    for row in rows:
+        row['mean_wall'] = row['wall']/row['calls']
+        row['percent'] = row['wall']/total*100
+    return rows
+
+
+def report(directory=None):
+    """write the timeline and summary of a trace directory, print the summary, and return its rows"""
+
+    directory = directory or trace_dir
+    events = read_events(directory)
+    with open(os.path.join(directory, 'trace.json'), 'w') as output:
+        json.dump(timeline(events), output)
+
+    rows = summary(events)
+    columns = ['module', 'calls', 'failed', 'wall', 'mean_wall', 'max_wall', 'percent', 'cpu', 'peak_rss']
+    with open(os.path.join(directory, 'summary.csv'), 'w') as output:
+        writer = csv.DictWriter(output, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print('{0:<16}{1:>7}{2:>12}{3:>10}{4:>8}{5:>12}{6:>12}'.format('module', 'calls', 'wall (s)', 'mean (s)', '%', 'cpu (s)', 'rss (kb)'))
+    for row in rows:
+        print('{module:<16}{calls:>7}{wall:>12.2f}{mean_wall:>10.2f}{percent:>8.1f}{cpu:>12.2f}{peak_rss:>12}'.format(**row))
+    return rows
+
+
+class Progress(object):
+    """print the number of finished items of a batch and the estimated time remaining"""
+
+    def __init__(self, total, label):
+        self.total = total
+        self.label = label
+        self.done = 0
+        self.start = time.time()
+        self.printed = 0
+
+    def step(self, name=''):
+        self.done += 1
+        now = time.time()
+        if now-self.printed < progress_interval and self.done < self.total:
+            return
+        self.printed = now
+        elapsed = now-self.start
+        remaining = elapsed/self.done*(self.total-self.done)
+        line = '{label}: {done}/{total} {name} elapsed {elapsed} eta {remaining}'.format(
+            label=self.label, done=self.done, total=self.total, name=name,
+            elapsed=_duration(elapsed), remaining=_duration(remaining))
+        sys.stdout.write('\r'+line.ljust(79))
+        if self.done >= self.total:
+            sys.stdout.write('\n')
+        sys.stdout.flush()
+
+
+def _duration(seconds):
+    """return seconds as hours, minutes, and seconds"""
+
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+def main():
+    report(sys.argv[1] if len(sys.argv) > 1 else None)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
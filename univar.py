@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+@brief: univariate statistics of many rasters for the tangible water flow experiment
+
+Computes the cell and null counts, sum, mean, minimum, maximum, standard
+deviation, and percentiles of a list of rasters like r.univar -e, but in
+process block by block instead of one r.univar call per map. Only the values
+of one map are held at a time for its percentiles. Maps can be split between
+a pool of worker processes. The statistics are returned as a table with a
+row for each map.
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file COPYING that comes with GRASS for details.
+
+@author: Brendan Harmon (brendanharmon@gmail.com)
+"""
+
+import csv
+import numpy as np
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+import parallel
+import rasters
+import series
+
+# set parameters
+percentiles = (25, 50, 75, 90)
+nprocs = 1  # number of worker processes that the maps are split between
+
+
+def columns():
+    """return the names and types of the columns of the statistics table"""
+
+    return ([('map', object), ('cells', np.int64), ('null_cells', np.int64), ('n', np.int64),
+             ('sum', np.float64), ('mean', np.float64), ('min', np.float64), ('max', np.float64), ('stddev', np.float64)]
+            + [('percentile_'+str(p), np.float64) for p in percentiles])
+
+
+def _row(raster, cells, blocks):
+    """return the statistics of the valid values of blocks of a raster with a number of cells as a tuple
+
+    The count, sum, mean, sum of squared deviations, minimum, and maximum are
+    combined block by block; only the valid values of this raster are kept
+    for its percentiles.
+    """
+
+    n, total_sum, mean, m2 = 0, 0.0, 0.0, 0.0
+    minimum, maximum = np.inf, -np.inf
+    values = []
+    for block in blocks:
+        block = block[~np.isnan(block)]
+        if not len(block):
+            continue
+        # combine the moments of the block with the running moments
+        block_mean = float(block.mean())
+        block_m2 = float(((block-block_mean)**2).sum())
+        total = n+len(block)
+        delta = block_mean-mean
+        mean += delta*len(block)/total
+        m2 += block_m2+delta*delta*n*len(block)/total
+        n = total
+        total_sum += float(block.sum())
+        minimum = min(minimum, float(block.min()))
+        maximum = max(maximum, float(block.max()))
+        if percentiles:
+            values.append(block)
+
+    if not n:
+        return (raster, cells, cells, 0, 0.0)+(np.nan,)*(4+len(percentiles))
+    quantiles = np.percentile(np.concatenate(values), percentiles) if percentiles else []
+    return ((raster, cells, cells-n, n, total_sum, mean, minimum, maximum, np.sqrt(m2/n))
+            + tuple(float(value) for value in quantiles))
+
+
+def _blocks(raster, region):
+    """read an open raster block by block"""
+
+    for start in range(0, region.rows, series.block_rows):
+        yield series._read_block(raster, start, min(start+series.block_rows, region.rows))
+
+
+def _collect(task):
+    """return the statistics of a list of rasters read one after another block by block or whole in an environment"""
+
+    maps, env = task
+    result = []
+    if env is not None:
+        for raster in maps:
+            array = rasters.read_array(raster, env=env)
+            result.append(_row(raster, array.size, [array]))
+        return result
+
+    region = Region()
+    for raster in maps:
+        opened = RasterRow(raster)
+        opened.open('r')
+        try:
+            result.append(_row(raster, region.rows*region.cols, _blocks(opened, region)))
+        finally:
+            opened.close()
+    return result
+
+
+def collect(maps, env=None, processes=None):
+    """return a table of the univariate statistics of a list of rasters
+
+    The table is a structured array with a row for each map in order; with
+    more than one process the maps are split between a pool of workers
+    """
+
+    processes = processes or nprocs
+    if processes > 1 and len(maps) > 1:
+        chunks = [list(maps[i::processes]) for i in range(min(processes, len(maps)))]
+        rows = dict((row[0], row) for result in parallel.run_in_pool(_collect, [(chunk, env) for chunk in chunks], processes) for row in result)
+        rows = [rows[raster] for raster in maps]
+    else:
+        rows = _collect((list(maps), env))
+    return np.array(rows, dtype=columns())
+
+
+def row(table, raster):
+    """return the row of a raster in a statistics table"""
+
+    matches = table[table['map'] == raster]
+    if not len(matches):
+        raise KeyError(raster)
+    return matches[0]
+
+
+def write_table(table, path):
+    """write a statistics table as comma separated values"""
+
+    with open(path, 'w') as output:
+        writer = csv.writer(output)
+        writer.writerow(table.dtype.names)
+        writer.writerows(table.tolist())